@@ -1,11 +1,17 @@
 from models import (ActionMixin, UserMixin, ItemMixin,
-                    ComputationMixin, COMPUTATION_SK_NAME,
-                    ACTION_UPVOTE, ACTION_DOWNVOTE)
+                    ComputationMixin, LinkMixin, COMPUTATION_SK_NAME,
+                    ACTION_UPVOTE, ACTION_DOWNVOTE,
+                    ACTION_FLAG_SPAM, ACTION_FLAG_HAM, deferred)
 
-from api import (bind_engine, bootstrap,
-                 run_offline_spam_detection, raise_spam_flag,
+from api import (bind_engine, bootstrap, create_indexes,
+                 run_offline_spam_detection, reconcile_counters,
+                 backfill_mm_random, redraw_mm_random,
+                 backfill_mm_priority,
+                 rebuild_links,
+                 apply_actions, raise_spam_flag,
                  raise_ham_flag, suggest_n_users_to_review,
                  get_n_items_for_spam_mm_randomly,
+                 get_n_items_for_mm_by_uncertainty,
                  delete_spam_item_by_author,
                  delete_item,
                  add_item, get_add_item,
@@ -1,16 +1,20 @@
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine, and_, inspect, case, func
 from datetime import datetime
+import random
 import numpy as np
 from models import (ActionMixin, UserMixin, ItemMixin, ComputationMixin,
-                    COMPUTATION_SK_NAME,
+                    LinkMixin, COMPUTATION_SK_NAME, listen_link_events,
                     ACTION_UPVOTE, ACTION_DOWNVOTE,
-                    ACTION_FLAG_SPAM, ACTION_FLAG_HAM)
+                    ACTION_FLAG_SPAM, ACTION_FLAG_HAM,
+                    deferred, flush, add_to_session, delete_from_session)
 
 
 import spam_utils as su
+import graph_d as gd
 import spam_detection_karger as sdk
 import spam_detection_dirichlet as sdd
 import hitsDB
+from spam_detection_mixins import expire_instances
 
 SPAM_ALGO = su.ALGO_DIRICHLET
 
@@ -21,8 +25,16 @@ def bind_engine(engine, session, base, should_create=True):
         base.metadata.create_all(engine)
 
 
-def bootstrap(base, create_all=False):
-    """ Engine should be binded before calling this function."""
+def bootstrap(base, create_all=False, percentile_table_path=None):
+    """ Engine should be binded before calling this function.
+    If percentile_table_path (by default DIRICHLET_PERCENTILE_TABLE from
+    mannord.conf) is not empty then the Dirichlet percentile table is loaded
+    from this file, see graph_d.load_percentile_table().
+    The link table is maintained only if hitsDB.USE_LINK_TABLE is True. If
+    the table does not exist in the database (a deployment created before
+    it was added) and create_all is False then USE_LINK_TABLE is set to
+    False and links are counted from items and actions, see rebuild_links().
+    """
     class Computation(ComputationMixin, base):
         pass
 
@@ -35,24 +47,179 @@ def bootstrap(base, create_all=False):
     class ModerationUser(UserMixin, base):
         pass
 
+    class UserPageLink(LinkMixin, base):
+        pass
+
     ActionMixin.cls = ModerationAction
     ItemMixin.cls = ModeratedAnnotation
     ComputationMixin.cls = Computation
     UserMixin.cls = ModerationUser
+    LinkMixin.cls = UserPageLink
+    bind = base.metadata.bind
+    if (hitsDB.USE_LINK_TABLE and not create_all and bind is not None and
+        LinkMixin.__tablename__ not in inspect(bind).get_table_names()):
+        hitsDB.USE_LINK_TABLE = False
+    if hitsDB.USE_LINK_TABLE:
+        listen_link_events()
+
+    if percentile_table_path is None:
+        percentile_table_path = su.DIRICHLET_PERCENTILE_TABLE
+    if percentile_table_path:
+        gd.load_percentile_table(percentile_table_path)
 
     if create_all:
         base.metadata.create_all(base.metadata.bind)
 
 
-def run_offline_spam_detection(algo_name, session):
-    """ Method runs offline spam detection. """
+def create_indexes(engine):
+    """ Creates indexes declared on mannord tables which are missing in the
+    database. Useful for deployments created before the indexes were added.
+    bootstrap() should be called before this function. Returns names of
+    created indexes."""
+    inspector = inspect(engine)
+    created = []
+    for cls in (ActionMixin.cls, ItemMixin.cls, UserMixin.cls):
+        table = cls.__table__
+        existing = set(idx['name'] for idx in
+                       inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            index.create(bind=engine)
+            created.append(index.name)
+    return created
+
+
+def run_offline_spam_detection(algo_name, session, incremental=False):
+    """ Method runs offline spam detection. If incremental is True then only
+    the region of the graph changed since the last run is recomputed."""
     # Obtains class names to perform db querries later.
     if algo_name == su.ALGO_KARGER:
-        sdk.run_offline_computations(session)
+        if incremental:
+            sdk.run_incremental_computations(session)
+        else:
+            sdk.run_offline_computations(session)
     else:
-        sdd.run_offline_computations(session)
-        pass
+        if incremental:
+            sdd.run_incremental_computations(session)
+        else:
+            sdd.run_offline_computations(session)
+    session.flush()
+
+
+def rebuild_links(session):
+    """ Regenerates the user-page link table (created if it does not exist)
+    from items and actions and turns on its use and maintenance by this
+    process (see bootstrap()). Other processes start using the table when
+    they are bootstrapped again. Returns the number of links."""
+    LinkClass = LinkMixin.cls
+    session.flush()
+    LinkClass.__table__.create(bind=session.connection(), checkfirst=True)
+    session.query(LinkClass).delete(synchronize_session=False)
+    mappings = [{'page_url': page_url, 'user_id': user_id, 'weight': weight}
+                for page_url, page_links in
+                    hitsDB.count_links_on_pages(None, session).iteritems()
+                for user_id, weight in page_links.iteritems()]
+    session.bulk_insert_mappings(LinkClass, mappings)
+    session.expire_all()
     session.flush()
+    listen_link_events()
+    hitsDB.USE_LINK_TABLE = True
+    hitsDB.suggestion_cache.clear()
+    return len(mappings)
+
+
+def reconcile_counters(session):
+    """ Recomputes vote_counter, mm_vote_counter and spam_flag_counter from
+    the action table and fixes rows which drifted. Each counter table is
+    aggregated by a single GROUP BY query. Returns the number of fixed rows.
+    """
+    User = UserMixin.cls
+    Item = ItemMixin.cls
+    Action = ActionMixin.cls
+    vote = case([(Action.type == ACTION_UPVOTE, 1),
+                 (Action.type == ACTION_DOWNVOTE, -1)], else_=0)
+    mm_vote = case([(Action.item_twin_id != None, vote)], else_=0)
+    session.flush()
+    votes = dict((author_id, (int(v), int(mm_v))) for author_id, v, mm_v in
+                 session.query(Item.author_id, func.sum(vote),
+                               func.sum(mm_vote)
+                              ).join(Action, Action.item_id == Item.id
+                              ).group_by(Item.author_id))
+    flags = dict(session.query(Action.item_id, func.count(Action.id)
+                              ).filter(Action.type == ACTION_FLAG_SPAM
+                              ).group_by(Action.item_id))
+    user_mappings = []
+    for user_id, v, mm_v in session.query(User.id, User.vote_counter,
+                                          User.mm_vote_counter):
+        new_v, new_mm_v = votes.get(user_id, (0, 0))
+        if (v, mm_v) != (new_v, new_mm_v):
+            user_mappings.append({'id': user_id, 'vote_counter': new_v,
+                                  'mm_vote_counter': new_mm_v})
+    item_mappings = []
+    for item_id, counter in session.query(Item.id, Item.spam_flag_counter):
+        new_counter = flags.get(item_id, 0)
+        if counter != new_counter:
+            item_mappings.append({'id': item_id,
+                                  'spam_flag_counter': new_counter})
+    session.bulk_update_mappings(User, user_mappings)
+    session.bulk_update_mappings(Item, item_mappings)
+    expire_instances(session, User, [m['id'] for m in user_mappings])
+    expire_instances(session, Item, [m['id'] for m in item_mappings])
+    session.flush()
+    return len(user_mappings) + len(item_mappings)
+
+
+def backfill_mm_random(session):
+    """ Draws mm_random keys of items which have none (rows created before
+    the column was added), such items are never returned by
+    get_n_items_for_spam_mm_randomly(). Returns the number of updated items.
+    """
+    Item = ItemMixin.cls
+    return _draw_mm_random(session, Item.mm_random == None)
+
+
+def redraw_mm_random(session):
+    """ Draws new mm_random keys of items marked for metamoderation.
+    get_n_items_for_spam_mm_randomly() picks an item with probability equal
+    to the gap before its key, so it is fair only on average over keys: the
+    function should be run periodically (e.g. with offline spam detection).
+    Returns the number of updated items."""
+    Item = ItemMixin.cls
+    return _draw_mm_random(session, Item.marked_for_mm == True)
+
+
+def _draw_mm_random(session, condition):
+    Item = ItemMixin.cls
+    session.flush()
+    mappings = [{'id': item_id, 'mm_random': random.random()} for item_id, in
+                session.query(Item.id).filter(condition)]
+    session.bulk_update_mappings(Item, mappings)
+    expire_instances(session, Item, [m['id'] for m in mappings])
+    session.flush()
+    return len(mappings)
+
+
+def backfill_mm_priority(session, algo_name=SPAM_ALGO):
+    """ Computes mm_priority of items which have none (rows created before
+    the column was added) from their weight of algo_name, such items are
+    never returned by get_n_items_for_mm_by_uncertainty(). Items without a
+    weight are skipped. Returns the number of updated items."""
+    Item = ItemMixin.cls
+    if algo_name == su.ALGO_KARGER:
+        weight_column = Item.sk_weight
+    else:
+        weight_column = Item.sd_weight
+    session.flush()
+    mappings = [{'id': item_id,
+                 'mm_priority': su.get_mm_priority(weight, algo_name)}
+                for item_id, weight in
+                    session.query(Item.id, weight_column).filter(
+                        Item.mm_priority == None, weight_column != None)]
+    session.bulk_update_mappings(Item, mappings)
+    expire_instances(session, Item, [m['id'] for m in mappings])
+    session.flush()
+    return len(mappings)
 
 
 def raise_spam_flag(item, user, session, algo_name=su.ALGO_DIRICHLET):
@@ -61,6 +228,7 @@ def raise_spam_flag(item, user, session, algo_name=su.ALGO_DIRICHLET):
         sdk.flag_spam(item, user, timestamp, session)
     else:
         sdd.flag_spam(item, user, timestamp, session)
+    hitsDB.suggestion_cache.invalidate(item.page_url)
 
 
 def raise_ham_flag(item, user, session, algo_name=su.ALGO_DIRICHLET):
@@ -69,20 +237,65 @@ def raise_ham_flag(item, user, session, algo_name=su.ALGO_DIRICHLET):
         sdk.flag_ham(item, user, timestamp, session)
     else:
         sdd.flag_ham(item, user, timestamp, session)
+    hitsDB.suggestion_cache.invalidate(item.page_url)
+
+
+def apply_actions(actions, session, algo_name=su.ALGO_DIRICHLET):
+    """ Applies a list of (action_type, item, user) tuples, where action_type
+    is upvote, downvote, spam or ham flag. The final state is the same as
+    after calling upvote(), downvote(), raise_spam_flag() or raise_ham_flag()
+    for each tuple in order, but existing actions of the batch are fetched
+    by one query, counters are updated once per row and the session is
+    flushed once, see deferred()."""
+    for action_type, item, user in actions:
+        if action_type not in (ACTION_UPVOTE, ACTION_DOWNVOTE,
+                               ACTION_FLAG_SPAM, ACTION_FLAG_HAM):
+            raise Exception("Unknown action: %s" % action_type)
+    with deferred(session) as batch:
+        ActionMixin.cls.prefetch_actions([(item.id, user.id) for _, item, user
+                                          in actions], batch, session)
+        for action_type, item, user in actions:
+            if action_type == ACTION_UPVOTE:
+                upvote(item, user, session)
+            elif action_type == ACTION_DOWNVOTE:
+                downvote(item, user, session)
+            elif action_type == ACTION_FLAG_SPAM:
+                raise_spam_flag(item, user, session, algo_name=algo_name)
+            else:
+                raise_ham_flag(item, user, session, algo_name=algo_name)
 
 
 def suggest_n_users_to_review(item, n, session):
     if item is None or item.page_url is None:
         return []
-    n_users = hitsDB.suggest_n_users_to_review(item, n, session)
+    deadline = hitsDB.get_deadline()
+    n_users = hitsDB.suggestion_cache.get(item.page_url, item.author_id, n)
+    if n_users is None:
+        n_users = hitsDB.suggest_n_users_to_review(item, n, session,
+                                                   deadline=deadline)
+        hitsDB.suggestion_cache.put(item.page_url, item.author_id, n, n_users)
     if len(n_users) < n:
-        # todo(michael): do random sampling (or some criteria)
-        pass
+        # Tops up with random active reliable users.
+        exclude = set(n_users)
+        exclude.add(item.author_id)
+        n_users.extend(hitsDB.reservoir.sample(n - len(n_users), exclude,
+                                               session, algo_name=SPAM_ALGO,
+                                               deadline=deadline))
     return n_users
 
 
 def get_n_items_for_spam_mm_randomly(n, session):
-   return ItemMixin.cls.get_n_items_for_spam_mm_randomly(n, session)
+    """ Returns n random items marked for metamoderation, see
+    redraw_mm_random(). Items without a key are not returned, see
+    backfill_mm_random()."""
+    return ItemMixin.cls.get_n_items_for_spam_mm_randomly(n, session)
+
+
+def get_n_items_for_mm_by_uncertainty(n, session):
+    """ Returns n items marked for metamoderation with the most uncertain
+    spam decision first. Items without mm_priority are not returned, see
+    backfill_mm_priority()."""
+    return ItemMixin.cls.get_n_items_for_mm_by_uncertainty(n, session)
 
 
 def delete_spam_item_by_author(item, session, algo_name=su.ALGO_DIRICHLET):
@@ -92,15 +305,15 @@ def delete_spam_item_by_author(item, session, algo_name=su.ALGO_DIRICHLET):
     if item.action_twin is not None:
         # If the item is also an action, delete the action first.
         if item.action_twin.type == ACTION_UPVOTE:
-            item.parent.author.mm_vote_counter -= 1
-            item.parent.author.vote_counter -= 1
+            UserMixin.cls.increment_vote_counters(item.parent.author_id,
+                                                  session, vote=-1, mm_vote=-1)
         elif item.action_twin.type == ACTION_DOWNVOTE:
-            item.parent.author.mm_vote_counter += 1
-            item.parent.author.vote_counter += 1
+            UserMixin.cls.increment_vote_counters(item.parent.author_id,
+                                                  session, vote=1, mm_vote=1)
         else:
             raise Exception("Unknown action: %s" % item.action_twin)
-        session.delete(item.action_twin)
-        session.flush()
+        delete_from_session(item.action_twin, session)
+        flush(session)
     # Okay, deletes the item.
     if algo_name == su.ALGO_KARGER:
         sdk.delete_spam_item_by_author(item, session)
@@ -108,6 +321,7 @@ def delete_spam_item_by_author(item, session, algo_name=su.ALGO_DIRICHLET):
         sdd.delete_spam_item_by_author(item, session)
     else:
         raise Exception("Unknown algorithm!")
+    hitsDB.suggestion_cache.invalidate(item.page_url)
 
 
 def add_item(page_url, item_id, user, session, parent_id=None, action_type=None,
@@ -115,8 +329,8 @@ def add_item(page_url, item_id, user, session, parent_id=None, action_type=None,
     """ Creates an item and adds it to the db."""
     annot = ItemMixin.cls(page_url, item_id, user, parent_id=parent_id,
                           spam_detect_algo=spam_detect_algo)
-    session.add(annot)
-    session.flush()
+    add_to_session(annot, session)
+    flush(session)
     # If the annotation is action, then create and bind the action.
     if action_type is not None:
         if parent_id is None:
@@ -125,15 +339,16 @@ def add_item(page_url, item_id, user, session, parent_id=None, action_type=None,
                               datetime.utcnow(), item_twin_id=annot.id)
         item = ItemMixin.cls.get_item(parent_id, session)
         if action_type == ACTION_UPVOTE:
-            item.author.mm_vote_counter += 1
-            item.author.vote_counter += 1
+            UserMixin.cls.increment_vote_counters(item.author_id, session,
+                                                  vote=1, mm_vote=1)
         elif action_type == ACTION_DOWNVOTE:
-            item.author.mm_vote_counter -= 1
-            item.author.vote_counter -= 1
+            UserMixin.cls.increment_vote_counters(item.author_id, session,
+                                                  vote=-1, mm_vote=-1)
         else:
             raise Exception("Action should be whether upvote or donwvote!")
-        session.add(act)
-        session.flush()
+        add_to_session(act, session)
+        flush(session)
+    hitsDB.suggestion_cache.invalidate(page_url)
     return annot
 
 
@@ -156,16 +371,17 @@ def delete_item(item, session):
         return
     if item.action_twin is not None:
         if item.action_twin.type == ACTION_UPVOTE:
-            item.parent.author.mm_vote_counter -= 1
-            item.parent.author.vote_counter -= 1
+            UserMixin.cls.increment_vote_counters(item.parent.author_id,
+                                                  session, vote=-1, mm_vote=-1)
         elif item.action_twin.type == ACTION_DOWNVOTE:
-            item.parent.author.mm_vote_counter += 1
-            item.parent.author.vote_counter += 1
+            UserMixin.cls.increment_vote_counters(item.parent.author_id,
+                                                  session, vote=1, mm_vote=1)
         else:
             raise Exception("Unknown action: %s" % item.action_twin)
-        session.delete(item.action_twin)
-    session.delete(item)
-    session.flush()
+        delete_from_session(item.action_twin, session)
+    delete_from_session(item, session)
+    flush(session)
+    hitsDB.suggestion_cache.invalidate(item.page_url)
 
 
 def get_add_user(user_id, session):
@@ -174,8 +390,8 @@ def get_add_user(user_id, session):
     user = UserMixin.cls.get_user(user_id, session)
     if user is None:
         user = UserMixin.cls(user_id)
-        session.add(user)
-        session.flush()
+        add_to_session(user, session)
+        flush(session)
     return user
 
 
@@ -190,10 +406,11 @@ def upvote(item, user, session):
     # Okay, upvoting fresh
     act = ActionMixin.cls(item.id, user.id, ACTION_UPVOTE, datetime.utcnow())
     # Increase item author's vote counter.
-    item.author.vote_counter += 1
+    UserMixin.cls.increment_vote_counters(item.author_id, session, vote=1)
     raise_ham_flag(item, user, session)
-    session.add(act)
-    session.flush()
+    add_to_session(act, session)
+    flush(session)
+    hitsDB.suggestion_cache.invalidate(item.page_url)
 
 
 def downvote(item, user, session):
@@ -205,9 +422,10 @@ def downvote(item, user, session):
     # Downvoting
     act = ActionMixin.cls(item.id, user.id, ACTION_DOWNVOTE, datetime.utcnow())
     # Decrease item author's vote counter
-    item.author.vote_counter -= 1
-    session.add(act)
-    session.flush()
+    UserMixin.cls.increment_vote_counters(item.author_id, session, vote=-1)
+    add_to_session(act, session)
+    flush(session)
+    hitsDB.suggestion_cache.invalidate(item.page_url)
 
 
 def undo_upvote(item, user, session):
@@ -215,15 +433,16 @@ def undo_upvote(item, user, session):
     if upvote is None:
         # Nothing to do
         return
-    item.author.vote_counter -= 1
+    UserMixin.cls.increment_vote_counters(item.author_id, session, vote=-1)
     if SPAM_ALGO == su.ALGO_KARGER:
         sdk._undo_spam_ham_flag(item, user, session, spam_flag=False)
     elif SPAM_ALGO == su.ALGO_DIRICHLET:
         sdd._undo_spam_ham_flag(item, user, session, spam_flag=False)
     else:
         raise Exception("unknown algorithm")
-    session.delete(upvote)
-    session.flush()
+    delete_from_session(upvote, session)
+    flush(session)
+    hitsDB.suggestion_cache.invalidate(item.page_url)
 
 
 def undo_downvote(item, user, session):
@@ -231,6 +450,7 @@ def undo_downvote(item, user, session):
     if downvote is None:
         # Nothing to do
         return
-    item.author.vote_counter += 1
-    session.delete(downvote)
-    session.flush()
+    UserMixin.cls.increment_vote_counters(item.author_id, session, vote=1)
+    delete_from_session(downvote, session)
+    flush(session)
+    hitsDB.suggestion_cache.invalidate(item.page_url)
@@ -0,0 +1,66 @@
+import math
+import hashlib
+import struct
+
+
+class BloomFilter(object):
+    """ Set of strings which answers membership queries with no false
+    negatives and a false positive rate close to error_rate as long as at
+    most capacity strings are added. Strings cannot be removed."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.n_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                    math.log(2) ** 2))
+        self.n_hashes = max(1, int(round(self.n_bits * math.log(2) /
+                                         capacity)))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_added = 0
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _indices(self, key):
+        # Double hashing, k hash functions are derived from two 64-bit halves
+        # of md5.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.n_bits for i in xrange(self.n_hashes)]
+
+    def add(self, key):
+        for idx in self._indices(key):
+            self.bits[idx >> 3] |= 1 << (idx & 7)
+        self.n_added += 1
+
+    def __contains__(self, key):
+        for idx in self._indices(key):
+            if not self.bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+
+class ScalableBloomFilter(object):
+    """ Bloom filter which grows instead of losing precision: when the last
+    BloomFilter holds capacity strings, a new one growth times larger is
+    added. Error rates of new filters are halved, so the false positive rate
+    stays below 2 * error_rate however many strings are added."""
+
+    def __init__(self, capacity, error_rate=0.01, growth=2):
+        self.growth = growth
+        self.filters = [BloomFilter(capacity, error_rate=error_rate / 2.0)]
+
+    @property
+    def n_added(self):
+        return sum(f.n_added for f in self.filters)
+
+    def add(self, key):
+        last = self.filters[-1]
+        if last.n_added >= last.capacity:
+            last = BloomFilter(last.capacity * self.growth,
+                               error_rate=last.error_rate / 2.0)
+            self.filters.append(last)
+        last.add(key)
+
+    def __contains__(self, key):
+        for f in self.filters:
+            if key in f:
+                return True
+        return False
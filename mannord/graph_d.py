@@ -1,40 +1,421 @@
 # Spam detection algorithm in spirit of belief propagation (like Karger's algo).
 # Use's reliability is computed using Dirichlet dist.
+import math
 import numpy as np
+from graph_pool import compute_residual, RESIDUAL_NORM_MAX
 
 ALGO_DIRICHLET_KARMA_USER_VOTE = 0.1
+# Percentile used to compute users' reliability and items' weight.
+PERCENTILE = 0.8
+# Maximum number of (neg, pos) pairs which are processed at once by
+# compute_percentile_dirichlet_array(), every pair takes about 80KB per
+# temporary array.
+PERCENTILE_CHUNK_SIZE = 8
+# If True then percentiles are computed by inverting the regularized
+# incomplete Beta function (compute_percentile_beta()), otherwise they are
+# computed by numerical integration on a grid with step 0.0001.
+USE_BETA_SOLVER = True
+# Error bound of percentiles computed by compute_percentile_beta().
+PERCENTILE_TOLERANCE = 1e-9
+# Default range and step of a percentile lookup table
+# (see build_percentile_table()). With these values the table takes 1.3MB
+# and the largest interpolation error measured at centers of its cells is
+# about 6e-5.
+PERCENTILE_TABLE_MAX_COUNT = 20
+PERCENTILE_TABLE_STEP = 0.05
 
 DEBUG = False
 
+# Grid for numerical integration in compute_percentile_dirichlet().
+_GRID_DELTA = 0.0001
+_GRID_X = np.arange(0 + _GRID_DELTA, 1, _GRID_DELTA)
+_GRID_LOG_X = np.log(_GRID_X)
+_GRID_LOG_1_X = np.log(1 - _GRID_X)
+# Cache of percentiles of the (0, 0) case, it maps (percentile,
+# USE_BETA_SOLVER) to the value.
+_mid_point_cache = {}
+# Constants of the Beta solver.
+_FPMIN = 1e-300
+_CF_EPS = 1e-13
+_CF_MAX_TERMS = 100000
+_SOLVER_MAX_ITER = 200
+_lgamma = np.frompyfunc(math.lgamma, 1, 1)
+# Loaded percentile lookup table, see load_percentile_table().
+_percentile_table = None
+
+
+def _percentile_on_grid(alpha, beta, percentile):
+    """ Computes percentiles for 1-d arrays alpha and beta on the grid."""
+    # Unnormalised probability mass function x ** alpha * (1 - x) ** beta,
+    # it is computed as an exponent of its logarithm.
+    y = np.exp(alpha[:, np.newaxis] * _GRID_LOG_X +
+               beta[:, np.newaxis] * _GRID_LOG_1_X)
+    # Integral approximation based on trapezoidal rule, row by row.
+    integral_vec = (y[:, 1:] + y[:, :-1]) / 2 * _GRID_DELTA
+    integral = np.sum(integral_vec, axis=1)
+    cumsum = np.cumsum(integral_vec, axis=1)
+    threshold = (1 - percentile) * integral
+    # Same as cumsum.searchsorted(threshold) for every row.
+    idx = np.sum(cumsum < threshold[:, np.newaxis], axis=1)
+    return idx * _GRID_DELTA
+
+
+def _log_beta(a, b):
+    """ Logarithm of the Beta function for arrays a and b."""
+    return np.asarray(_lgamma(a) + _lgamma(b) - _lgamma(a + b),
+                      dtype=np.float64)
+
+
+def _avoid_zero(val):
+    if isinstance(val, np.ndarray):
+        return np.where(np.abs(val) < _FPMIN, _FPMIN, val)
+    return _FPMIN if abs(val) < _FPMIN else val
+
+
+def _beta_cont_frac(a, b, x):
+    """ Evaluates continued fraction for the incomplete Beta function by
+    modified Lentz's method (see Numerical Recipes, betacf).
+    Arguments are floats or arrays of the same shape."""
+    qab = a + b
+    qap = a + 1
+    qam = a - 1
+    c = 1.0
+    d = 1 / _avoid_zero(1 - qab * x / qap)
+    h = d
+    for m in xrange(1, _CF_MAX_TERMS + 1):
+        m2 = 2 * m
+        # Even step of the recurrence.
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1 / _avoid_zero(1 + aa * d)
+        c = _avoid_zero(1 + aa / c)
+        h = h * d * c
+        # Odd step of the recurrence.
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1 / _avoid_zero(1 + aa * d)
+        c = _avoid_zero(1 + aa / c)
+        delta = d * c
+        h = h * delta
+        converged = abs(delta - 1) < _CF_EPS
+        if converged is True or (converged is not False and converged.all()):
+            break
+    return h
+
+
+def _log_betainc(a, b, x, log_beta):
+    """ Computes regularized incomplete Beta function I_x(a, b) in log space.
+    Returns a tuple (direct, log_val): where direct is True log_val is
+    log(I_x(a, b)), elsewhere log_val is log(1 - I_x(a, b)). This way
+    neither of values underflows for large a and b.
+    """
+    log_front = a * np.log(x) + b * np.log1p(-x) - log_beta
+    # The continued fraction converges fast for x < (a + 1) / (a + b + 2),
+    # otherwise we use the symmetry I_x(a, b) = 1 - I_{1-x}(b, a).
+    direct = x < (a + 1) / (a + b + 2)
+    cf_a = np.where(direct, a, b)
+    cf_b = np.where(direct, b, a)
+    cf_x = np.where(direct, x, 1 - x)
+    log_val = (log_front - np.log(cf_a) +
+               np.log(_beta_cont_frac(cf_a, cf_b, cf_x)))
+    return direct, log_val
+
+
+def _percentile_beta_scalar(a, b, q, tol):
+    """ Scalar version of the solver in compute_percentile_beta(), it solves
+    I_x(a, b) = q using floats, which is much faster for a single value."""
+    log_q, log_1_q = math.log(q), math.log1p(-q)
+    log_beta = math.lgamma(a) + math.lgamma(b) - math.lgamma(a + b)
+    lo, hi = 0.0, 1.0
+    # Starts from the mean of the distribution.
+    x = a / (a + b)
+    for i in xrange(_SOLVER_MAX_ITER):
+        log_x, log_1_x = math.log(x), math.log1p(-x)
+        log_front = a * log_x + b * log_1_x - log_beta
+        if x < (a + 1) / (a + b + 2):
+            log_val = (log_front - math.log(a) +
+                       math.log(_beta_cont_frac(a, b, x)))
+            below = log_val < log_q
+            cdf = math.exp(log_val)
+        else:
+            log_val = (log_front - math.log(b) +
+                       math.log(_beta_cont_frac(b, a, 1 - x)))
+            below = log_val > log_1_q
+            cdf = -math.expm1(log_val)
+        if below:
+            lo = x
+        else:
+            hi = x
+        # Newton's step, bisection if the step leaves the bracket.
+        log_pdf = (a - 1) * log_x + (b - 1) * log_1_x - log_beta
+        try:
+            x_new = x - (cdf - q) / math.exp(log_pdf)
+        except (OverflowError, ZeroDivisionError):
+            x_new = lo
+        bisect = not lo < x_new < hi
+        if bisect:
+            x_new = (lo + hi) / 2
+        done = (abs(x_new - x) < tol and not bisect) or hi - lo < tol
+        x = x_new
+        if done:
+            break
+    return x
+
+
+def compute_percentile_beta(neg, pos, percentile, tol=PERCENTILE_TOLERANCE):
+    """ Computes the same percentile as compute_percentile_dirichlet(), but
+    by solving I_x(pos + 1, |neg| + 1) = 1 - percentile for x, where I_x is
+    the regularized incomplete Beta function. Everything is computed in log
+    space, so large neg and pos do not underflow.
+    neg and pos are numbers or arrays of the same shape. Newton's method is
+    used and bisection is a fallback when a Newton step leaves the bracket
+    of the solution. The error of the result is below tol; usually it takes
+    less than ten iterations.
+    """
+    q = 1 - percentile
+    if np.isscalar(neg) and np.isscalar(pos):
+        return _percentile_beta_scalar(float(pos) + 1, abs(float(neg)) + 1,
+                                       q, tol)
+    neg = np.asarray(neg, dtype=np.float64)
+    pos = np.asarray(pos, dtype=np.float64)
+    a = pos.ravel() + 1
+    b = np.abs(neg.ravel()) + 1
+    log_q, log_1_q = np.log(q), np.log1p(-q)
+    log_beta = _log_beta(a, b)
+    lo = np.zeros_like(a)
+    hi = np.ones_like(a)
+    # Starts from the mean of the distribution.
+    x = a / (a + b)
+    # Indices of values which are not computed yet.
+    active = np.arange(len(a))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore',
+                     under='ignore'):
+        for i in xrange(_SOLVER_MAX_ITER):
+            if len(active) == 0:
+                break
+            a_act, b_act, x_act = a[active], b[active], x[active]
+            lo_act, hi_act = lo[active], hi[active]
+            direct, log_val = _log_betainc(a_act, b_act, x_act,
+                                           log_beta[active])
+            # Updates the bracket.
+            below = np.where(direct, log_val < log_q, log_val > log_1_q)
+            lo_act = np.where(below, x_act, lo_act)
+            hi_act = np.where(below, hi_act, x_act)
+            # Newton's step.
+            cdf = np.where(direct, np.exp(log_val), -np.expm1(log_val))
+            log_pdf = ((a_act - 1) * np.log(x_act) +
+                       (b_act - 1) * np.log1p(-x_act) - log_beta[active])
+            x_new = x_act - (cdf - q) / np.exp(log_pdf)
+            # Bisection if the step leaves the bracket.
+            bisect = ~((x_new > lo_act) & (x_new < hi_act))
+            x_new = np.where(bisect, (lo_act + hi_act) / 2, x_new)
+            done = (((np.abs(x_new - x_act) < tol) & ~bisect) |
+                    (hi_act - lo_act < tol))
+            x[active] = x_new
+            lo[active] = lo_act
+            hi[active] = hi_act
+            active = active[~done]
+    return x.reshape(neg.shape)
+
 
 def compute_percentile_dirichlet(neg, pos, percentile):
     """ Numerically computes percentile of Dirichlet distribution.
     Percentile is between 0 and 1.
+    If USE_BETA_SOLVER is True then compute_percentile_beta() is used,
+    otherwise the percentile is computed by integration on the grid, the
+    result is then about 0.00015 less than the exact value.
     """
+    if USE_BETA_SOLVER:
+        return compute_percentile_beta(neg, pos, percentile)
     # alpha is a number of "Truth"
     # beta is a number of "False"
     alpha, beta = pos, abs(neg)
     # Sanity check for testing purposes.
     if alpha > 1000000 or beta > 1000000:
         raise Exception("Alpha or Beta is too big!!!")
-    # First, numerically compute unnormalised probability mass function.
-    delta = 0.0001
-    x = np.arange(0 + delta, 1, delta)
-    y = x ** (alpha) * (1 - x) ** (beta)
-    # Integral approximation based on trapezoidal rule.
-    y1 = y[:-1]
-    y2 = y[1:]
-    integral_vec = (y2 + y1) / 2 * delta
-    integral = np.sum(integral_vec)
-    cumsum = np.cumsum(integral_vec)
-    threshold = (1 - percentile) * integral
-    idx = cumsum.searchsorted(threshold)
-    val = idx * delta
-    return val
+    val = _percentile_on_grid(np.array([alpha], dtype=np.float64),
+                              np.array([beta], dtype=np.float64), percentile)
+    return val[0]
+
+
+def compute_percentile_dirichlet_array(neg, pos, percentile,
+                                       chunk_size=PERCENTILE_CHUNK_SIZE):
+    """ Array version of compute_percentile_dirichlet().
+    neg and pos are arrays of the same shape, the function returns an array
+    of percentiles of this shape. Every distinct (neg, pos) pair is computed
+    once. On the grid pairs are processed in chunks of chunk_size to bound
+    memory usage.
+    """
+    neg = np.asarray(neg, dtype=np.float64)
+    pos = np.asarray(pos, dtype=np.float64)
+    if neg.size == 0:
+        return np.zeros(neg.shape)
+    pairs = np.column_stack((neg.ravel(), pos.ravel()))
+    uniq, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    if USE_BETA_SOLVER:
+        vals = compute_percentile_beta(uniq[:, 0], uniq[:, 1], percentile)
+        return vals[inverse].reshape(neg.shape)
+    uniq[:, 0] = np.abs(uniq[:, 0])
+    # Sanity check for testing purposes.
+    if uniq.max() > 1000000:
+        raise Exception("Alpha or Beta is too big!!!")
+    vals = np.empty(len(uniq))
+    for start in xrange(0, len(uniq), chunk_size):
+        end = start + chunk_size
+        vals[start:end] = _percentile_on_grid(uniq[start:end, 1],
+                                              uniq[start:end, 0], percentile)
+    return vals[inverse].reshape(neg.shape)
+
+
+class PercentileTable(object):
+    """ Percentiles of the Dirichlet distribution on a regular grid.
+
+    values[i, j] is a percentile for neg = -i * step and pos = j * step, the
+    grid covers |neg| and pos from 0 to max_count. Values between grid
+    points are computed by bilinear interpolation, error is the maximum
+    interpolation error measured at centers of the grid cells when the table
+    was built. It is an empirical estimate, not a bound: the error at other
+    points of a cell can be larger.
+    """
+
+    def __init__(self, values, step, percentile, error):
+        self.values = values
+        self.step = step
+        self.percentile = percentile
+        self.error = error
+        self.max_count = step * (values.shape[0] - 1)
+
+    def __repr__(self):
+        return '<PercentileTable max_count %s, step %s, error %s>' % (
+                                        self.max_count, self.step, self.error)
+
+    def covers(self, neg, pos, percentile):
+        """ Returns True if the table can be used for (neg, pos) pair."""
+        return (percentile == self.percentile and
+                abs(neg) <= self.max_count and 0 <= pos <= self.max_count)
+
+    def covers_array(self, neg, pos, percentile):
+        """ Returns a boolean mask of pairs which can be looked up."""
+        if percentile != self.percentile:
+            return np.zeros(neg.shape, dtype=bool)
+        return ((np.abs(neg) <= self.max_count) & (pos >= 0) &
+                (pos <= self.max_count))
+
+    def lookup(self, neg, pos):
+        """ Interpolates the percentile for neg and pos, they are numbers or
+        arrays covered by the table."""
+        if np.isscalar(neg) and np.isscalar(pos):
+            return self._lookup_scalar(neg, pos)
+        i = np.abs(neg) / self.step
+        j = np.asarray(pos) / self.step
+        # Indices of the lower left corner of the cell.
+        n = self.values.shape[0] - 1
+        i0 = np.minimum(np.floor(i), n - 1).astype(np.int64)
+        j0 = np.minimum(np.floor(j), n - 1).astype(np.int64)
+        fi = i - i0
+        fj = j - j0
+        v = self.values
+        return (v[i0, j0] * (1 - fi) * (1 - fj) + v[i0 + 1, j0] * fi * (1 - fj) +
+                v[i0, j0 + 1] * (1 - fi) * fj + v[i0 + 1, j0 + 1] * fi * fj)
+
+    def _lookup_scalar(self, neg, pos):
+        i = abs(neg) / self.step
+        j = pos / self.step
+        n = self.values.shape[0] - 1
+        i0 = min(int(i), n - 1)
+        j0 = min(int(j), n - 1)
+        fi = i - i0
+        fj = j - j0
+        v = self.values
+        return float(v[i0, j0] * (1 - fi) * (1 - fj) +
+                     v[i0 + 1, j0] * fi * (1 - fj) +
+                     v[i0, j0 + 1] * (1 - fi) * fj +
+                     v[i0 + 1, j0 + 1] * fi * fj)
+
+
+def build_percentile_table(file_path, max_count=PERCENTILE_TABLE_MAX_COUNT,
+                           step=PERCENTILE_TABLE_STEP, percentile=PERCENTILE):
+    """ Computes percentiles on a grid and saves them into .npy file which
+    can be loaded by load_percentile_table(). The first row of the file
+    contains step, percentile and the measured interpolation error of the
+    table (see PercentileTable), the rest of the file is the grid of
+    percentiles.
+    Returns the PercentileTable.
+    """
+    if step <= 0 or max_count < 2 * step:
+        raise Exception("The table should have step > 0 and "
+                        "max_count >= 2 * step!")
+    n = int(round(max_count / float(step)))
+    counts = np.arange(n + 1) * step
+    neg, pos = np.meshgrid(-counts, counts, indexing='ij')
+    values = compute_percentile_dirichlet_array(neg, pos, percentile)
+    table = PercentileTable(values, step, percentile, 0)
+    # Measures interpolation error at centers of the cells.
+    centers = (np.arange(n) + 0.5) * step
+    neg, pos = np.meshgrid(-centers, centers, indexing='ij')
+    exact = compute_percentile_dirichlet_array(neg, pos, percentile)
+    table.error = float(np.max(np.abs(table.lookup(neg, pos) - exact)))
+    data = np.zeros((n + 2, n + 1))
+    data[0, :3] = step, percentile, table.error
+    data[1:] = values
+    np.save(file_path, data)
+    return table
+
+
+def load_percentile_table(file_path):
+    """ Loads a table built by build_percentile_table(), the file is memory
+    mapped, so processes which load the same file share its pages.
+    After the call get_reliability(), get_item_weight() and their array
+    versions use the table for pairs it covers and compute exact values
+    otherwise. Returns the PercentileTable.
+    """
+    global _percentile_table
+    data = np.load(file_path, mmap_mode='r')
+    step, percentile, error = data[0, :3]
+    _percentile_table = PercentileTable(data[1:], float(step),
+                                        float(percentile), float(error))
+    return _percentile_table
+
+
+def unload_percentile_table():
+    global _percentile_table
+    _percentile_table = None
+
+
+def _lookup_percentile(neg, pos, percentile):
+    """ Returns percentile from the loaded table if it covers the (neg, pos)
+    pair, otherwise computes it."""
+    table = _percentile_table
+    if table is not None and table.covers(neg, pos, percentile):
+        return table.lookup(neg, pos)
+    return compute_percentile_dirichlet(neg, pos, percentile)
+
+
+def _lookup_percentile_array(neg, pos, percentile):
+    """ Array version of _lookup_percentile()."""
+    table = _percentile_table
+    if table is None:
+        return compute_percentile_dirichlet_array(neg, pos, percentile)
+    neg = np.asarray(neg, dtype=np.float64)
+    pos = np.asarray(pos, dtype=np.float64)
+    covered = table.covers_array(neg, pos, percentile)
+    vals = np.empty(neg.shape)
+    vals[covered] = table.lookup(neg[covered], pos[covered])
+    vals[~covered] = compute_percentile_dirichlet_array(neg[~covered],
+                                                    pos[~covered], percentile)
+    return vals
+
+
+def _get_mid_point(perc):
+    """ Returns percentile of the (0, 0) case, the value is computed once."""
+    key = (perc, USE_BETA_SOLVER)
+    mid_point = _mid_point_cache.get(key)
+    if mid_point is None:
+        mid_point = compute_percentile_dirichlet(0, 0, perc)
+        _mid_point_cache[key] = mid_point
+    return mid_point
 
 
 def get_reliability(u_n, u_p):
-    perc = 0.8
+    perc = PERCENTILE
     # todo(michael): mid_point determines what is default attitude towards
     # a user. If it is 0 then we treat user with no feedback positively.
     # If we compute mod_point as percentile of 0,0 case, then user would
@@ -45,16 +426,34 @@ def get_reliability(u_n, u_p):
 
     #mid_point = compute_percentile_dirichlet(0, 0, perc)
     mid_point = 0
-    val = compute_percentile_dirichlet(u_n, u_p, perc)
+    val = _lookup_percentile(u_n, u_p, perc)
     val = max(0, val - mid_point)
     val = (val / (1 - mid_point)) ** 2
     return val
 
 
 def get_item_weight(c_n, c_p):
-    perc = 0.8
-    mid_point = compute_percentile_dirichlet(0, 0, perc)
-    val = compute_percentile_dirichlet(c_n, c_p, perc)
+    perc = PERCENTILE
+    mid_point = _get_mid_point(perc)
+    val = _lookup_percentile(c_n, c_p, perc)
+    return val - mid_point
+
+
+def get_reliability_array(u_n, u_p):
+    """ Array version of get_reliability()."""
+    perc = PERCENTILE
+    mid_point = 0
+    val = _lookup_percentile_array(u_n, u_p, perc)
+    val = np.maximum(0, val - mid_point)
+    val = (val / (1 - mid_point)) ** 2
+    return val
+
+
+def get_item_weight_array(c_n, c_p):
+    """ Array version of get_item_weight()."""
+    perc = PERCENTILE
+    mid_point = _get_mid_point(perc)
+    val = _lookup_percentile_array(c_n, c_p, perc)
     return val - mid_point
 
 
@@ -84,6 +483,9 @@ class Item(object):
         # c_n is a sum of negative signals sent towards the item
         self.c_n = 0
         self.weight = 0
+        # Weight from a previous run of the algorithm, it is used for
+        # warm start (None if it is unknown).
+        self.warm_weight = None
         # A list of messages from users.
         self.msgs = []
 
@@ -100,6 +502,10 @@ class User(object):
         self.u_n = base_u_n
         self.u_p = base_u_p
         self.reliability = get_reliability(base_u_n, base_u_p)
+        # u_n and u_p from a previous run of the algorithm, they are used for
+        # warm start (None if they are unknown).
+        self.warm_u_n = None
+        self.warm_u_p = None
         # answers is a dictionary of user's flags/votes: it maps item id to
         # answer A by the user.
         # In terms of spam/ham: if A is positive then the item is ham and if A
@@ -144,6 +550,10 @@ class Graph(object):
         self.user_dict = {}
         # normalization is to normalize user's reliability.
         self.normaliz = 1
+        # Number of iterations made by compute_answers() and the residual
+        # after the last iteration (it is computed only if tolerance is given).
+        self.n_iterations = 0
+        self.residual = None
 
     def __repr__(self):
         s = 'Graph \n'
@@ -157,18 +567,25 @@ class Graph(object):
                                                                u.answers[it_id])
         return s
 
-    def add_answer(self, user_id, item_id, answer, base_u_n=0, base_u_p=0):
+    def add_answer(self, user_id, item_id, answer, base_u_n=0, base_u_p=0,
+                   warm_u_n=None, warm_u_p=None, warm_weight=None):
         """ Method adds answer to dictionary user.answers. If user or item
         with give ids does not exist then the method creates it.
+        warm_u_n, warm_u_p and warm_weight are the user's u_n, u_p and the
+        item's weight from a previous run, they are used for warm start.
         """
         u = self.user_dict.get(user_id)
         if not u:
             u = User(user_id, base_u_n, base_u_p)
+            if warm_u_n is not None and warm_u_p is not None:
+                u.warm_u_n = warm_u_n
+                u.warm_u_p = warm_u_p
             self.users.append(u)
             self.user_dict[user_id] = u
         it = self.item_dict.get(item_id)
         if not it:
             it = Item(item_id)
+            it.warm_weight = warm_weight
             self.items.append(it)
             self.item_dict[item_id] = it
         # Adds answer
@@ -259,20 +676,58 @@ class Graph(object):
             it.weight = get_item_weight(it.c_n, it.c_p)
 
 
-    def compute_answers(self, k_max):
+    def _get_state(self):
+        """ Returns an array of items' c_n and c_p and users' reliabilities,
+        they are known after every iteration, so measuring convergence does
+        not need percentiles of items' weights."""
+        return np.array([it.c_n for it in self.items] +
+                        [it.c_p for it in self.items] +
+                        [u.reliability for u in self.users], dtype=np.float64)
+
+    def _apply_warm_start(self):
+        """ Sets u_n, u_p, reliabilities and weights from a previous run and
+        returns a dictionary which maps user id to the factor of the user's
+        initial messages."""
+        factors = {}
+        for u in self.users:
+            if u.warm_u_n is not None:
+                u.u_n = u.warm_u_n
+                u.u_p = u.warm_u_p
+                u.reliability = get_reliability(u.u_n, u.u_p)
+                factors[u.id] = u.reliability
+        for it in self.items:
+            if it.warm_weight is not None:
+                it.weight = it.warm_weight
+        return factors
+
+    def compute_answers(self, k_max, tol=None, norm=RESIDUAL_NORM_MAX,
+                        warm_start=False):
+        """ Runs at most k_max iterations of the algorithm. If tol is given
+        then iterations stop when the residual of items' c_n and c_p and
+        users' reliabilities between two iterations is less than tol.
+        If warm_start is True then initial messages from users with known
+        warm_u_n and warm_u_p are their answers multiplied by the reliability
+        from the previous run.
+        """
+        self.n_iterations = 0
+        self.residual = None
+        factors = self._apply_warm_start() if warm_start else {}
         # Sends the initial messages from users to items.
         for it in self.items:
             it.msgs = []
         for u in self.users:
+            factor = factors.get(u.id, 1)
             for it_id in u.answers.iterkeys():
                 it = self.item_dict[it_id]
-                msg = Message_to_item(u.id, u.answers[it_id])
+                msg = Message_to_item(u.id, u.answers[it_id] * factor)
                 it.msgs.append(msg)
         # Runs main iterations.
         if DEBUG:
             for it in self.items:
                 for msg in it.msgs:
                     print msg
+        if tol is not None:
+            state = self._get_state()
         for i in xrange(k_max):
             if DEBUG:
                 print ''
@@ -287,5 +742,106 @@ class Graph(object):
                 for it in self.items:
                     for msg in it.msgs:
                         print msg
+            self.n_iterations = i + 1
+            if tol is not None:
+                new_state = self._get_state()
+                self.residual = compute_residual(state, new_state, norm)
+                state = new_state
+                if self.residual < tol:
+                    break
         # Aggregating item information.
         self._aggregate_items()
+
+
+class ArrayGraph(Graph):
+    """ Array-backed version of the Graph.
+
+    Users, items and answers are added exactly as in the Graph, but
+    compute_answers() keeps c_n/c_p of items and u_n/u_p of users as float
+    arrays over the list of edges (user index, item index, answer) and
+    computes leave-one-out values and reliabilities with whole-array
+    operations instead of creating message objects. After the computation
+    c_n, c_p and weight of items and u_n, u_p and reliability of users are
+    set to the same values the Graph produces.
+    """
+
+    def _build_edge_arrays(self):
+        """ Returns arrays of user indices, item indices and answers."""
+        item_idx = dict((it.id, i) for i, it in enumerate(self.items))
+        n_edges = sum(len(u.answers) for u in self.users)
+        e_user = np.empty(n_edges, dtype=np.int64)
+        e_item = np.empty(n_edges, dtype=np.int64)
+        e_answr = np.empty(n_edges, dtype=np.float64)
+        k = 0
+        for i, u in enumerate(self.users):
+            for it_id, answr in u.answers.iteritems():
+                e_user[k] = i
+                e_item[k] = item_idx[it_id]
+                e_answr[k] = answr
+                k += 1
+        return e_user, e_item, e_answr
+
+    def compute_answers(self, k_max, tol=None, norm=RESIDUAL_NORM_MAX,
+                        warm_start=False):
+        self.n_iterations = 0
+        self.residual = None
+        factors = self._apply_warm_start() if warm_start else {}
+        n_users = len(self.users)
+        n_items = len(self.items)
+        e_user, e_item, e_answr = self._build_edge_arrays()
+        e_sign = np.sign(e_answr)
+        base_u_n = np.array([u.base_u_n for u in self.users], dtype=np.float64)
+        base_u_p = np.array([u.base_u_p for u in self.users], dtype=np.float64)
+        u_n = np.array([u.u_n for u in self.users], dtype=np.float64)
+        u_p = np.array([u.u_p for u in self.users], dtype=np.float64)
+        reliab = np.array([u.reliability for u in self.users], dtype=np.float64)
+        # Messages from users to items; initially users send their answers.
+        factor = np.array([factors.get(u.id, 1) for u in self.users],
+                          dtype=np.float64)
+        msg_to_item = e_answr * factor[e_user]
+        if tol is not None:
+            state = self._get_state()
+        for i in xrange(k_max):
+            # Propagation from items: sums of negative and positive signals
+            # and leave-one-out values for every edge.
+            msg_n = np.minimum(msg_to_item, 0)
+            msg_p = np.maximum(msg_to_item, 0)
+            c_n = np.bincount(e_item, weights=msg_n, minlength=n_items)
+            c_p = np.bincount(e_item, weights=msg_p, minlength=n_items)
+            msg_c_n = c_n[e_item] - msg_n
+            msg_c_p = c_p[e_item] - msg_p
+            # Propagation from users. A message value multiplied by the sign
+            # of the answer goes to u_n if it is negative and to u_p
+            # otherwise (see neg_first()).
+            positive = e_sign > 0
+            val_n = np.where(positive, msg_c_n * e_sign, msg_c_p * e_sign)
+            val_p = np.where(positive, msg_c_p * e_sign, msg_c_n * e_sign)
+            u_n = base_u_n + np.bincount(e_user, weights=val_n,
+                                         minlength=n_users)
+            u_p = base_u_p + np.bincount(e_user, weights=val_p,
+                                         minlength=n_users)
+            reliab = get_reliability_array(u_n, u_p)
+            msg_reliab = get_reliability_array(u_n[e_user] - val_n,
+                                               u_p[e_user] - val_p)
+            msg_to_item = e_answr * msg_reliab
+            self.n_iterations = i + 1
+            if tol is not None:
+                new_state = np.concatenate((c_n, c_p, reliab))
+                self.residual = compute_residual(state, new_state, norm)
+                state = new_state
+                if self.residual < tol:
+                    break
+        # Aggregating item information.
+        val = e_answr * reliab[e_user]
+        c_n = np.bincount(e_item, weights=np.minimum(val, 0), minlength=n_items)
+        c_p = np.bincount(e_item, weights=np.maximum(val, 0), minlength=n_items)
+        weight = get_item_weight_array(c_n, c_p)
+        # Writes results back to users and items.
+        for i, u in enumerate(self.users):
+            u.u_n = float(u_n[i])
+            u.u_p = float(u_p[i])
+            u.reliability = float(reliab[i])
+        for i, it in enumerate(self.items):
+            it.c_n = float(c_n[i])
+            it.c_p = float(c_p[i])
+            it.weight = float(weight[i])
@@ -1,5 +1,7 @@
 # Implementation of Karger's algorithm with some modifications.
 import numpy as np
+import graph_pool as gp
+from graph_pool import compute_residual, RESIDUAL_NORM_MAX, RESIDUAL_NORM_L2
 
 USE_ASYMPTOTIC_FUNC = True
 DEBUG = False 
@@ -16,6 +18,9 @@ class Item(object):
         # where A_ij is vote/flag of user j to annotation i, y_ji is reliability
         # of user j
         self.weight = 0
+        # Weight from a previous run of the algorithm, it is used for
+        # warm start (None if it is unknown).
+        self.warm_weight = None
         # A list of messages from users.
         self.msgs = []
 
@@ -38,6 +43,9 @@ class User(object):
         # Raw reliability is user's reliability before applying asymptotic
         # function or normalization. We need it to perform online update.
         self.reliability_raw = 0
+        # Reliability from a previous run of the algorithm, it is used for
+        # warm start (None if it is unknown).
+        self.warm_reliability = None
         # answers is a dictionary of user's flags/votes: it maps item id to
         # answer A by the user.
         # In terms of spam/ham: if A is positive then the item is ham and if A
@@ -94,6 +102,13 @@ class Graph(object):
         self.user_dict = {}
         # normalization is to normalize user's reliability.
         self.normaliz = 1
+        # If fixed_normaliz is not None then it is used as normalization
+        # instead of computing it on every iteration.
+        self.fixed_normaliz = None
+        # Number of iterations made by compute_answers() and the residual
+        # after the last iteration (it is computed only if tolerance is given).
+        self.n_iterations = 0
+        self.residual = None
 
     def __repr__(self):
         s = 'Graph \n'
@@ -120,19 +135,24 @@ class Graph(object):
             g.item_dict[it.id] = it
         return g
 
-    def add_answer(self, user_id, item_id, answer, base_reliability=0):
+    def add_answer(self, user_id, item_id, answer, base_reliability=0,
+                   warm_reliability=None, warm_weight=None):
         """ Method adds answer to dictionary user.answers. If user or item
         with give ids does not exist then the method creates it.
+        warm_reliability and warm_weight are the user's reliability and the
+        item's weight from a previous run, they are used for warm start.
         """
         u = self.user_dict.get(user_id)
         if not u:
             u = User(user_id)
             u.base_reliability = base_reliability
+            u.warm_reliability = warm_reliability
             self.users.append(u)
             self.user_dict[user_id] = u
         it = self.item_dict.get(item_id)
         if not it:
             it = Item(item_id)
+            it.warm_weight = warm_weight
             self.items.append(it)
             self.item_dict[item_id] = it
         # Adds answer
@@ -171,7 +191,10 @@ class Graph(object):
                     val = asympt_func(val)
                 reliab_list.append(val)
         # Computes normalization coefficient
-        self.normaliz = compute_normaliz(reliab_list)
+        if self.fixed_normaliz is None:
+            self.normaliz = compute_normaliz(reliab_list)
+        else:
+            self.normaliz = self.fixed_normaliz
         # Okay, now we send messages to items and compute user reliability
         for u in self.users:
             if len(u.msgs) < 2:
@@ -234,15 +257,52 @@ class Graph(object):
                 it.weight += u.reliability * answr
 
 
-    def compute_answers(self, k_max):
+    def _get_state(self):
+        """ Returns an array of items' weights and users' reliabilities."""
+        return np.array([it.weight for it in self.items] +
+                        [u.reliability for u in self.users], dtype=np.float64)
+
+    def _apply_warm_start(self):
+        """ Sets reliabilities and weights from a previous run and returns
+        a dictionary which maps user id to the factor of the user's initial
+        messages."""
+        factors = {}
+        for u in self.users:
+            if u.warm_reliability is not None:
+                u.reliability = u.warm_reliability
+                factors[u.id] = u.warm_reliability
+        for it in self.items:
+            if it.warm_weight is not None:
+                it.weight = it.warm_weight
+        return factors
+
+    def compute_answers(self, k_max, tol=None, norm=RESIDUAL_NORM_MAX,
+                        warm_start=False, normaliz=None):
+        """ Runs at most k_max iterations of the algorithm. If tol is given
+        then iterations stop when the residual of items' weights and users'
+        reliabilities between two iterations is less than tol.
+        If warm_start is True then initial messages from users with known
+        warm_reliability are their answers multiplied by the reliability,
+        i.e. the algorithm starts close to the result of a previous run.
+        If normaliz is given then it is used as normalization coefficient
+        instead of computing it from the graph (for instance, when the graph
+        is only a part of the whole graph).
+        """
+        self.fixed_normaliz = normaliz
+        if normaliz is not None:
+            self.normaliz = normaliz
+        self.n_iterations = 0
+        self.residual = None
+        factors = self._apply_warm_start() if warm_start else {}
         # Sends the initial messages from users to items.
         for it in self.items:
             it.msgs = []
         for u in self.users:
+            factor = factors.get(u.id, 1)
             for it_id in u.answers.iterkeys():
                 it = self.item_dict[it_id]
                 # todo(michael): is it necessary to randomize initial y's?
-                it.msgs.append(Msg(u.id, u.answers[it_id]))# * np.random.normal(1,1)))
+                it.msgs.append(Msg(u.id, u.answers[it_id] * factor))# * np.random.normal(1,1)))
         if DEBUG:
             print ""
             print "messages from users"
@@ -252,6 +312,8 @@ class Graph(object):
                                     (msg.source_id, it.id, msg.value))
         # Runs main iterations.
         for i in xrange(k_max):
+            if tol is not None:
+                state = self._get_state()
             self._propagate_from_items()
             if DEBUG:
                 print ""
@@ -268,5 +330,178 @@ class Graph(object):
                     for msg in it.msgs:
                         print ('user id=%s -> item id=%s, value=%s' %
                                         (msg.source_id, it.id, msg.value))
+            self.n_iterations = i + 1
+            if tol is not None:
+                self.residual = compute_residual(state, self._get_state(),
+                                                 norm)
+                if self.residual < tol:
+                    break
         # Aggregating item information.
         self._aggregate_items()
+
+
+class ArrayGraph(Graph):
+    """ Array-backed version of the Graph.
+
+    Users, items and answers are added exactly as in the Graph, but
+    compute_answers() keeps messages in NumPy arrays over the list of edges
+    (user index, item index, answer) and computes per-node sums with
+    np.bincount instead of creating Msg objects. After the computation
+    weight, reliability and reliability_raw of User/Item objects and
+    normaliz of the graph are set to the same values the Graph produces.
+    """
+
+    def _build_edge_arrays(self):
+        """ Returns arrays of user indices, item indices and answers."""
+        item_idx = dict((it.id, i) for i, it in enumerate(self.items))
+        n_edges = sum(len(u.answers) for u in self.users)
+        e_user = np.empty(n_edges, dtype=np.int64)
+        e_item = np.empty(n_edges, dtype=np.int64)
+        e_answr = np.empty(n_edges, dtype=np.float64)
+        k = 0
+        for i, u in enumerate(self.users):
+            for it_id, answr in u.answers.iteritems():
+                e_user[k] = i
+                e_item[k] = item_idx[it_id]
+                e_answr[k] = answr
+                k += 1
+        return e_user, e_item, e_answr
+
+    def compute_answers(self, k_max, tol=None, norm=RESIDUAL_NORM_MAX,
+                        warm_start=False, normaliz=None):
+        self.fixed_normaliz = normaliz
+        if normaliz is not None:
+            self.normaliz = normaliz
+        self.n_iterations = 0
+        self.residual = None
+        self._start(warm_start, tol is not None)
+        for i in xrange(k_max):
+            values = self._propagate()
+            if self.fixed_normaliz is None:
+                self.normaliz = compute_normaliz(values)
+            residual = self._send(self.normaliz, norm)
+            self.n_iterations = i + 1
+            if tol is not None:
+                self.residual = residual
+                if self.residual < tol:
+                    break
+        self._finish()
+
+    # compute_answers() is split into steps, so that parts of a graph can be
+    # computed in lock-step with a common normalization (see
+    # compute_answers_in_pool()).
+
+    def _start(self, warm_start, track_residual):
+        """ Builds arrays and sends the initial messages from users."""
+        factors = self._apply_warm_start() if warm_start else {}
+        self._track_residual = track_residual
+        self._e_user, self._e_item, self._e_answr = self._build_edge_arrays()
+        self._base = np.array([u.base_reliability for u in self.users],
+                              dtype=np.float64)
+        self._item_weight = np.array([it.weight for it in self.items],
+                                     dtype=np.float64)
+        self._reliab = np.array([u.reliability for u in self.users],
+                                dtype=np.float64)
+        self._reliab_raw = np.array([u.reliability_raw for u in self.users],
+                                    dtype=np.float64)
+        # Messages from users to items; initially all users send their answers.
+        factor = np.array([factors.get(u.id, 1) for u in self.users],
+                          dtype=np.float64)
+        self._msg_to_item = self._e_answr * factor[self._e_user]
+        self._has_msg_to_item = np.ones(len(self._e_answr), dtype=bool)
+
+    def _propagate(self):
+        """ Makes the first half of an iteration: propagation from items and
+        unnormalized messages of users. Returns values which the
+        normalization is computed from."""
+        e_user, e_item, e_answr = self._e_user, self._e_item, self._e_answr
+        n_users = len(self.users)
+        n_items = len(self.items)
+        if self._track_residual:
+            self._state = np.concatenate((self._item_weight, self._reliab))
+        # Propagation from items. Items with less than two messages
+        # do not send anything.
+        n_msgs = np.bincount(e_item, weights=self._has_msg_to_item,
+                             minlength=n_items)
+        active_items = n_msgs >= 2
+        sums = np.bincount(e_item,
+                           weights=self._msg_to_item * self._has_msg_to_item,
+                           minlength=n_items)
+        self._item_weight[active_items] = sums[active_items]
+        has_msg_to_user = active_items[e_item]
+        msg_to_user = np.where(has_msg_to_user,
+                    (self._item_weight[e_item] - self._msg_to_item) * e_answr,
+                    0)
+        # Propagation from users. Users with less than two messages get
+        # default reliability and do not send anything.
+        n_msgs = np.bincount(e_user, weights=has_msg_to_user,
+                             minlength=n_users)
+        active_users = n_msgs >= 2
+        reliab_raw = self._base + np.bincount(e_user, weights=msg_to_user,
+                                              minlength=n_users)
+        reliab_raw[~active_users] = DEFAULT_RELIABILITY
+        self._reliab_raw = reliab_raw
+        self._has_msg_to_item = has_msg_to_user & active_users[e_user]
+        val = reliab_raw[e_user] - msg_to_user
+        val_reliab = reliab_raw[active_users]
+        if USE_ASYMPTOTIC_FUNC:
+            val = asympt_func(val)
+            val_reliab = asympt_func(val_reliab)
+        self._val = val
+        self._val_reliab = val_reliab
+        self._active_users = active_users
+        return val[self._has_msg_to_item]
+
+    def _send(self, normaliz, norm=RESIDUAL_NORM_MAX):
+        """ Makes the second half of an iteration: normalized messages to
+        items and users' reliabilities. Returns the residual of the iteration
+        if it is tracked."""
+        self._msg_to_item = np.where(self._has_msg_to_item,
+                                     self._val / normaliz * self._e_answr, 0)
+        self._reliab[~self._active_users] = DEFAULT_RELIABILITY
+        self._reliab[self._active_users] = self._val_reliab / normaliz
+        if not self._track_residual:
+            return None
+        return compute_residual(self._state,
+                    np.concatenate((self._item_weight, self._reliab)), norm)
+
+    def _finish(self):
+        """ Aggregates items' weights and writes results back to users and
+        items."""
+        e_user, e_item, e_answr = self._e_user, self._e_item, self._e_answr
+        item_weight = np.bincount(e_item,
+                weights=(self._msg_to_item * self._has_msg_to_item +
+                         self._reliab[e_user] * e_answr),
+                minlength=len(self.items))
+        for i, u in enumerate(self.users):
+            u.reliability = float(self._reliab[i])
+            u.reliability_raw = float(self._reliab_raw[i])
+        for i, it in enumerate(self.items):
+            it.weight = float(item_weight[i])
+        for name in ('_e_user', '_e_item', '_e_answr', '_base', '_item_weight',
+                     '_reliab', '_reliab_raw', '_msg_to_item',
+                     '_has_msg_to_item', '_state', '_val', '_val_reliab',
+                     '_active_users'):
+            self.__dict__.pop(name, None)
+
+
+def compute_answers_in_pool(graph, k_max, n_processes, normaliz=None,
+                            **kwargs):
+    """ Runs compute_answers() on connected components of Karger's graph in
+    n_processes worker processes (see gp.compute_answers_in_pool()).
+    kwargs are passed to compute_answers() (tol, norm, warm_start).
+
+    Messages never cross component boundaries, the only global values are
+    the normalization and the residual, which are computed over the whole
+    graph on every iteration. If normaliz is None then parts are computed in
+    lock-step as ArrayGraph objects and the result is the same as the result
+    of compute_answers() on the whole graph. If normaliz is given then it is
+    used as fixed normalization and parts are computed independently.
+    """
+    if normaliz is None:
+        gp.compute_answers_in_pool(graph, k_max, n_processes,
+                                   lockstep_cls=ArrayGraph, **kwargs)
+    else:
+        gp.compute_answers_in_pool(graph, k_max, n_processes,
+                                   normaliz=normaliz, **kwargs)
+        graph.normaliz = normaliz
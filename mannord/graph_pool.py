@@ -0,0 +1,273 @@
+# Algorithm-agnostic helpers of iterative graph algorithms (Karger's
+# algorithm in graph_k and Dirichlet algorithm in graph_d): the residual
+# between iterations and computation of connected components of a graph in
+# a pool of worker processes.
+import multiprocessing
+import numpy as np
+
+# Norms of the residual between two iterations (see compute_residual()).
+RESIDUAL_NORM_MAX = 'max'
+RESIDUAL_NORM_L2 = 'l2'
+# compute_answers_in_pool() joins small connected components into parts with
+# at least COMPONENT_BATCH_EDGES answers, every part is one task for a worker.
+COMPONENT_BATCH_EDGES = 10000
+
+
+def compute_residual(old_values, new_values, norm=RESIDUAL_NORM_MAX):
+    """ Computes the residual between arrays of values (e.g. items'
+    weights and users' reliabilities) on two consecutive iterations."""
+    if len(old_values) == 0:
+        return 0.0
+    diff = np.abs(np.asarray(new_values) - np.asarray(old_values))
+    if norm == RESIDUAL_NORM_MAX:
+        return float(np.max(diff))
+    elif norm == RESIDUAL_NORM_L2:
+        return float(np.sum(diff ** 2) ** 0.5)
+    else:
+        raise Exception("Unknown norm: %s" % norm)
+
+
+def split_components(graph):
+    """ Returns a list of connected components of the graph (gk.Graph or
+    gd.Graph), every component is a pair (list of users, list of items).
+    """
+    # Union-find over item ids, users join all their items.
+    parent = {}
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for it in graph.items:
+        parent[it.id] = it.id
+    for u in graph.users:
+        root = None
+        for it_id in u.answers:
+            r = find(it_id)
+            if root is None:
+                root = r
+            elif r != root:
+                parent[r] = root
+    components = {}
+    for u in graph.users:
+        for it_id in u.answers:
+            components.setdefault(find(it_id), ([], []))[0].append(u)
+            break
+    for it in graph.items:
+        components.setdefault(find(it.id), ([], []))[1].append(it)
+    return components.values()
+
+
+def _make_subgraph(graph, users, items, cls=None):
+    """ Returns a graph of the same class (or of cls) which holds given users
+    and items."""
+    g = (cls or graph.__class__)()
+    for u in users:
+        g.users.append(u)
+        g.user_dict[u.id] = u
+    for it in items:
+        g.items.append(it)
+        g.item_dict[it.id] = it
+    return g
+
+
+# Parts of the graph computed by the pool, worker processes inherit them
+# when they are forked, so parts are not pickled.
+_pool_parts = []
+# Attributes of users and items which are not sent back from workers.
+_INPUT_ATTRIBUTES = ('id', 'answers', 'msgs')
+
+
+def _get_part_values(g):
+    """ Returns a list of computed attributes of users of the part g, a list
+    of computed attributes of its items and its n_iterations and residual."""
+    users = [dict((k, v) for k, v in u.__dict__.iteritems()
+                  if k not in _INPUT_ATTRIBUTES) for u in g.users]
+    items = [dict((k, v) for k, v in it.__dict__.iteritems()
+                  if k not in _INPUT_ATTRIBUTES) for it in g.items]
+    return users, items, g.n_iterations, g.residual
+
+
+def _compute_part(args):
+    """ Runs compute_answers() on a part of a graph and returns
+    _get_part_values() of the part."""
+    index, k_max, kwargs = args
+    g = _pool_parts[index]
+    g.compute_answers(k_max, **kwargs)
+    return _get_part_values(g)
+
+
+def _lockstep_worker(conn, indices, warm_start, track_residual, norm):
+    """ Computes parts of a graph with given indices (objects of lockstep_cls
+    of compute_answers_in_pool()) in lock-step with other workers. On every iteration the worker
+    waits for True, sends the sum of squares and the number of values which
+    the normalization is computed from, waits for the normalization and
+    sends residuals of its parts. False finishes the computation, then
+    _get_part_values() of the parts are sent."""
+    parts = [_pool_parts[i] for i in indices]
+    for g in parts:
+        g._start(warm_start, track_residual)
+    while conn.recv():
+        sum_squares, n_values = 0.0, 0
+        for g in parts:
+            values = g._propagate()
+            sum_squares += float(np.sum(values ** 2))
+            n_values += len(values)
+        conn.send((sum_squares, n_values))
+        normaliz = conn.recv()
+        conn.send([g._send(normaliz, norm) for g in parts])
+    for g in parts:
+        g._finish()
+    conn.send([_get_part_values(g) for g in parts])
+    conn.close()
+
+
+def _combine_residuals(residuals, norm):
+    if norm == RESIDUAL_NORM_L2:
+        return float(np.sum(np.array(residuals) ** 2) ** 0.5)
+    return max(residuals)
+
+
+def _compute_in_lockstep(parts, k_max, n_processes, tol=None,
+                         norm=RESIDUAL_NORM_MAX, warm_start=False):
+    """ Computes parts of a graph in n_processes worker processes
+    (see _lockstep_worker()) with the normalization computed over all parts
+    on every iteration, iterations stop when the residual over all parts is
+    less than tol. Returns a list of _get_part_values() of parts, the
+    normalization, the number of iterations and the residual."""
+    global _pool_parts
+    _pool_parts = parts
+    n_workers = min(n_processes, len(parts))
+    conns, workers = [], []
+    try:
+        for i in xrange(n_workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_lockstep_worker,
+                    args=(worker_conn, range(i, len(parts), n_workers),
+                          warm_start, tol is not None, norm))
+            worker.start()
+            # The worker holds its end, so recv() fails if the worker dies.
+            worker_conn.close()
+            conns.append(conn)
+            workers.append(worker)
+    finally:
+        _pool_parts = []
+    normaliz = 1
+    n_iterations = 0
+    residual = None
+    try:
+        for i in xrange(k_max):
+            for conn in conns:
+                conn.send(True)
+            sums = [conn.recv() for conn in conns]
+            sum_squares = sum(s for s, n in sums)
+            n_values = sum(n for s, n in sums)
+            # The same as compute_normaliz() of all values.
+            normaliz = 1.0
+            if n_values > 0 and sum_squares > 0:
+                normaliz = (sum_squares / float(n_values)) ** 0.5
+            for conn in conns:
+                conn.send(normaliz)
+            residuals = []
+            for conn in conns:
+                residuals.extend(conn.recv())
+            n_iterations = i + 1
+            if tol is not None:
+                residual = _combine_residuals(residuals, norm)
+                if residual < tol:
+                    break
+        for conn in conns:
+            conn.send(False)
+        results = [None] * len(parts)
+        for i, conn in enumerate(conns):
+            for index, values in zip(range(i, len(parts), n_workers),
+                                     conn.recv()):
+                results[index] = values
+    finally:
+        for worker in workers:
+            worker.join()
+    return results, normaliz, n_iterations, residual
+
+
+def compute_answers_in_pool(graph, k_max, n_processes, lockstep_cls=None,
+                            **kwargs):
+    """ Splits the graph into connected components and runs compute_answers()
+    on them in n_processes worker processes. Small components are joined
+    into parts of at least COMPONENT_BATCH_EDGES answers. Workers get parts
+    by forking (parts are not pickled) and send back only computed values,
+    which are set to users and items of the graph.
+    kwargs are passed to compute_answers() (tol, norm, warm_start).
+
+    Messages never cross component boundaries. If the algorithm has no
+    global values (lockstep_cls is None) then parts are computed
+    independently and the graph gets the largest number of iterations and
+    the residual combined over parts. Otherwise parts are built as
+    lockstep_cls objects (they implement _start(), _propagate(), _send() and
+    _finish(), see gk.ArrayGraph) and computed in lock-step: on every
+    iteration workers send sums of squares and numbers of their values, the
+    normalization is combined from them and sent back, and all parts stop
+    together, so the result is the same as the result of compute_answers()
+    on the whole graph.
+    """
+    global _pool_parts
+    lockstep = lockstep_cls is not None
+    parts = []
+    users, items, n_edges = [], [], 0
+    for comp_users, comp_items in split_components(graph):
+        users.extend(comp_users)
+        items.extend(comp_items)
+        n_edges += sum(len(u.answers) for u in comp_users)
+        if n_edges >= COMPONENT_BATCH_EDGES:
+            parts.append(_make_subgraph(graph, users, items, lockstep_cls))
+            users, items, n_edges = [], [], 0
+    if len(items) > 0:
+        parts.append(_make_subgraph(graph, users, items, lockstep_cls))
+    if lockstep and n_processes > 1 and len(parts) > 1:
+        results, normaliz, n_iterations, residual = _compute_in_lockstep(
+                                        parts, k_max, n_processes, **kwargs)
+        _set_part_values(parts, results)
+        graph.normaliz = normaliz
+        graph.n_iterations = n_iterations
+        graph.residual = residual
+        return
+    if lockstep:
+        # One part or one process, the whole graph is computed at once.
+        part = _make_subgraph(graph, graph.users, graph.items, lockstep_cls)
+        part.compute_answers(k_max, **kwargs)
+        graph.normaliz = part.normaliz
+        graph.n_iterations = part.n_iterations
+        graph.residual = part.residual
+        return
+    tasks = [(i, k_max, kwargs) for i in xrange(len(parts))]
+    _pool_parts = parts
+    try:
+        if n_processes > 1 and len(parts) > 1:
+            pool = multiprocessing.Pool(min(n_processes, len(parts)))
+            try:
+                results = pool.map(_compute_part, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_compute_part(task) for task in tasks]
+    finally:
+        _pool_parts = []
+    _set_part_values(parts, results)
+    graph.n_iterations = max([g.n_iterations for g in parts] or [0])
+    residuals = [g.residual for g in parts if g.residual is not None]
+    if not residuals:
+        graph.residual = None
+    else:
+        graph.residual = _combine_residuals(residuals, kwargs.get('norm'))
+
+
+def _set_part_values(parts, results):
+    """ Sets results of parts (see _get_part_values()) to their users and
+    items."""
+    for g, (users, items, n_iterations, residual) in zip(parts, results):
+        for u, values in zip(g.users, users):
+            u.__dict__.update(values)
+        for it, values in zip(g.items, items):
+            it.__dict__.update(values)
+        g.n_iterations = n_iterations
+        g.residual = residual
@@ -1,4 +1,5 @@
 # Classic hits algorithm.
+import heapq
 import numpy as np
 
 
@@ -64,9 +65,15 @@ class Graph(object):
         return self.user_dict.get(user_id)
 
 
-    def hubs_and_authorities(self, k_max):
+    def hubs_and_authorities(self, k_max, tol=None):
+        """ Runs at most k_max iterations. If tol is not None then the
+        iterations stop once no hub weight changes by more than tol, the
+        number of made iterations is stored in n_iterations."""
+        self.n_iterations = 0
         # Users are hubs and pages are authorities.
         for i in xrange(k_max):
+            if tol is not None:
+                prev_hub_weights = [u.hub_weight for u in self.users]
             # Computes authority for all pages.
             norm = 0
             for it in self.items:
@@ -89,19 +96,75 @@ class Graph(object):
             norm = norm ** 0.5
             for u in self.users:
                 u.hub_weight /= norm
+            self.n_iterations += 1
+            if tol is not None and all(abs(u.hub_weight - prev) <= tol for
+                                       u, prev in zip(self.users,
+                                                      prev_hub_weights)):
+                break
 
 
     def get_n_top_users(self, n, author_id):
         """ Returns top n users exclusive the author."""
-        l = [(user.hub_weight, user.id) for user in self.users if user.id != author_id]
-        # Sorting tuples from largest to smalles based on the first number.
-        l.sort(reverse=True)
-        n_users = [l[i][1] for i in xrange(min(n, len(l)))]
-        return n_users
+        # Selects n largest tuples based on the first number without sorting
+        # all users.
+        l = heapq.nlargest(n, ((user.hub_weight, user.id) for user in
+                               self.users if user.id != author_id))
+        return [user_id for _, user_id in l]
 
 
     def get_n_top_items(self, n):
-        l = [(item.auth_weight, item.id) for item in self.items]
-        l.sort(reverse=True)
-        n_items = [l[i][1] for i in xrange(min(n, len(l)))]
-        return n_items
+        l = heapq.nlargest(n, ((item.auth_weight, item.id) for item in
+                               self.items))
+        return [item_id for _, item_id in l]
+
+
+class ArrayGraph(Graph):
+    """ Array-backed version of the Graph.
+
+    Links are added exactly as in the Graph, but hubs_and_authorities()
+    keeps weights in NumPy arrays over the list of links (user index, item
+    index, value) and computes user->item and item->user products as
+    segment sums with np.bincount. After the computation hub_weight and
+    auth_weight of User/Item objects are set to the computed values.
+    """
+
+    def _build_link_arrays(self):
+        """ Returns arrays of user indices, item indices and link values."""
+        item_idx = dict((it.id, i) for i, it in enumerate(self.items))
+        n_links = sum(len(u.links) for u in self.users)
+        l_user = np.empty(n_links, dtype=np.int64)
+        l_item = np.empty(n_links, dtype=np.int64)
+        l_value = np.empty(n_links, dtype=np.float64)
+        k = 0
+        for i, u in enumerate(self.users):
+            for item_id, value in u.links.iteritems():
+                l_user[k] = i
+                l_item[k] = item_idx[item_id]
+                l_value[k] = value
+                k += 1
+        return l_user, l_item, l_value
+
+    def hubs_and_authorities(self, k_max, tol=None):
+        self.n_iterations = 0
+        n_users = len(self.users)
+        n_items = len(self.items)
+        l_user, l_item, l_value = self._build_link_arrays()
+        hub = np.array([u.hub_weight for u in self.users], dtype=np.float64)
+        auth = np.array([it.auth_weight for it in self.items],
+                        dtype=np.float64)
+        for i in xrange(k_max):
+            auth = np.bincount(l_item, weights=l_value * hub[l_user],
+                               minlength=n_items)
+            auth /= np.sqrt(np.sum(auth ** 2))
+            prev_hub = hub
+            hub = np.bincount(l_user, weights=l_value * auth[l_item],
+                              minlength=n_users)
+            # As in the Graph, the hub norm is a square root of the sum.
+            hub /= np.sqrt(np.sum(hub))
+            self.n_iterations += 1
+            if tol is not None and np.all(np.abs(hub - prev_hub) <= tol):
+                break
+        for u, val in zip(self.users, hub):
+            u.hub_weight = float(val)
+        for it, val in zip(self.items, auth):
+            it.auth_weight = float(val)
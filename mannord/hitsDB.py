@@ -1,52 +1,457 @@
+import time
+import heapq
+import random
 import collections
+from datetime import datetime, timedelta
 import numpy as np
-from models import (ActionMixin, UserMixin, ItemMixin)
+from sqlalchemy import func, select, union_all, and_, inspect
+from models import (ActionMixin, UserMixin, ItemMixin, LinkMixin)
+from spam_detection_mixins import query_in_chunks, IN_CLAUSE_CHUNK_SIZE
+import spam_utils as su
 import hits
 
 K_MAX = 10
+# HITS iterations stop once no hub weight changes by more than TOLERANCE.
+TOLERANCE = 1e-4
+# If True then HITS is computed by hits.ArrayGraph.
+USE_ARRAY_GRAPH = True
+# If True then links of the HITS graph are read from the link table
+# (LinkMixin), otherwise they are counted from items and actions.
+USE_LINK_TABLE = True
+# If True then the heaviest pages of users are selected by one query with
+# ROW_NUMBER() when the db supports window functions, otherwise by one query
+# per user (see get_page_weights_of_users()).
+USE_WINDOW_FUNCTIONS = True
+# Maximum number of users in the reservoir of random reviewers.
+RESERVOIR_SIZE = 1000
+# Number of seconds after which a sample of the reservoir is stale and is
+# refreshed from the db when a request has time for it.
+RESERVOIR_REFRESH_INTERVAL = 600
+# Users who did an action during this number of days are active.
+RESERVOIR_ACTIVE_DAYS = 30
+# Users with spam reliability not greater than this are not in the reservoir.
+RESERVOIR_MIN_RELIABILITY = 0
+# Maximum number of users of the target page whose pages are added to the
+# HITS graph, users with heavier links to the page go first.
+MAX_NEIGHBOR_USERS = 200
+# Maximum number of pages added per neighbour user, heaviest links first.
+MAX_PAGES_PER_USER = 50
+# Maximum number of links in the HITS graph.
+MAX_LINKS = 50000
+# Number of seconds after which the neighbourhood expansion stops and HITS
+# runs on the links gathered so far.
+SUGGESTION_TIME_BUDGET = 1.0
+# Number of pages whose links are fetched by one query during the expansion,
+# the time budget is checked between queries.
+PAGES_PER_QUERY = 50
+# Maximum number of reviewer lists in the suggestion cache.
+SUGGESTION_CACHE_SIZE = 10000
+# Number of seconds a cached reviewer list stays valid.
+SUGGESTION_CACHE_TTL = 300
 
-def suggest_n_users_to_review(item, n, session):
-    """ Function suggests n users to review targer item."""
-    ItemClass = ItemMixin.cls
-    ActionClass = ActionMixin.cls
-    UserClass = UserMixin.cls
-    graph = hits.Graph()
-    # Fetches all annotations (items) on the target page
+
+class ReviewerReservoir(object):
+    """ Uniform random samples of at most size recently active users with
+    spam reliability of an algorithm above RESERVOIR_MIN_RELIABILITY. A
+    sample per algorithm is kept in memory, between refreshes sampling
+    reviewers costs no queries. A sample becomes stale after
+    RESERVOIR_REFRESH_INTERVAL seconds. sample() refreshes a stale sample
+    only if its last refresh took less time than is left before the
+    deadline of the request, otherwise the stale sample is served.
+    A periodic job can call refresh() to keep samples fresh outside
+    requests."""
+
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.size = size
+        # Maps algo_name to (user ids, expiration time, number of seconds
+        # which the last refresh took).
+        self.samples = {}
+
+    def invalidate(self):
+        """ Makes all samples stale, they are served until refreshed."""
+        for algo_name, (user_ids, expires, duration) in self.samples.items():
+            self.samples[algo_name] = (user_ids, 0, duration)
+
+    def refresh(self, session, algo_name=su.ALGO_DIRICHLET):
+        start = time.time()
+        UserClass = UserMixin.cls
+        ActionClass = ActionMixin.cls
+        if algo_name == su.ALGO_KARGER:
+            reliab = UserClass.sk_reliab
+        else:
+            reliab = UserClass.sd_reliab
+        since = datetime.utcnow() - timedelta(days=RESERVOIR_ACTIVE_DAYS)
+        rows = session.query(UserClass.id).join(ActionClass,
+                                        ActionClass.user_id == UserClass.id
+                    ).filter(ActionClass.timestamp >= since,
+                             reliab > RESERVOIR_MIN_RELIABILITY
+                    ).distinct().yield_per(1000)
+        # Reservoir sampling, every user is kept with equal probability.
+        user_ids = []
+        for i, (user_id, ) in enumerate(rows):
+            if i < self.size:
+                user_ids.append(user_id)
+            else:
+                j = random.randint(0, i)
+                if j < self.size:
+                    user_ids[j] = user_id
+        now = time.time()
+        self.samples[algo_name] = (user_ids, now + RESERVOIR_REFRESH_INTERVAL,
+                                   now - start)
+
+    def sample(self, n, exclude, session, algo_name=su.ALGO_DIRICHLET,
+               deadline=None):
+        """ Returns at most n random users from the sample of algo_name
+        which are not in exclude. Without a sample the function returns an
+        empty list if the deadline (time.time() value) has passed."""
+        entry = self.samples.get(algo_name)
+        now = time.time()
+        if entry is None:
+            if deadline is not None and now >= deadline:
+                return []
+            self.refresh(session, algo_name=algo_name)
+        elif now >= entry[1] and (deadline is None or
+                                  now + entry[2] < deadline):
+            self.refresh(session, algo_name=algo_name)
+        user_ids = self.samples[algo_name][0]
+        k = min(n + len(exclude), len(user_ids))
+        user_ids = [user_id for user_id in random.sample(user_ids, k)
+                    if user_id not in exclude]
+        return user_ids[:n]
+
+
+reservoir = ReviewerReservoir()
+
+
+class SuggestionCache(object):
+    """ LRU cache of reviewer lists keyed by page url, author id and n.
+    Entries of a page are dropped by invalidate() when the page gets a new
+    item or action. Activity on neighbouring pages also changes the HITS
+    graph, so entries expire after ttl seconds regardless. hits and misses
+    count lookups since the cache was created or cleared."""
+
+    def __init__(self, size=SUGGESTION_CACHE_SIZE, ttl=SUGGESTION_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.page_keys = collections.defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, page_url, author_id, n):
+        key = (page_url, author_id, n)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                self._discard_page_key(key)
+            self.misses += 1
+            return None
+        # Moves the entry to the end, it is the most recently used now.
+        self.entries[key] = entry
+        self.hits += 1
+        return list(entry[1])
+
+    def put(self, page_url, author_id, n, user_ids):
+        key = (page_url, author_id, n)
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, list(user_ids))
+        self.page_keys[page_url].add(key)
+        while len(self.entries) > self.size:
+            old_key, _ = self.entries.popitem(last=False)
+            self._discard_page_key(old_key)
+
+    def invalidate(self, page_url):
+        for key in self.page_keys.pop(page_url, ()):
+            self.entries.pop(key, None)
+
+    def _discard_page_key(self, key):
+        keys = self.page_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.page_keys[key[0]]
+
+
+suggestion_cache = SuggestionCache()
+
+def get_deadline():
+    """ Returns the deadline of a suggestion request (time.time() value) or
+    None if SUGGESTION_TIME_BUDGET is None."""
+    if SUGGESTION_TIME_BUDGET is None:
+        return None
+    return time.time() + SUGGESTION_TIME_BUDGET
+
+
+def suggest_n_users_to_review(item, n, session, deadline=None):
+    """ Function suggests n users to review targer item.
+    The HITS graph is bounded by MAX_NEIGHBOR_USERS, MAX_PAGES_PER_USER,
+    MAX_LINKS and the deadline (see get_deadline(), None disables a
+    limit)."""
+    if deadline is None:
+        deadline = get_deadline()
+    graph = hits.ArrayGraph() if USE_ARRAY_GRAPH else hits.Graph()
+    # Fetches links of users who annotated the target page or acted on
     # annotations.
-    users_1, links_1 = get_1neighbors_and_links(item.page_url, session)
-    add_links_to_graph(graph, item.page_url, links_1)
-    # Adds links for 2-heighbors
-    for user_id in users_1:
-        pages = get_1neighbors_for_user(user_id, session)
-        for p in pages:
-            users, links = get_1neighbors_and_links(p, session)
-            add_links_to_graph(graph, p, links)
+    links = get_links_on_pages([item.page_url], session)
+    page_links = links.get(item.page_url, {})
+    n_links = len(page_links)
+    users_1 = _top_keys(page_links, MAX_NEIGHBOR_USERS)
+    # Adds links for 2-heighbors, pages with heavier links to the neighbours
+    # go first.
+    page_weights = collections.defaultdict(int)
+    for user_pages in get_page_weights_of_users(users_1, session,
+                            max_pages=MAX_PAGES_PER_USER, exclude=links,
+                            deadline=deadline).itervalues():
+        for page_url, weight in user_pages.iteritems():
+            page_weights[page_url] += weight
+    pages = _top_keys(page_weights, None)
+    is_full = False
+    for i in xrange(0, len(pages), PAGES_PER_QUERY):
+        if is_full or (deadline is not None and time.time() >= deadline):
+            break
+        chunk = pages[i : i + PAGES_PER_QUERY]
+        chunk_links = get_links_on_pages(chunk, session)
+        for page_url in chunk:
+            page_links = chunk_links.get(page_url, {})
+            if MAX_LINKS is not None and n_links + len(page_links) > MAX_LINKS:
+                is_full = True
+                break
+            links[page_url] = page_links
+            n_links += len(page_links)
+    for page_url, page_links in links.iteritems():
+        add_links_to_graph(graph, page_url, page_links)
     # Runns hits algorithm
-    graph.hubs_and_authorities(K_MAX)
+    graph.hubs_and_authorities(K_MAX, tol=TOLERANCE)
     return graph.get_n_top_users(n, item.author_id)
 
 
+def _top_keys(weights, n):
+    """ Returns a list of at most n keys of the dictionary with the largest
+    values, all keys if n is None."""
+    if n is None or n >= len(weights):
+        return sorted(weights, key=weights.get, reverse=True)
+    return heapq.nlargest(n, weights, key=weights.get)
+
+
 def add_links_to_graph(graph, page_url, links):
     for user_id in links:
         graph.add_link(user_id, page_url, links[user_id])
 
 
+def get_links_on_pages(page_urls, session):
+    """ Returns a dictionary which maps page url to a dictionary with links,
+    the dictionary maps user id to a number of times the user annotated the
+    page or acted on its annotations (weight). Links are read from the link
+    table if USE_LINK_TABLE is True.
+    """
+    if not USE_LINK_TABLE:
+        return count_links_on_pages(page_urls, session)
+    LinkClass = LinkMixin.cls
+    links = collections.defaultdict(dict)
+    query = session.query(LinkClass.page_url, LinkClass.user_id,
+                          LinkClass.weight).filter(LinkClass.weight > 0)
+    for page_url, user_id, weight in query_in_chunks(query, LinkClass.page_url,
+                                                     page_urls):
+        links[page_url][user_id] = weight
+    return dict(links)
+
+
+def get_pages_of_users(user_ids, session):
+    """ Returns a set of pages which users annotated and pages with
+    annotations which the users acted on (voted, flagged, etc.).
+    """
+    if not USE_LINK_TABLE:
+        return count_pages_of_users(user_ids, session)
+    LinkClass = LinkMixin.cls
+    query = session.query(LinkClass.page_url).filter(LinkClass.weight > 0
+                                                    ).distinct()
+    return set(page_url for page_url, in query_in_chunks(
+                                query, LinkClass.user_id, user_ids))
+
+
+def get_page_weights_of_users(user_ids, session, max_pages=None,
+                              exclude=(), deadline=None):
+    """ Returns a dictionary which maps user id to a dictionary which maps
+    pages of the user (see get_pages_of_users()) except pages in exclude to
+    link weights. Every user gets at most max_pages heaviest pages (all if
+    max_pages is None). Links are read by one query per chunk of users, the
+    limit is applied by ROW_NUMBER() (see has_window_functions()), without
+    window functions by one query per user. Users after deadline
+    (time.time() value) are skipped."""
+    if not USE_LINK_TABLE:
+        return count_page_weights_of_users(user_ids, session, max_pages,
+                                           exclude, deadline)
+    LinkClass = LinkMixin.cls
+    weights = collections.defaultdict(dict)
+    window = max_pages is not None and has_window_functions(session)
+    conditions = [LinkClass.weight > 0]
+    if exclude:
+        conditions.append(~LinkClass.page_url.in_(list(exclude)))
+    query = session.query(LinkClass.user_id, LinkClass.page_url,
+                          LinkClass.weight).filter(*conditions)
+    if max_pages is not None and not window:
+        chunks = [[user_id] for user_id in user_ids]
+    else:
+        chunks = _chunks(user_ids)
+    for chunk in chunks:
+        if deadline is not None and time.time() >= deadline:
+            break
+        if window:
+            links = select([LinkClass.user_id, LinkClass.page_url,
+                            LinkClass.weight]
+                        ).where(LinkClass.user_id.in_(chunk)
+                        ).where(and_(*conditions)).alias()
+            rows = _top_pages_query(links, max_pages, session)
+        elif max_pages is not None:
+            rows = query.filter(LinkClass.user_id == chunk[0]
+                        ).order_by(LinkClass.weight.desc()
+                        ).limit(max_pages)
+        else:
+            rows = query.filter(LinkClass.user_id.in_(chunk))
+        for user_id, page_url, weight in rows:
+            weights[user_id][page_url] = weight
+    return dict(weights)
+
+
+def has_window_functions(session):
+    """ Returns True if USE_WINDOW_FUNCTIONS is True and the db of the link
+    table supports ROW_NUMBER() OVER (...)."""
+    if not USE_WINDOW_FUNCTIONS:
+        return False
+    dialect = session.get_bind(mapper=inspect(LinkMixin.cls)).dialect
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 25)
+    if dialect.name == 'mysql':
+        version = dialect.server_version_info
+        if version is None:
+            return False
+        if getattr(dialect, '_is_mariadb', False):
+            return version >= (10, 2)
+        return version >= (8, 0)
+    return True
+
+
+def _chunks(user_ids):
+    user_ids = list(user_ids)
+    return [user_ids[i : i + IN_CLAUSE_CHUNK_SIZE]
+            for i in xrange(0, len(user_ids), IN_CLAUSE_CHUNK_SIZE)]
+
+
+def _top_pages_query(links, max_pages, session):
+    """ Returns a query of (user_id, page_url, weight) rows of the links
+    selectable, at most max_pages heaviest pages per user."""
+    rank = func.row_number().over(partition_by=links.c.user_id,
+                                  order_by=links.c.weight.desc())
+    ranked = select([links.c.user_id, links.c.page_url, links.c.weight,
+                     rank.label('rank')]).alias()
+    return session.query(ranked.c.user_id, ranked.c.page_url,
+                         ranked.c.weight).filter(ranked.c.rank <= max_pages)
+
+
+def count_links_on_pages(page_urls, session):
+    """ Same as get_links_on_pages() (for all pages if page_urls is None),
+    but weights are counted from items and actions by two GROUP BY queries
+    (per chunk of pages).
+    """
+    ItemClass = ItemMixin.cls
+    ActionClass = ActionMixin.cls
+    links = collections.defaultdict(lambda: collections.defaultdict(int))
+    # Counts items
+    items_query = session.query(ItemClass.page_url, ItemClass.author_id,
+                                func.count(ItemClass.id)
+                ).filter(ItemClass.page_url != None
+                ).group_by(ItemClass.page_url, ItemClass.author_id)
+    # Counts actions. We care only about actions which are not annotations
+    # itself, because actions which are annotations were already counted.
+    actions_query = session.query(ItemClass.page_url, ActionClass.user_id,
+                                  func.count(ActionClass.id)
+                ).join(ActionClass, ActionClass.item_id == ItemClass.id
+                ).filter(ItemClass.page_url != None,
+                         ActionClass.item_twin_id == None
+                ).group_by(ItemClass.page_url, ActionClass.user_id)
+    for query in (items_query, actions_query):
+        if page_urls is None:
+            rows = query.all()
+        else:
+            rows = query_in_chunks(query, ItemClass.page_url, page_urls)
+        for page_url, user_id, count in rows:
+            if user_id is not None:
+                links[page_url][user_id] += count
+    return dict((page_url, dict(page_links))
+                for page_url, page_links in links.iteritems())
+
+
+def count_pages_of_users(user_ids, session):
+    """ Same as get_pages_of_users(), but pages are fetched from items and
+    actions."""
+    ItemClass = ItemMixin.cls
+    ActionClass = ActionMixin.cls
+    query = session.query(ItemClass.page_url).distinct()
+    pages = set(page_url for page_url, in query_in_chunks(
+                                query, ItemClass.author_id, user_ids))
+    query = session.query(ItemClass.page_url).join(ActionClass,
+                                        ActionClass.item_id == ItemClass.id
+                ).filter(ActionClass.item_twin_id == None).distinct()
+    pages.update(page_url for page_url, in query_in_chunks(
+                                query, ActionClass.user_id, user_ids))
+    return pages
+
+
+def count_page_weights_of_users(user_ids, session, max_pages=None,
+                                exclude=(), deadline=None):
+    """ Same as get_page_weights_of_users(), but weights are counted from
+    items and actions by one GROUP BY query per chunk of users. Without
+    window functions the limit is applied after counting."""
+    ItemClass = ItemMixin.cls
+    ActionClass = ActionMixin.cls
+    weights = {}
+    window = max_pages is not None and has_window_functions(session)
+    for chunk in _chunks(user_ids):
+        if deadline is not None and time.time() >= deadline:
+            break
+        items = select([ItemClass.author_id.label('user_id'),
+                        ItemClass.page_url.label('page_url')]
+                    ).where(and_(ItemClass.author_id.in_(chunk),
+                                 ItemClass.page_url != None))
+        actions = select([ActionClass.user_id.label('user_id'),
+                          ItemClass.page_url.label('page_url')]
+                    ).where(and_(ActionClass.item_id == ItemClass.id,
+                                 ActionClass.user_id.in_(chunk),
+                                 ItemClass.page_url != None,
+                                 ActionClass.item_twin_id == None))
+        if exclude:
+            items = items.where(~ItemClass.page_url.in_(list(exclude)))
+            actions = actions.where(~ItemClass.page_url.in_(list(exclude)))
+        all_links = union_all(items, actions).alias()
+        links = select([all_links.c.user_id, all_links.c.page_url,
+                        func.count().label('weight')]
+                    ).group_by(all_links.c.user_id, all_links.c.page_url
+                    ).alias()
+        if window:
+            rows = _top_pages_query(links, max_pages, session)
+        else:
+            rows = session.query(links.c.user_id, links.c.page_url,
+                                 links.c.weight)
+        chunk_weights = collections.defaultdict(dict)
+        for user_id, page_url, weight in rows:
+            chunk_weights[user_id][page_url] = weight
+        for user_id, user_pages in chunk_weights.iteritems():
+            if max_pages is not None and not window:
+                user_pages = dict((page_url, user_pages[page_url])
+                                  for page_url in _top_keys(user_pages,
+                                                            max_pages))
+            weights[user_id] = user_pages
+    return weights
+
+
 def get_1neighbors_for_user(user_id, session):
     """ The method returns a list of pages wich author annotated and
     pages with annotation which the user acted on (voted, flagged, etc.).
     """
-    ItemClass = ItemMixin.cls
-    ActionClass = ActionMixin.cls
-    set_of_pages = set()
-    # Fetches items.
-    items = ItemClass.get_items_by_author(user_id, session)
-    for it in items:
-        set_of_pages.add(it.page_url)
-    actions = ActionClass.get_actions_by_user(user_id, session)
-    for act in actions:
-        if act.item_twin is None:
-            set_of_pages.add(act.item.page_url)
-    return list(set_of_pages)
+    return list(get_pages_of_users([user_id], session))
 
 
 def get_1neighbors_and_links(page_url, session):
@@ -55,21 +460,5 @@ def get_1neighbors_and_links(page_url, session):
     The method, also, returns a dictionary with links, the dictionary maps
     user id to a number of times the user acted on the page (weight).
     """
-    ItemClass = ItemMixin.cls
-    ActionClass = ActionMixin.cls
-    # A dictionary is initialized with zeros, it is convenient for counting.
-    counter_dict = collections.defaultdict(int)
-    # Fetches items
-    items = ItemClass.get_items_on_page(page_url, session)
-    for it in items:
-        counter_dict[it.author_id] += 1
-    # Fetches actions
-    for it in items:
-        # Get actions on the item it.
-        actions = ActionClass.get_actions_on_item(it.id, session)
-        for act in actions:
-            # We care only about actions which are not annotations itself,
-            # because actions which are annotations were already counted.
-            if act.item_twin is None:
-                counter_dict[act.user_id] += 1
+    counter_dict = get_links_on_pages([page_url], session).get(page_url, {})
     return counter_dict.keys(), counter_dict
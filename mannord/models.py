@@ -1,17 +1,27 @@
 import os
+import time
+import random
+import collections
+import contextlib
 import ConfigParser
 from pkg_resources import resource_string, resource_filename
 from sqlalchemy import (Column, Integer, Float, String, Boolean,
-                        ForeignKey, DateTime, Sequence, and_)
-from sqlalchemy.orm import relationship, backref
+                        ForeignKey, DateTime, Sequence, Index, and_,
+                        inspect, event, select)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, backref, object_session, Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.sql.expression import func
 from spam_detection_mixins import (UserDirichletMixin, ItemDirichletMixin,
                                    ActionDirichletMixin, UserKargerMixin,
-                                   ItemKargerMixin, ActionKargerMixin)
+                                   ItemKargerMixin, ActionKargerMixin,
+                                   flag_index, query_in_chunks)
 import spam_utils as su
 import graph_k as gk
 import graph_d as gd
+from bloom import ScalableBloomFilter
 
 
 # Reads config file
@@ -38,11 +48,177 @@ COMPUTATION_SK_NAME =   ini_config.get('names', 'COMPUTATION_SK_NAME')
 
 
 STRING_FIELD_LENGTH = 32
+# Key of the session.info entry which holds an active Batch.
+BATCH_KEY = 'mannord_batch'
+# Key of the session.info entry which holds changes of the link table
+# collected during a flush (see listen_link_events()).
+LINK_DELTAS_KEY = 'mannord_link_deltas'
+# Number of seconds for which normalization of a computation is cached by
+# the process, new values written by other processes are picked up after it.
+COMPUTATION_CACHE_TTL = 60
+# Number of times a random probe of get_n_items_for_spam_mm_randomly() is
+# redrawn when it hits an item which is already picked.
+MM_RANDOM_PROBE_RETRIES = 10
+
+
+# False positive rate of the filter of existing actions.
+ACTION_FILTER_ERROR_RATE = 0.01
+# The filter is sized for this many times the number of existing actions,
+# when it is full a part this many times larger is added to it.
+ACTION_FILTER_GROWTH = 2
+# Number of seconds after which actions which are added to the db since the
+# last refresh (not through add_to_session(), e.g. by scripts) are loaded
+# into the filter.
+ACTION_FILTER_TTL = 60
+
+
+# Filter of (item_id, user_id, type) of existing actions, see
+# ActionMixin.load_action_filter().
+_action_filter = None
+# Time of the next refresh of the filter, its ttl and the largest id of
+# actions loaded into the filter.
+_action_filter_expiration = None
+_action_filter_ttl = None
+_action_filter_max_id = None
+# Maps computation name to (normalization, expiration time).
+_normalization_cache = {}
+# Incremented on every invalidation, a value loaded from the db is cached
+# only if no invalidation happened while it was loaded.
+_normalization_cache_version = 0
 # Explanation of prefixes of column names.
 #   - sk - a field related to spam detection using karger's algorithm
 #   - sd - a filed related to spam detection based on Dirichlet distribution
 
 
+class Batch(object):
+    """ State of a batch of online updates applied to a session, see
+    deferred(). Maps keys returned by batch_key() methods to objects which
+    were added, deleted (None) or looked up during the batch."""
+
+    def __init__(self):
+        self.objects = {}
+        # (item_id, user_id) pairs which actions are all in objects.
+        self.pairs = set()
+        self.computations = {}
+        # Maps (class, object id) to a Counter of column deltas.
+        self.counter_deltas = collections.defaultdict(collections.Counter)
+        # Counters which were not updated on instances during the batch.
+        self.unsynced = set()
+
+
+def get_batch(session):
+    return session.info.get(BATCH_KEY)
+
+
+@contextlib.contextmanager
+def deferred(session):
+    """ Context manager which defers flushes of mannord functions till the
+    end of the block, then flushes the session once. Lookups of actions,
+    items and users inside the block see objects added or deleted in it,
+    other queries autoflush as usual. Counter increments are written by one
+    UPDATE per row on exit and are applied to instances in the session
+    right away. Nested blocks share the outermost batch."""
+    batch = get_batch(session)
+    if batch is not None:
+        yield batch
+        return
+    batch = Batch()
+    session.info[BATCH_KEY] = batch
+    try:
+        yield batch
+    finally:
+        del session.info[BATCH_KEY]
+    session.flush()
+    for (cls, obj_id), deltas in batch.counter_deltas.iteritems():
+        _update_counters(cls, obj_id, session, deltas, False)
+        if (cls, obj_id) in batch.unsynced:
+            obj = session.identity_map.get(identity_key(cls, obj_id))
+            if obj is not None:
+                session.expire(obj, deltas.keys())
+
+
+def flush(session):
+    """ Flushes the session unless a batch is active."""
+    if get_batch(session) is None:
+        session.flush()
+
+
+def add_to_session(obj, session):
+    """ Adds an action, an item or a user to the session and to the active
+    batch."""
+    session.add(obj)
+    if _action_filter is not None and isinstance(obj, ActionMixin):
+        _action_filter.add(_action_filter_key(obj.item_id, obj.user_id,
+                                              obj.type))
+    batch = get_batch(session)
+    if batch is not None:
+        # Column defaults are applied on flush, but the object can be read
+        # before the batch is flushed.
+        for column in obj.__table__.columns:
+            if (getattr(column.default, "is_scalar", False) and
+                getattr(obj, column.key) is None):
+                setattr(obj, column.key, column.default.arg)
+        batch.objects[obj.batch_key()] = obj
+
+
+def delete_from_session(obj, session):
+    """ Deletes an action, an item or a user from the session and from the
+    active batch."""
+    if inspect(obj).pending:
+        # The object was added by the active batch.
+        session.expunge(obj)
+    else:
+        session.delete(obj)
+    batch = get_batch(session)
+    if batch is not None:
+        batch.objects[obj.batch_key()] = None
+
+
+def _get_by_key(key, query, session):
+    """ Returns the first object of the query, inside a batch the object is
+    looked up in the batch first."""
+    batch = get_batch(session)
+    if batch is None:
+        return query.first()
+    if key not in batch.objects:
+        # Objects which are pending in the batch are in batch.objects.
+        with session.no_autoflush:
+            batch.objects[key] = query.first()
+    return batch.objects[key]
+
+
+def _action_filter_key(item_id, user_id, action_type):
+    return '\0'.join((item_id, user_id, action_type)).encode('utf-8')
+
+
+def _update_counters(cls, obj_id, session, deltas, synchronize_session):
+    values = dict((getattr(cls, name), getattr(cls, name) + delta)
+                  for name, delta in deltas.iteritems() if delta != 0)
+    if not values:
+        return
+    session.query(cls).filter(cls.id == obj_id).update(
+        values, synchronize_session=synchronize_session)
+
+
+def increment_counters(cls, obj_id, session, **deltas):
+    """ Adds deltas to integer columns of the row obj_id with a single
+    UPDATE ... SET counter = counter + delta, so the row is not loaded and
+    concurrent increments are not lost. Instances in the session are
+    updated in place."""
+    batch = get_batch(session)
+    if batch is None:
+        _update_counters(cls, obj_id, session, deltas, 'evaluate')
+        return
+    batch.counter_deltas[(cls, obj_id)].update(deltas)
+    obj = session.identity_map.get(identity_key(cls, obj_id))
+    if obj is None or (cls, obj_id) in batch.unsynced:
+        batch.unsynced.add((cls, obj_id))
+        return
+    # Updates the instance without marking it dirty.
+    for name, delta in deltas.iteritems():
+        set_committed_value(obj, name, getattr(obj, name) + delta)
+
+
 # Notes: A spam karma user always votes "not spam" on annotations
 # created by a user. Reliability of the spam karma user reflects whether user
 # is spammer or not. If it has negative reliability then the user is spammer.
@@ -53,6 +229,14 @@ class UserMixin(UserDirichletMixin, UserKargerMixin, object):
     __tablename__ = USER_TABLE_NAME
     cls = None
 
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            # Incremental spam detection.
+            flag_index(USER_TABLE_NAME, 'sk_dirty', True),
+            flag_index(USER_TABLE_NAME, 'sd_dirty', True),
+        )
+
     @declared_attr
     def id(cls):
         return Column(String(STRING_FIELD_LENGTH), primary_key=True)
@@ -71,13 +255,22 @@ class UserMixin(UserDirichletMixin, UserKargerMixin, object):
 
     @classmethod
     def get_user(cls, user_id, session):
-        user = session.query(cls).filter_by(id = user_id).first()
+        user = _get_by_key((cls, user_id),
+                           session.query(cls).filter_by(id = user_id), session)
         return user
 
+    @classmethod
+    def increment_vote_counters(cls, user_id, session, vote=0, mm_vote=0):
+        increment_counters(cls, user_id, session, vote_counter=vote,
+                           mm_vote_counter=mm_vote)
+
 
     def __init__(self, user_id):
         self.id = user_id
 
+    def batch_key(self):
+        return (self.__class__, self.id)
+
 
 class ItemMixin(ItemDirichletMixin, ItemKargerMixin, object):
     """ Item is an object like annotation, post, etc.
@@ -86,6 +279,25 @@ class ItemMixin(ItemDirichletMixin, ItemKargerMixin, object):
     __tablename__ = ITEM_TABLE_NAME
     cls = None
 
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            # get_items_on_page(), get_items_by_author()
+            Index('ix_%s_page_url' % ITEM_TABLE_NAME, 'page_url'),
+            Index('ix_%s_author_id' % ITEM_TABLE_NAME, 'author_id'),
+            # get_n_items_for_spam_mm_randomly()
+            flag_index(ITEM_TABLE_NAME, 'marked_for_mm', True,
+                       'marked_for_mm', 'mm_random'),
+            # get_n_items_for_mm_by_uncertainty()
+            flag_index(ITEM_TABLE_NAME, 'marked_for_mm', True,
+                       'marked_for_mm', 'mm_priority'),
+            # Offline and incremental spam detection.
+            flag_index(ITEM_TABLE_NAME, 'sk_frozen', False),
+            flag_index(ITEM_TABLE_NAME, 'sd_frozen', False),
+            flag_index(ITEM_TABLE_NAME, 'sk_dirty', True),
+            flag_index(ITEM_TABLE_NAME, 'sd_dirty', True),
+        )
+
     @declared_attr
     def id(cls):
         return Column(String(STRING_FIELD_LENGTH), primary_key=True)
@@ -132,6 +344,18 @@ class ItemMixin(ItemDirichletMixin, ItemKargerMixin, object):
         """Mark the action fot metamoderation."""
         return Column(Boolean, default=False)
 
+    @declared_attr
+    def mm_random(cls):
+        """ Random key which defines a random order of items marked for
+        metamoderation, see get_n_items_for_spam_mm_randomly()."""
+        return Column(Float, default=random.random)
+
+    @declared_attr
+    def mm_priority(cls):
+        """ Uncertainty of the spam decision, smaller values are more
+        uncertain, see spam_utils.get_mm_priority()."""
+        return Column(Float)
+
 #    @declared_attr
 #    def is_mm(cls):
 #        """ True if the action is metamoderation."""
@@ -139,9 +363,14 @@ class ItemMixin(ItemDirichletMixin, ItemKargerMixin, object):
 
     @classmethod
     def get_item(cls, item_id, session):
-        annot = session.query(cls).filter_by(id = item_id).first()
+        annot = _get_by_key((cls, item_id),
+                            session.query(cls).filter_by(id = item_id), session)
         return annot
 
+    @classmethod
+    def increment_spam_flag_counter(cls, item_id, session, delta):
+        increment_counters(cls, item_id, session, spam_flag_counter=delta)
+
     @classmethod
     def get_items_on_page(cls, page_url, session):
         return session.query(cls).filter_by(page_url = page_url).all()
@@ -152,10 +381,58 @@ class ItemMixin(ItemDirichletMixin, ItemKargerMixin, object):
 
     @classmethod
     def get_n_items_for_spam_mm_randomly(cls, n, session):
-        return session.query(cls).filter(cls.marked_for_mm == True
-                                     ).order_by(func.random()).limit(n).all()
+        """ Returns n random items marked for metamoderation. Every item is
+        picked by an independent probe: the first item with mm_random at or
+        after a random point (wrapping around), which is one row of the index
+        instead of sorting all marked items. A probe which hits a picked item
+        is redrawn. An item is picked with probability equal to the gap
+        between its key and the previous key, so keys should be redrawn from
+        time to time (see api.redraw_mm_random()). Items with NULL mm_random
+        are never returned.
+        """
+        query = session.query(cls).filter(cls.marked_for_mm == True,
+                                          cls.mm_random != None)
+        items = []
+        picked = set()
+        while len(items) < n:
+            for i in xrange(MM_RANDOM_PROBE_RETRIES + 1):
+                item = cls._probe_mm_random(query, random.random())
+                if item is None or item.id not in picked:
+                    break
+            else:
+                # Most items are picked, takes the next not picked item.
+                item = cls._probe_mm_random(
+                        query.filter(~cls.id.in_(list(picked))), random.random())
+            if item is None:
+                # No more marked items.
+                break
+            items.append(item)
+            picked.add(item.id)
+        return items
+
+    @classmethod
+    def _probe_mm_random(cls, query, start):
+        """ Returns the first item of the query with mm_random >= start, or
+        with the smallest mm_random if there is no such item."""
+        item = query.filter(cls.mm_random >= start
+                           ).order_by(cls.mm_random).first()
+        if item is None:
+            # Wraps around.
+            item = query.order_by(cls.mm_random).first()
+        return item
 
 
+    @classmethod
+    def get_n_items_for_mm_by_uncertainty(cls, n, session):
+        """ Returns n items marked for metamoderation with the most
+        uncertain spam decision first. Items with NULL mm_priority are
+        skipped (NULLs sort differently on different backends), see
+        api.backfill_mm_priority()."""
+        return session.query(cls).filter(cls.marked_for_mm == True,
+                                         cls.mm_priority != None
+                                        ).order_by(cls.mm_priority
+                                        ).limit(n).all()
+
     def __init__(self, page_url, item_id, user, parent_id=None,
                  spam_detect_algo=su.ALGO_KARGER):
         self.page_url = page_url
@@ -172,6 +449,9 @@ class ItemMixin(ItemDirichletMixin, ItemKargerMixin, object):
         su.mark_spam_ham_or_mm(self, algo_type=spam_detect_algo)
         # If an item is also action on another item then create this action.
 
+    def batch_key(self):
+        return (self.__class__, self.id)
+
     def __repr__(self):
         return '<Item %s>' % self.id
 
@@ -181,6 +461,19 @@ class ActionMixin(ActionDirichletMixin, ActionKargerMixin, object):
     __tablename__ = ACTION_TABLE_NAME
     cls = None
 
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            # get_action() and get_actions_by_user()
+            Index('ix_%s_user_item_type' % ACTION_TABLE_NAME,
+                  'user_id', 'item_id', 'type'),
+            # get_actions_on_item()
+            Index('ix_%s_item_id' % ACTION_TABLE_NAME, 'item_id'),
+            # Offline spam detection.
+            flag_index(ACTION_TABLE_NAME, 'sk_frozen', False),
+            flag_index(ACTION_TABLE_NAME, 'sd_frozen', False),
+        )
+
     # Id is an integer from range 1, 2, 3 ... .
     @declared_attr
     def id(cls):
@@ -237,19 +530,108 @@ class ActionMixin(ActionDirichletMixin, ActionKargerMixin, object):
 
     @classmethod
     def get_action(cls, item_id, user_id, action_type, session):
-        action = session.query(cls).filter(and_(cls.user_id == user_id,
+        key = (cls, item_id, user_id, action_type)
+        batch = get_batch(session)
+        if (_action_filter is not None and
+                time.time() >= _action_filter_expiration):
+            cls._refresh_action_filter(session)
+        if (_action_filter is not None and (batch is None or
+                                            key not in batch.objects) and
+            _action_filter_key(item_id, user_id, action_type)
+                not in _action_filter):
+            # The action definitely does not exist.
+            return None
+        if batch is not None and (item_id, user_id) in batch.pairs:
+            return batch.objects.get(key)
+        action = _get_by_key(key,
+                             session.query(cls).filter(and_(
+                                    cls.user_id == user_id,
                                     cls.item_id == item_id,
-                                    cls.type == action_type)).first()
+                                    cls.type == action_type)), session)
         return action
 
 
+    @classmethod
+    def load_action_filter(cls, session, single_writer=False,
+                           error_rate=ACTION_FILTER_ERROR_RATE,
+                           ttl=ACTION_FILTER_TTL):
+        """ Loads (item_id, user_id, type) of all actions into a per-process
+        Bloom filter. While the filter is loaded get_action() answers "no
+        action" without a query for keys which are not in the filter, other
+        keys are looked up in the db. Actions added by add_to_session() (and
+        add_action()) are added to the filter.
+
+        The filter knows actions written through this process at once, other
+        actions only when get_action() refreshes the filter: every ttl
+        seconds it loads actions with ids larger than any loaded id. So this
+        process must be the only one which adds actions through mannord,
+        otherwise get_action() misses actions of other processes and
+        duplicates are added; single_writer=True confirms it. The filter
+        grows when it is full (see ScalableBloomFilter), it is never rebuilt.
+        """
+        global _action_filter, _action_filter_ttl, _action_filter_max_id
+        if not single_writer:
+            raise Exception("The action filter is only correct if this "
+                            "process is the only writer of actions, pass "
+                            "single_writer=True to confirm it")
+        n_actions = session.query(func.count(cls.id)).scalar()
+        _action_filter = ScalableBloomFilter(
+                                max(n_actions, 1000) * ACTION_FILTER_GROWTH,
+                                error_rate=error_rate,
+                                growth=ACTION_FILTER_GROWTH)
+        _action_filter_ttl = ttl
+        _action_filter_max_id = None
+        cls._refresh_action_filter(session)
+
+    @classmethod
+    def _refresh_action_filter(cls, session):
+        """ Adds actions with ids larger than ids of actions in the filter to
+        the filter."""
+        global _action_filter_expiration, _action_filter_max_id
+        query = session.query(cls.id, cls.item_id, cls.user_id, cls.type)
+        if _action_filter_max_id is not None:
+            query = query.filter(cls.id > _action_filter_max_id)
+        for action_id, item_id, user_id, action_type in query.yield_per(1000):
+            _action_filter.add(_action_filter_key(item_id, user_id,
+                                                  action_type))
+            if (_action_filter_max_id is None or
+                    action_id > _action_filter_max_id):
+                _action_filter_max_id = action_id
+        _action_filter_expiration = time.time() + _action_filter_ttl
+
+    @classmethod
+    def clear_action_filter(cls):
+        global _action_filter, _action_filter_expiration
+        global _action_filter_ttl, _action_filter_max_id
+        _action_filter = None
+        _action_filter_expiration = None
+        _action_filter_ttl = None
+        _action_filter_max_id = None
+
+    @classmethod
+    def prefetch_actions(cls, pairs, batch, session):
+        """ Loads actions of all (item_id, user_id) pairs into the batch."""
+        pairs = set(pairs) - batch.pairs
+        user_ids = set(user_id for _, user_id in pairs)
+        query = session.query(cls).filter(cls.user_id.in_(user_ids))
+        with session.no_autoflush:
+            actions = query_in_chunks(query, cls.item_id,
+                                      set(item_id for item_id, _ in pairs))
+        for act in actions:
+            if (act.item_id, act.user_id) in pairs:
+                # Actions added or deleted in the batch take precedence.
+                batch.objects.setdefault(act.batch_key(), act)
+        batch.pairs.update(pairs)
+
     @classmethod
     def add_action(cls, item_id, user_id, action_type, value,
                    timestamp, session, item_twin_id=None):
-        action = cls(item_id, user_id, action_type, value, timestamp,
-                                                    item_twin_id = item_twin_id)
-        session.add(action)
-        session.flush()
+        """ Adds an action, value is ignored (actions have no value column).
+        """
+        action = cls(item_id, user_id, action_type, timestamp,
+                     item_twin_id=item_twin_id)
+        add_to_session(action, session)
+        flush(session)
 
     @classmethod
     def get_actions_on_item(cls, item_id, session):
@@ -274,11 +656,183 @@ class ActionMixin(ActionDirichletMixin, ActionKargerMixin, object):
             raise Exception("An action cannot be performed on an item which represents the action!!!")
         self.item_twin_id = item_twin_id
 
+    def batch_key(self):
+        return (self.__class__, self.item_id, self.user_id, self.type)
+
     def __repr__(self):
         return '<Action of user %s on item %s, type %s>' % (self.user_id,
                                         self.item_id, self.type)
 
 
+class LinkMixin(object):
+    """ Number of times a user annotated a page or acted on annotations on
+    the page (weight), these are links of the HITS graph. Rows are
+    maintained on inserts and deletes of items and actions, see
+    listen_link_events(), and can be regenerated by api.rebuild_links().
+    """
+
+    __tablename__ = "user_page_link"
+    cls = None
+
+    @declared_attr
+    def __table_args__(cls):
+        return (Index('ix_user_page_link_user_id', 'user_id'), )
+
+    @declared_attr
+    def page_url(cls):
+        return Column(String(STRING_FIELD_LENGTH), primary_key=True)
+
+    @declared_attr
+    def user_id(cls):
+        return Column(String(STRING_FIELD_LENGTH), primary_key=True)
+
+    @declared_attr
+    def weight(cls):
+        return Column(Integer, default=0)
+
+    def __init__(self, page_url, user_id, weight):
+        self.page_url = page_url
+        self.user_id = user_id
+        self.weight = weight
+
+    def __repr__(self):
+        return '<Link of user %s to page %s, weight %s>' % (self.user_id,
+                                                self.page_url, self.weight)
+
+
+def _add_link_weight(connection, page_url, user_id, delta):
+    if page_url is None or user_id is None:
+        return
+    table = LinkMixin.cls.__table__
+    update = table.update().where(and_(table.c.page_url == page_url,
+                                       table.c.user_id == user_id)
+                          ).values(weight=table.c.weight + delta)
+    result = connection.execute(update)
+    if result.rowcount == 0 and delta > 0:
+        insert = table.insert().values(page_url=page_url, user_id=user_id,
+                                       weight=delta)
+        if connection.dialect.name == 'sqlite':
+            # SQLite serializes writers, and pysqlite breaks savepoints.
+            connection.execute(insert)
+            return
+        try:
+            with connection.begin_nested():
+                connection.execute(insert)
+        except IntegrityError:
+            # A concurrent writer inserted the link after our update.
+            connection.execute(update)
+
+
+class _LinkDeltas(object):
+    """ Changes of link weights collected during a flush. deltas maps
+    (page_url, user_id) to the change of weight, by_item maps item id to
+    {user_id: change} of actions whose item is not loaded, their page urls
+    are looked up once at the end of the flush."""
+
+    def __init__(self):
+        self.deltas = collections.defaultdict(int)
+        self.by_item = collections.defaultdict(
+                                lambda: collections.defaultdict(int))
+
+    def add(self, page_url, user_id, delta):
+        if page_url is not None and user_id is not None:
+            self.deltas[(page_url, user_id)] += delta
+
+    def resolve_item(self, item_id, page_url):
+        """ Moves changes of actions on the item to deltas."""
+        for user_id, delta in self.by_item.pop(item_id, {}).iteritems():
+            self.add(page_url, user_id, delta)
+
+
+def _get_link_deltas(obj):
+    info = object_session(obj).info
+    if LINK_DELTAS_KEY not in info:
+        info[LINK_DELTAS_KEY] = _LinkDeltas()
+    return info[LINK_DELTAS_KEY]
+
+
+def _add_action_link_weight(act, delta):
+    # Actions which are annotations are counted as items.
+    if act.item_twin_id is not None:
+        return
+    session = object_session(act)
+    link_deltas = _get_link_deltas(act)
+    # Uses the item if it is loaded in the session.
+    item = session.identity_map.get(identity_key(ItemMixin.cls, act.item_id))
+    if item is not None and 'page_url' in item.__dict__:
+        link_deltas.add(item.page_url, act.user_id, delta)
+    else:
+        link_deltas.by_item[act.item_id][act.user_id] += delta
+
+
+def _item_inserted(mapper, connection, item):
+    _get_link_deltas(item).add(item.page_url, item.author_id, 1)
+
+
+def _item_deleted(mapper, connection, item):
+    link_deltas = _get_link_deltas(item)
+    # The page url of the item is not found after it is deleted.
+    link_deltas.resolve_item(item.id, item.page_url)
+    link_deltas.add(item.page_url, item.author_id, -1)
+    # Actions on the item are not deleted with it, but they are not links
+    # any more (see hitsDB.count_links_on_pages()).
+    actions = ActionMixin.cls.__table__
+    rows = connection.execute(select([actions.c.user_id,
+                                      func.count(actions.c.id)]).where(and_(
+                                  actions.c.item_id == item.id,
+                                  actions.c.item_twin_id == None)
+                              ).group_by(actions.c.user_id))
+    for user_id, count in rows.fetchall():
+        link_deltas.add(item.page_url, user_id, -count)
+
+
+def _action_inserted(mapper, connection, act):
+    _add_action_link_weight(act, 1)
+
+
+def _action_deleted(mapper, connection, act):
+    _add_action_link_weight(act, -1)
+
+
+def _clear_link_deltas(session, flush_context, instances):
+    # Drops changes of a failed flush.
+    session.info.pop(LINK_DELTAS_KEY, None)
+
+
+def _apply_link_deltas(session, flush_context):
+    """ Writes changes of link weights collected during the flush, one
+    statement (or two for a new link) per changed link."""
+    link_deltas = session.info.pop(LINK_DELTAS_KEY, None)
+    if link_deltas is None:
+        return
+    if link_deltas.by_item:
+        Item = ItemMixin.cls
+        for item_id, page_url in query_in_chunks(
+                session.query(Item.id, Item.page_url), Item.id,
+                link_deltas.by_item.keys()):
+            link_deltas.resolve_item(item_id, page_url)
+    connection = session.connection(mapper=inspect(LinkMixin.cls))
+    for (page_url, user_id), delta in sorted(
+                                        link_deltas.deltas.iteritems()):
+        if delta != 0:
+            _add_link_weight(connection, page_url, user_id, delta)
+
+
+def listen_link_events():
+    """ Maintains the link table on every flush which inserts or deletes
+    items or actions: changes are collected per flush and written at its
+    end. Is called by api.bootstrap() if the link table is used, repeated
+    calls do nothing."""
+    for cls, name, fn in ((ItemMixin.cls, 'after_insert', _item_inserted),
+                          (ItemMixin.cls, 'before_delete', _item_deleted),
+                          (ActionMixin.cls, 'after_insert', _action_inserted),
+                          (ActionMixin.cls, 'before_delete', _action_deleted),
+                          (Session, 'before_flush', _clear_link_deltas),
+                          (Session, 'after_flush', _apply_link_deltas)):
+        if not event.contains(cls, name, fn):
+            event.listen(cls, name, fn)
+
+
 class ComputationMixin(object):
     """ After running offline computations for vandalism detection
     using Karger's algorithm, I need to store normalization coefficient.
@@ -298,14 +852,44 @@ class ComputationMixin(object):
 
     @classmethod
     def get(cls, name, session):
+        batch = get_batch(session)
+        if batch is not None and name in batch.computations:
+            return batch.computations[name]
         comp = session.query(cls).filter(
                      cls.name == name).first()
         if comp is None:
             comp = cls(name)
             session.add(comp)
-            session.flush()
+            flush(session)
+        if batch is not None:
+            batch.computations[name] = comp
         return comp
 
+    @classmethod
+    def get_normalization(cls, name, session):
+        """ Returns normalization of the computation, the value is cached
+        by the process for COMPUTATION_CACHE_TTL seconds."""
+        cached = _normalization_cache.get(name)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        version = _normalization_cache_version
+        normalization = cls.get(name, session).normalization
+        if version == _normalization_cache_version:
+            _normalization_cache[name] = (normalization,
+                                          time.time() + COMPUTATION_CACHE_TTL)
+        return normalization
+
+    @classmethod
+    def invalidate_cache(cls, name=None):
+        """ Drops cached normalization of the computation (of all computations
+        if name is None), should be called after a new value is written."""
+        global _normalization_cache_version
+        _normalization_cache_version += 1
+        if name is None:
+            _normalization_cache.clear()
+        else:
+            _normalization_cache.pop(name, None)
+
     def __init__(self, name):
         self.name = name
         self.normalization = 1.0
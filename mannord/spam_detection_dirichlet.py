@@ -1,10 +1,13 @@
 import numpy as np
 from models import (ActionMixin, UserMixin, ItemMixin,
                     ACTION_FLAG_SPAM, ACTION_FLAG_HAM,
-                    ACTION_UPVOTE, ACTION_DOWNVOTE)
+                    ACTION_UPVOTE, ACTION_DOWNVOTE, flush,
+                    add_to_session, delete_from_session)
 
 import spam_utils as su
 import graph_d as gd
+import graph_pool as gp
+import spam_detection_offline as so
 
 K_MAX = 10
 KARMA_USER_VOTE = 0.5
@@ -12,91 +15,233 @@ KARMA_USER_VOTE = 0.5
 THRESHOLD_DEFINITELY_SPAM = - np.inf
 THRESHOLD_DEFINITELY_HAM = np.inf
 BASE_SPAM_INCREMENT = 10
+# If True then offline computations use the array-backed graph
+# (gd.ArrayGraph), otherwise the object-based graph (gd.Graph) is used.
+USE_ARRAY_GRAPH = True
+# Offline iterations stop when the residual of items' c_n and c_p and users'
+# reliabilities between two iterations is less than TOLERANCE, K_MAX is an
+# upper bound on the number of iterations. If TOLERANCE is None then
+# exactly K_MAX iterations are made.
+TOLERANCE = 1e-5
+# If True then offline computations start from users' u_n, u_p and items'
+# weights stored by the previous run (see gd.Graph.compute_answers()).
+WARM_START = False
+# Incremental computations fall back to full offline computations if the
+# region of the graph around dirty items has more than INCREMENTAL_MAX_ITEMS
+# items.
+INCREMENTAL_MAX_ITEMS = 10000
+# If N_PROCESSES > 1 then connected components of the graph are computed in
+# a pool of N_PROCESSES processes (see gp.compute_answers_in_pool()).
+N_PROCESSES = 1
+# Types of actions which are edges of the graph.
+GRAPH_ACTION_TYPES = (ACTION_FLAG_SPAM, ACTION_FLAG_HAM, ACTION_UPVOTE)
+# Number of rows fetched at once when the graph is built (see yield_per()).
+ROWS_PER_FETCH = 1000
+# If True then the full offline run writes results back with bulk updates
+# (see _bulk_from_graph_to_db()), otherwise through ORM objects.
+BULK_WRITE_BACK = True
 
-def run_offline_computations(session):
+def run_offline_computations(session, array_graph=None, warm_start=None,
+                             n_processes=None):
     """ The function
                 - fetches action infromation from the db
                 - given action information it runs Karger's algorithm
                 - it marks anctions and annotations based on the output
                 - it writes information back to the db
+
+    The function returns the graph, its n_iterations and residual fields
+    tell how many iterations were made and what the final residual is.
+    If array_graph is True the graph is computed by gd.ArrayGraph, if it is
+    False by gd.Graph; by default USE_ARRAY_GRAPH decides.
+    If warm_start is True the algorithm starts from u_n, u_p and weights
+    saved in the db by the previous run; by default WARM_START decides.
+    If n_processes > 1 (by default N_PROCESSES) then connected components of
+    the graph are computed in a pool of processes, the result is the same.
     """
-    ActionClass = ActionMixin.cls
-    ItemClass = ItemMixin.cls
-    # Creates graph
-    graph = gd.Graph()
-    # Fetches all actions
-    actions = ActionClass.sd_get_actions_offline_spam_detect(session)
-    items = ItemClass.sd_get_items_offline_spam_detect(session)
-    # Adds info to the graph object.
-    _add_spam_info_to_graph_d(graph, items, actions)
-    # Runs vandalism detection!
-    graph.compute_answers(K_MAX)
+    # Builds the graph from streamed rows.
+    graph = _create_graph(array_graph)
+    _add_spam_info_to_graph_d(graph, _get_item_rows(session),
+                              _get_action_rows(session))
+    _compute_answers(graph, warm_start, n_processes)
     # Puts information back to the db.
+    if BULK_WRITE_BACK:
+        _bulk_from_graph_to_db(graph, session)
+    else:
+        # Items and actions are streamed.
+        items = ItemMixin.cls.sd_get_items_offline_spam_detect(session)
+        actions = ActionMixin.cls.sd_get_actions_offline_spam_detect(session)
+        _from_graph_to_db(graph, items, actions)
+    # Saves information back to the DB
+    session.flush()
+    so.clear_dirty_users('sd', session)
+    return graph
+
+
+def run_incremental_computations(session, array_graph=None, warm_start=None,
+                                 n_processes=None):
+    """ The function runs offline computations only on the region of the
+    graph which contains items changed since the last computations (items
+    with sd_dirty flag and items of users with sd_dirty flag, see
+    _get_dirty_region()). Users and items outside
+    the region are not fetched and not written back. Messages never leave
+    the region, so the result is the same as the result of the full run;
+    run_offline_computations() is still supposed to run periodically to
+    reconcile changes the incremental mode does not track (deleted items).
+
+    The function returns the graph or None if there are no dirty items.
+    If the region has more than INCREMENTAL_MAX_ITEMS items then the full
+    offline computations are run instead.
+    """
+    items, actions, user_ids = _get_dirty_region(session)
+    if items is None:
+        return run_offline_computations(session, array_graph=array_graph,
+                                        warm_start=warm_start,
+                                        n_processes=n_processes)
+    if len(items) == 0:
+        so.clear_dirty_users('sd', session, user_ids)
+        return None
+    graph = _create_graph(array_graph)
+    item_rows = [(it.id, it.author_id, it.author.sd_base_u_n,
+                  it.author.sd_base_u_p, it.author.sd_karma_user_u_n,
+                  it.author.sd_karma_user_u_p, it.sd_weight) for it in items]
+    action_rows = [(act.user_id, act.item_id, act.type,
+                    act.user.sd_base_u_n, act.user.sd_base_u_p,
+                    act.user.sd_u_n, act.user.sd_u_p, act.item.sd_weight)
+                   for act in actions if act.type in GRAPH_ACTION_TYPES]
+    _add_spam_info_to_graph_d(graph, item_rows, action_rows)
+    _compute_answers(graph, warm_start, n_processes)
     _from_graph_to_db(graph, items, actions)
     # Saves information back to the DB
     session.flush()
+    so.clear_dirty_users('sd', session, user_ids)
+    return graph
 
 
-def _add_spam_info_to_graph_d(graph, items, actions):
-    for act in actions:
-        if act.type == ACTION_FLAG_SPAM:
+def _create_graph(array_graph):
+    if array_graph is None:
+        array_graph = USE_ARRAY_GRAPH
+    return so.create_graph(gd, array_graph)
+
+
+def _compute_answers(graph, warm_start, n_processes):
+    """ Runs vandalism detection on the graph."""
+    if warm_start is None:
+        warm_start = WARM_START
+    if n_processes is None:
+        n_processes = N_PROCESSES
+    if n_processes > 1:
+        gp.compute_answers_in_pool(graph, K_MAX, n_processes, tol=TOLERANCE,
+                                   warm_start=warm_start)
+    else:
+        graph.compute_answers(K_MAX, tol=TOLERANCE, warm_start=warm_start)
+
+
+def _get_action_rows(session):
+    """ Returns an iterator over rows (user id, item id, action type, user's
+    base u_n, base u_p, u_n, u_p, item's weight) of actions which
+    participate in offline computations. Rows are fetched by one query with
+    joins, ROWS_PER_FETCH rows at a time."""
+    columns = ('sd_base_u_n', 'sd_base_u_p', 'sd_u_n', 'sd_u_p')
+    return so.get_action_rows('sd', session, columns, GRAPH_ACTION_TYPES,
+                              ROWS_PER_FETCH)
+
+
+def _get_item_rows(session):
+    """ Returns an iterator over rows (item id, author id, author's base u_n,
+    base u_p, u_n and u_p of the author's karma user, item's weight) of
+    items which participate in offline computations."""
+    columns = ('sd_base_u_n', 'sd_base_u_p', 'sd_karma_user_u_n',
+               'sd_karma_user_u_p')
+    return so.get_item_rows('sd', session, columns, ROWS_PER_FETCH)
+
+
+def _get_dirty_region(session):
+    """ Returns a list of items, a list of actions of the region of the
+    graph which contains all dirty items and items of dirty users, and ids
+    of dirty users, see so.get_dirty_region(). If the region has more than
+    INCREMENTAL_MAX_ITEMS items then the function returns (None, None, None).
+    """
+    return so.get_dirty_region('sd', session, GRAPH_ACTION_TYPES,
+                               INCREMENTAL_MAX_ITEMS)
+
+
+def _add_spam_info_to_graph_d(graph, item_rows, action_rows):
+    """ Rows are tuples described in _get_item_rows() and _get_action_rows().
+    """
+    # u_n, u_p and weights stored by the previous run are used for warm start.
+    for row in action_rows:
+        user_id, item_id, act_type, base_u_n, base_u_p, u_n, u_p, weight = row
+        if act_type == ACTION_FLAG_SPAM:
             # Spam flag!
-            graph.add_answer(act.user_id, act.item_id, -1,
-              base_u_n = act.user.sd_base_u_n, base_u_p = act.user.sd_base_u_p)
-        elif act.type == ACTION_FLAG_HAM or act.type == ACTION_UPVOTE:
+            answr = -1
+        elif act_type == ACTION_FLAG_HAM or act_type == ACTION_UPVOTE:
             # Ham flag!
-            graph.add_answer(act.user_id, act.item_id, 1,
-              base_u_n = act.user.sd_base_u_n, base_u_p = act.user.sd_base_u_p)
+            answr = 1
         else:
-            act.sk_frozen = True
             continue
-    for it in items:
+        u_n, u_p = _warm_u_n_u_p(u_n, u_p)
+        graph.add_answer(user_id, item_id, answr,
+          base_u_n = base_u_n, base_u_p = base_u_p,
+          warm_u_n = u_n, warm_u_p = u_p, warm_weight = weight)
+    for item_id, author_id, base_u_n, base_u_p, u_n, u_p, weight in item_rows:
         # Creates karma user (old "null" user)
-        graph.add_answer('-' + it.author.id, it.id, KARMA_USER_VOTE,
-          base_u_n = it.author.sd_base_u_n, base_u_p = it.author.sd_base_u_p)
+        u_n, u_p = _warm_u_n_u_p(u_n, u_p)
+        graph.add_answer('-' + author_id, item_id, KARMA_USER_VOTE,
+          base_u_n = base_u_n, base_u_p = base_u_p,
+          warm_u_n = u_n, warm_u_p = u_p, warm_weight = weight)
+
+
+def _warm_u_n_u_p(u_n, u_p):
+    """ Returns stored u_n and u_p for warm start or (None, None) if they
+    were not computed yet (both are zero or None)."""
+    if not u_n and not u_p:
+        return None, None
+    return u_n or 0, u_p or 0
 
 
 def _from_graph_to_db(graph, items, actions):
-    # Fills users' fileds.
-    for act in actions:
-        u = act.user
-        user_d = graph.get_user(u.id)
-        u.sd_u_n = user_d.u_n
-        u.sd_u_p = user_d.u_p
-        u.sd_reliab = user_d.reliability
+    """ Writes results to ORM objects. items and actions are iterated once,
+    items first, so they can be streamed (see query_in_pages())."""
     # Detects and mark frozen items. Fills items' fileds.
     for it in items:
         it.sd_frozen = False
+        it.sd_dirty = False
         # item_d represents item "it" in the algorithm, it contains spam info.
         item_d = graph.get_item(it.id)
         it.sd_weight = item_d.weight
         # Marks spam, ham, or marks for metamoderation.
         su.mark_spam_ham_or_mm(it, algo_type=su.ALGO_DIRICHLET)
         # Marks off items actions from offline computation
-        if (it.sk_weight > THRESHOLD_DEFINITELY_HAM or
-            it.sk_weight < THRESHOLD_DEFINITELY_SPAM):
-            it.sk_frozen = True
+        if (it.sd_weight > THRESHOLD_DEFINITELY_HAM or
+            it.sd_weight < THRESHOLD_DEFINITELY_SPAM):
+            it.sd_frozen = True
         # Saves reliability of a spam karma user related to an author of the item
         # Reliability user has "-" in from of it's id.
         user_d = graph.get_user('-' + it.author.id)
         it.author.sd_karma_user_reliab = user_d.reliability
         it.author.sd_karma_user_u_n = user_d.u_n
         it.author.sd_karma_user_u_p = user_d.u_p
-
-    # Some items were marked to be excluded in future offline computations,
-    # based on it we need to mark corresponding action and update base
-    # spam reliability for users who performed actions.
+    # Fills users' fileds.
     for act in actions:
+        if act.type not in GRAPH_ACTION_TYPES:
+            # The action is excluded from future offline computations.
+            act.sd_frozen = True
+            continue
         u = act.user
+        user_d = graph.get_user(u.id)
+        u.sd_u_n = user_d.u_n
+        u.sd_u_p = user_d.u_p
+        u.sd_reliab = user_d.reliability
+        # Some items were marked to be excluded in future offline
+        # computations, based on it we need to mark the action and update
+        # base spam reliability of the user who performed it.
         it = act.item
         if it.sd_frozen:
             act.sd_frozen = True
             if act.type == ACTION_FLAG_SPAM:
                 act_val = -1
-            elif act.type == ACTION_FLAG_HAM or act.type == ACTION_UPVOTE:
-                act_val = 1
             else:
-                continue
+                act_val = 1
             if it.is_spam:
                 neg_val, pos_val = gd.neg_first(0, act_val * (-BASE_SPAM_INCREMENT))
                 u.sd_base_u_n += neg_val
@@ -111,6 +256,36 @@ def _from_graph_to_db(graph, items, actions):
                 it.author.sd_karma_user_base_u_p += pos_val
 
 
+def _bulk_from_graph_to_db(graph, session):
+    """ Does the same as _from_graph_to_db() for all items and actions which
+    participate in offline computations, see so.bulk_from_graph_to_db().
+    """
+    so.bulk_from_graph_to_db(graph, session, 'sd', su.ALGO_DIRICHLET,
+                             GRAPH_ACTION_TYPES, THRESHOLD_DEFINITELY_SPAM,
+                             THRESHOLD_DEFINITELY_HAM, BASE_SPAM_INCREMENT,
+                             _get_user_values, _split_base_delta,
+                             ROWS_PER_FETCH)
+
+
+def _get_user_values(user_d):
+    """ Returns fields of a user of the graph, fields of a karma user are
+    fields of its author."""
+    if user_d.id.startswith('-'):
+        # Spam karma user related to an author.
+        return {'sd_karma_user_reliab': user_d.reliability,
+                'sd_karma_user_u_n': user_d.u_n,
+                'sd_karma_user_u_p': user_d.u_p}
+    return {'sd_u_n': user_d.u_n, 'sd_u_p': user_d.u_p,
+            'sd_reliab': user_d.reliability}
+
+
+def _split_base_delta(delta):
+    """ Returns increments of base fields for a change of base reliability.
+    """
+    neg, pos = gd.neg_first(0, delta)
+    return {'base_u_n': neg, 'base_u_p': pos}
+
+
 def flag_spam(item, user, timestamp, session):
     # Check whether the annotation was flagged as spam.
     act = ActionMixin.cls.get_action(item.id, user.id, ACTION_FLAG_SPAM, session)
@@ -127,7 +302,7 @@ def flag_spam(item, user, timestamp, session):
         # Undoes effects of ham flag.
         _undo_spam_ham_flag(item, user, session, spam_flag=False)
         # Deletes the ham aciton.
-        session.delete(act)
+        delete_from_session(act, session)
         # Flags the item as spam.
         _raise_spam_ham_flag_fresh(item, user, timestamp, session, spam_flag=True)
 
@@ -158,11 +333,13 @@ def _raise_spam_ham_flag_fresh(item, user, timestamp, session, spam_flag=True):
     if spam_flag:
         answr = -1
         act = ActionMixin.cls(item.id, user.id, ACTION_FLAG_SPAM, timestamp)
-        item.spam_flag_counter += 1
+        ItemMixin.cls.increment_spam_flag_counter(item.id, session, 1)
     else:
         answr = 1
         act = ActionMixin.cls(item.id, user.id, ACTION_FLAG_HAM, timestamp)
-    session.add(act)
+    add_to_session(act, session)
+    # The graph changed, so the item is recomputed by incremental computations.
+    su.mark_dirty(item)
     # If the item is known as spam/ham then we change
     # the user's spam base u_n and u_p.
     if item.sd_frozen:
@@ -170,9 +347,11 @@ def _raise_spam_ham_flag_fresh(item, user, timestamp, session, spam_flag=True):
         neg, pos = gd.neg_first(0, val)
         user.sd_base_u_n += neg
         user.sd_base_u_p += pos
+        # Other items of the user are affected by the base values.
+        su.mark_user_dirty(user)
         # Mark action to not use in offline spam detection.
-        act.sk_frozen = True
-        session.flush()
+        act.sd_frozen = True
+        flush(session)
         return
     # Okay, item participate in offline spam detection.
     # Updating weight of the item
@@ -189,19 +368,20 @@ def _raise_spam_ham_flag_fresh(item, user, timestamp, session, spam_flag=True):
     user.sd_reliab = gd.get_reliability(user.sd_u_n, user.sd_u_p)
     # Marks the item as spam or ham, or marks for metamoderation.
     su.mark_spam_ham_or_mm(item, algo_type=su.ALGO_DIRICHLET)
-    session.flush()
+    flush(session)
 
 
 def _undo_spam_ham_flag(item, user, session, spam_flag=False):
     answr = -1 if spam_flag else 1
+    su.mark_dirty(item)
     if item.sd_frozen:
         val = np.sign(item.sd_weight) * answr * BASE_SPAM_INCREMENT
         neg, pos = gd.neg_first(0, val)
         user.sd_base_u_n -= neg
         user.sd_base_u_p -= pos
-        # Mark action to not use in offline spam detection.
-        act.sk_frozen = True
-        session.flush()
+        # Other items of the user are affected by the base values.
+        su.mark_user_dirty(user)
+        flush(session)
         return
     # Okay, item participate in offline spam detection.
     # Updating weight of the item
@@ -218,15 +398,15 @@ def _undo_spam_ham_flag(item, user, session, spam_flag=False):
     user.sd_reliab = gd.get_reliability(user.sd_u_n, user.sd_u_p)
     # Marks the item as spam or ham, or marks for metamoderation.
     su.mark_spam_ham_or_mm(item, algo_type=su.ALGO_DIRICHLET)
-    session.flush()
+    flush(session)
 
 
 def _delete_spam_action(act, session):
     """ Deletes spam action from the db, it takes care of spam flag counter. """
     if act is None:
         return
-    act.item.spam_flag_counter -= 1
-    session.delete(act)
+    ItemMixin.cls.increment_spam_flag_counter(act.item_id, session, -1)
+    delete_from_session(act, session)
 
 
 def delete_spam_item_by_author(item, session):
@@ -234,20 +414,24 @@ def delete_spam_item_by_author(item, session):
     if item.sd_frozen:
         for act in actions:
             if act.type == ACTION_FLAG_SPAM or act.type == ACTION_FLAG_HAM:
-                session.delete(act)
-        session.delete(item)
-        session.flush()
+                delete_from_session(act, session)
+        delete_from_session(item, session)
+        flush(session)
         return
+    # The author's karma user loses the item.
+    su.mark_user_dirty(item.author)
     for act in actions:
         if act.type == ACTION_FLAG_SPAM:
             # Increases spam reliability
             act.user.sd_base_u_p += BASE_SPAM_INCREMENT
-            session.delete(act)
+            su.mark_user_dirty(act.user)
+            delete_from_session(act, session)
         elif act.type == ACTION_FLAG_HAM:
             # Reduces spam reliability of the author
             act.user.sd_base_u_n += BASE_SPAM_INCREMENT
-            session.delete(act)
+            su.mark_user_dirty(act.user)
+            delete_from_session(act, session)
         else:
             pass
-    session.delete(item)
-    session.flush()
+    delete_from_session(item, session)
+    flush(session)
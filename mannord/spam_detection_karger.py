@@ -2,10 +2,12 @@ import numpy as np
 from models import (ActionMixin, UserMixin, ItemMixin,
                     ComputationMixin, COMPUTATION_SK_NAME,
                     ACTION_FLAG_SPAM, ACTION_FLAG_HAM,
-                    ACTION_UPVOTE, ACTION_DOWNVOTE)
+                    ACTION_UPVOTE, ACTION_DOWNVOTE, flush,
+                    add_to_session, delete_from_session)
 
 import spam_utils as su
 import graph_k as gk
+import spam_detection_offline as so
 
 
 K_MAX = 11
@@ -16,9 +18,35 @@ THRESHOLD_DEFINITELY_HAM = np.inf
 # Increment for base reliability, user's base reliability changes
 # by this amound every time he make an action on an spam/ham annotation.
 BASE_SPAM_INCREMENT = 1
+# If True then offline computations use the array-backed graph
+# (gk.ArrayGraph), otherwise the object-based graph (gk.Graph) is used.
+USE_ARRAY_GRAPH = True
+# Offline iterations stop when the residual of items' weights and users'
+# reliabilities between two iterations is less than TOLERANCE, K_MAX is an
+# upper bound on the number of iterations. If TOLERANCE is None then
+# exactly K_MAX iterations are made.
+TOLERANCE = 1e-4
+# If True then offline computations start from users' reliabilities and
+# items' weights stored by the previous run (see gk.Graph.compute_answers()).
+WARM_START = False
+# Incremental computations fall back to full offline computations if the
+# region of the graph around dirty items has more than INCREMENTAL_MAX_ITEMS
+# items.
+INCREMENTAL_MAX_ITEMS = 10000
+# If N_PROCESSES > 1 then connected components of the graph are computed in
+# a pool of N_PROCESSES processes (see gk.compute_answers_in_pool()).
+N_PROCESSES = 1
+# Types of actions which are edges of the graph.
+GRAPH_ACTION_TYPES = (ACTION_FLAG_SPAM, ACTION_FLAG_HAM, ACTION_UPVOTE)
+# Number of rows fetched at once when the graph is built (see yield_per()).
+ROWS_PER_FETCH = 1000
+# If True then the full offline run writes results back with bulk updates
+# (see _bulk_from_graph_to_db()), otherwise through ORM objects.
+BULK_WRITE_BACK = True
 
 
-def run_offline_computations(session):
+def run_offline_computations(session, array_graph=None, warm_start=None,
+                             n_processes=None):
     """ The function
                 - fetches action infromation from the db
                 - given action information it runs Karger's algorithm
@@ -30,58 +58,169 @@ def run_offline_computations(session):
     It is possible to make the algorithm work on any scale (process one
     annotation at a time, saving intermediate result into the db, be careful
     about the order, etc.), but premature optimization is evil!
+
+    The function returns the graph, its n_iterations and residual fields
+    tell how many iterations were made and what the final residual is.
+    If array_graph is True the graph is computed by gk.ArrayGraph, if it is
+    False by gk.Graph; by default USE_ARRAY_GRAPH decides.
+    If warm_start is True the algorithm starts from reliabilities and weights
+    saved in the db by the previous run; by default WARM_START decides.
+    If n_processes > 1 (by default N_PROCESSES) then connected components of
+    the graph are computed in a pool of processes. They iterate in
+    lock-step with the normalization of reliabilities computed over the
+    whole graph, so the result is the same (see gk.compute_answers_in_pool()).
     """
-    ActionClass = ActionMixin.cls
-    ItemClass = ItemMixin.cls
-    # Creates graph
-    graph = gk.Graph()
-    # Fetches all actions
-    actions = ActionClass.sk_get_actions_offline_spam_detect(session)
-    items = ItemClass.sk_get_items_offline_spam_detect(session)
-    # Adds info to the graph object.
-    _add_spam_info_to_graph_k(graph, items, actions)
-    # Runs vandalism detection!
-    graph.compute_answers(K_MAX)
+    # Builds the graph from streamed rows.
+    graph = _create_graph(array_graph)
+    _add_spam_info_to_graph_k(graph, _get_item_rows(session),
+                              _get_action_rows(session))
+    comp = ComputationMixin.cls.get(COMPUTATION_SK_NAME, session)
+    _compute_answers(graph, comp, warm_start, n_processes)
     # Puts information back to the db.
+    if BULK_WRITE_BACK:
+        _bulk_from_graph_to_db(graph, session, comp)
+    else:
+        # Items and actions are streamed.
+        items = ItemMixin.cls.sk_get_items_offline_spam_detect(session)
+        actions = ActionMixin.cls.sk_get_actions_offline_spam_detect(session)
+        _from_graph_to_db(graph, items, actions, comp)
+    # Saves information back to the DB
+    session.flush()
+    so.clear_dirty_users('sk', session)
+    # Online flags read normalization from the cache.
+    ComputationMixin.cls.invalidate_cache(COMPUTATION_SK_NAME)
+    return graph
+
+
+def run_incremental_computations(session, array_graph=None, warm_start=None,
+                                 n_processes=None):
+    """ The function runs offline computations only on the region of the
+    graph which contains items changed since the last computations (items
+    with sk_dirty flag and items of users with sk_dirty flag, see
+    _get_dirty_region()). Users and items outside
+    the region are not fetched and not written back.
+    Normalization of reliabilities is not recomputed, the value stored by
+    the last full run is used. run_offline_computations() is still
+    supposed to run periodically, it reconciles everything the incremental
+    mode does not track (normalization, deleted items).
+
+    The function returns the graph or None if there are no dirty items.
+    If the region has more than INCREMENTAL_MAX_ITEMS items then the full
+    offline computations are run instead.
+    """
+    items, actions, user_ids = _get_dirty_region(session)
+    if items is None:
+        return run_offline_computations(session, array_graph=array_graph,
+                                        warm_start=warm_start,
+                                        n_processes=n_processes)
+    if len(items) == 0:
+        so.clear_dirty_users('sk', session, user_ids)
+        return None
+    graph = _create_graph(array_graph)
+    item_rows = [(it.id, it.author_id, it.author.sk_karma_user_base_reliab,
+                  it.author.sk_karma_user_reliab, it.sk_weight) for it in items]
+    action_rows = [(act.user_id, act.item_id, act.type,
+                    act.user.sk_base_reliab, act.user.sk_reliab,
+                    act.item.sk_weight) for act in actions
+                   if act.type in GRAPH_ACTION_TYPES]
+    _add_spam_info_to_graph_k(graph, item_rows, action_rows)
     comp = ComputationMixin.cls.get(COMPUTATION_SK_NAME, session)
+    _compute_answers(graph, comp, warm_start, n_processes,
+                     fixed_normaliz=True)
     _from_graph_to_db(graph, items, actions, comp)
     # Saves information back to the DB
     session.flush()
+    so.clear_dirty_users('sk', session, user_ids)
+    return graph
+
+
+def _create_graph(array_graph):
+    if array_graph is None:
+        array_graph = USE_ARRAY_GRAPH
+    return so.create_graph(gk, array_graph)
+
+
+def _compute_answers(graph, comp, warm_start, n_processes,
+                     fixed_normaliz=False):
+    """ Runs vandalism detection on the graph."""
+    if warm_start is None:
+        warm_start = WARM_START
+    if n_processes is None:
+        n_processes = N_PROCESSES
+    normaliz = comp.normalization if fixed_normaliz else None
+    if n_processes > 1:
+        gk.compute_answers_in_pool(graph, K_MAX, n_processes,
+                                   normaliz=normaliz, tol=TOLERANCE,
+                                   warm_start=warm_start)
+    else:
+        graph.compute_answers(K_MAX, tol=TOLERANCE, warm_start=warm_start,
+                              normaliz=normaliz)
 
-def _add_spam_info_to_graph_k(graph, items, actions):
+
+def _get_action_rows(session):
+    """ Returns an iterator over rows (user id, item id, action type, user's
+    base reliability, user's reliability, item's weight) of actions which
+    participate in offline computations. Rows are fetched by one query with
+    joins, ROWS_PER_FETCH rows at a time."""
+    return so.get_action_rows('sk', session, ('sk_base_reliab', 'sk_reliab'),
+                              GRAPH_ACTION_TYPES, ROWS_PER_FETCH)
+
+
+def _get_item_rows(session):
+    """ Returns an iterator over rows (item id, author id, base reliability
+    of the author's karma user, reliability of the author's karma user,
+    item's weight) of items which participate in offline computations."""
+    columns = ('sk_karma_user_base_reliab', 'sk_karma_user_reliab')
+    return so.get_item_rows('sk', session, columns, ROWS_PER_FETCH)
+
+
+def _get_dirty_region(session):
+    """ Returns a list of items, a list of actions of the region of the
+    graph which contains all dirty items and items of dirty users, and ids
+    of dirty users, see so.get_dirty_region(). If the region has more than
+    INCREMENTAL_MAX_ITEMS items then the function returns (None, None, None).
+    """
+    return so.get_dirty_region('sk', session, GRAPH_ACTION_TYPES,
+                               INCREMENTAL_MAX_ITEMS)
+
+
+def _add_spam_info_to_graph_k(graph, item_rows, action_rows):
     """ Adds spam information a graph for detection using Karger's algorithm.
+    Rows are tuples described in _get_item_rows() and _get_action_rows().
     """
     # Adds flag information (graph.add_answer(...)) to the graph object.
-    for act in actions:
-        if act.type == ACTION_FLAG_SPAM:
+    # Reliabilities and weights stored by the previous run are used for warm
+    # start, zero reliability means that it was not computed yet.
+    for user_id, item_id, act_type, base_reliab, reliab, weight in action_rows:
+        if act_type == ACTION_FLAG_SPAM:
             # Spam flag!
-            graph.add_answer(act.user_id, act.item_id, -1,
-                base_reliability = act.user.sk_base_reliab)
-        elif act.type == ACTION_FLAG_HAM or act.type == ACTION_UPVOTE:
+            answr = -1
+        elif act_type == ACTION_FLAG_HAM or act_type == ACTION_UPVOTE:
             # Ham flag!
-            graph.add_answer(act.user_id, act.item_id, 1,
-                base_reliability = act.user.sk_base_reliab)
+            answr = 1
         else:
             # The action does not related to vandalizm detection, so ignore it.
-            act.sk_frozen = True
             continue
-    for it in items:
+        graph.add_answer(user_id, item_id, answr,
+                         base_reliability = base_reliab,
+                         warm_reliability = reliab or None,
+                         warm_weight = weight)
+    for item_id, author_id, base_reliab, reliab, weight in item_rows:
         # Creates karma user.
-        graph.add_answer('-' + it.author.id, it.id, gk.KARMA_USER_VOTE,
-                   base_reliability = it.author.sk_karma_user_base_reliab)
+        graph.add_answer('-' + author_id, item_id, gk.KARMA_USER_VOTE,
+                         base_reliability = base_reliab,
+                         warm_reliability = reliab or None,
+                         warm_weight = weight)
 
 def _from_graph_to_db(graph, items, actions, computation):
+    """ Writes results to ORM objects. items and actions are iterated once,
+    items first, so they can be streamed (see query_in_pages())."""
     # Remembers normalization coefficient.
     computation.normalization = graph.normaliz
-    # Fills users' fileds.
-    for act in actions:
-        u = act.user
-        user_k = graph.get_user(u.id)
-        u.sk_reliab_raw = user_k.reliability_raw
-        u.sk_reliab = user_k.reliability
     # Detects and mark frozen items. Fills items' fileds.
     for it in items:
         it.sk_frozen = False
+        it.sk_dirty = False
         # item_k represents item "it" in the algorithm, it contains spam info.
         item_k = graph.get_item(it.id)
         it.sk_weight = item_k.weight
@@ -94,21 +233,27 @@ def _from_graph_to_db(graph, items, actions, computation):
         # Saves reliability of a spam karma user related to an author of the item
         k_user = graph.get_user('-' + it.author.id)
         it.author.sk_karma_user_reliab = k_user.reliability
-
-    # Some items were marked to be excluded in future offline computations,
-    # based on it we need to mark corresponding action and update base
-    # spam reliability for users who performed actions.
+    # Fills users' fileds.
     for act in actions:
+        if act.type not in GRAPH_ACTION_TYPES:
+            # The action does not related to vandalizm detection, so it is
+            # excluded from future offline computations.
+            act.sk_frozen = True
+            continue
         u = act.user
+        user_k = graph.get_user(u.id)
+        u.sk_reliab_raw = user_k.reliability_raw
+        u.sk_reliab = user_k.reliability
+        # Some items were marked to be excluded in future offline
+        # computations, based on it we need to mark the action and update
+        # base spam reliability of the user who performed it.
         it = act.item
         if it.sk_frozen:
             act.sk_frozen = True
             if act.type == ACTION_FLAG_SPAM:
                 act_val = -1
-            elif act.type == ACTION_FLAG_HAM or act.type == ACTION_UPVOTE:
-                act_val = 1
             else:
-                continue
+                act_val = 1
             if it.is_spam:
                 u.sk_base_reliab += act_val * (-BASE_SPAM_INCREMENT)
                 it.author.sk_karma_user_base_reliab += act_val * (-BASE_SPAM_INCREMENT)
@@ -117,6 +262,35 @@ def _from_graph_to_db(graph, items, actions, computation):
                 it.author.sk_karma_user_base_reliab += act_val * BASE_SPAM_INCREMENT
 
 
+def _bulk_from_graph_to_db(graph, session, computation):
+    """ Does the same as _from_graph_to_db() for all items and actions which
+    participate in offline computations, see so.bulk_from_graph_to_db().
+    """
+    # Remembers normalization coefficient.
+    computation.normalization = graph.normaliz
+    so.bulk_from_graph_to_db(graph, session, 'sk', su.ALGO_KARGER,
+                             GRAPH_ACTION_TYPES, THRESHOLD_DEFINITELY_SPAM,
+                             THRESHOLD_DEFINITELY_HAM, BASE_SPAM_INCREMENT,
+                             _get_user_values, _split_base_delta,
+                             ROWS_PER_FETCH)
+
+
+def _get_user_values(user_k):
+    """ Returns fields of a user of the graph, fields of a karma user are
+    fields of its author."""
+    if user_k.id.startswith('-'):
+        # Reliability of a spam karma user related to an author.
+        return {'sk_karma_user_reliab': user_k.reliability}
+    return {'sk_reliab_raw': user_k.reliability_raw,
+            'sk_reliab': user_k.reliability}
+
+
+def _split_base_delta(delta):
+    """ Returns increments of base fields for a change of base reliability.
+    """
+    return {'base_reliab': delta}
+
+
 def flag_spam(item, user, timestamp, session):
     # Check whether the annotation was flagged as spam.
     act = ActionMixin.cls.get_action(item.id, user.id, ACTION_FLAG_SPAM, session)
@@ -135,7 +309,7 @@ def flag_spam(item, user, timestamp, session):
         # Undoes effects of ham flag.
         _undo_spam_ham_flag(item, user, session, spam_flag=False)
         # Deletes the ham aciton.
-        session.delete(act)
+        delete_from_session(act, session)
         # Flags the item as spam.
         _raise_spam_ham_flag_fresh(item, user, timestamp, session, spam_flag=True)
 
@@ -169,10 +343,13 @@ def _undo_spam_ham_flag(item, user, session, spam_flag=True):
         spam flag then spam_flag=True; spam_flag=False for reverting ham flag.
     """
     answr = -1 if spam_flag else 1
+    su.mark_dirty(item)
     if item.sk_frozen:
         # The item is known as spam/ham.
         val = np.sign(item.sk_weight) * answr * BASE_SPAM_INCREMENT
         user.sk_base_reliab -= val
+        # Other items of the user are affected by the base reliability.
+        su.mark_user_dirty(user)
         return
     # Okay, item participate in offline spam detection.
     # Updating weight of the item
@@ -185,11 +362,11 @@ def _undo_spam_ham_flag(item, user, session, spam_flag=True):
     else:
         user.sk_reliab = user.sk_reliab_raw
     # Normalization!
-    comp = ComputationMixin.cls.get(COMPUTATION_SK_NAME, session)
-    user.sk_reliab /= comp.normalization
+    user.sk_reliab /= ComputationMixin.cls.get_normalization(
+                                            COMPUTATION_SK_NAME, session)
     # Marks the item as spam or ham, or marks for metamoderation.
     su.mark_spam_ham_or_mm(item, algo_type=su.ALGO_KARGER)
-    session.flush()
+    flush(session)
 
 
 def _raise_spam_ham_flag_fresh(item, user, timestamp,
@@ -203,19 +380,23 @@ def _raise_spam_ham_flag_fresh(item, user, timestamp,
     if spam_flag:
         answr = -1
         act = ActionMixin.cls(item.id, user.id, ACTION_FLAG_SPAM, timestamp)
-        item.spam_flag_counter += 1
+        ItemMixin.cls.increment_spam_flag_counter(item.id, session, 1)
     else:
         answr = 1
         act = ActionMixin.cls(item.id, user.id, ACTION_FLAG_HAM, timestamp)
-    session.add(act)
+    add_to_session(act, session)
+    # The graph changed, so the item is recomputed by incremental computations.
+    su.mark_dirty(item)
     # If the item is known as spam/ham then we change
     # the user's spam base reliability.
     if item.sk_frozen:
         val = np.sign(item.sk_weight) * answr * BASE_SPAM_INCREMENT
         user.sk_base_reliab += val
+        # Other items of the user are affected by the base reliability.
+        su.mark_user_dirty(user)
         # Mark action to not use in offline spam detection.
         act.sk_frozen = True
-        session.flush()
+        flush(session)
         return
     # Okay, item participate in offline spam detection.
     # Updating weight of the item
@@ -228,19 +409,19 @@ def _raise_spam_ham_flag_fresh(item, user, timestamp,
     else:
         user.sk_reliab = user.sk_reliab_raw
     # Normalization!
-    comp = ComputationMixin.cls.get(COMPUTATION_SK_NAME, session)
-    user.sk_reliab /= comp.normalization
+    user.sk_reliab /= ComputationMixin.cls.get_normalization(
+                                            COMPUTATION_SK_NAME, session)
     # Marks the item as spam or ham, or marks for metamoderation.
     su.mark_spam_ham_or_mm(item, algo_type=su.ALGO_KARGER)
-    session.flush()
+    flush(session)
 
 
 def _delete_spam_action(act, session):
     """ Deletes spam action from the db, it takes care of spam flag counter. """
     if act is None:
         return
-    act.item.spam_flag_counter -= 1
-    session.delete(act)
+    ItemMixin.cls.increment_spam_flag_counter(act.item_id, session, -1)
+    delete_from_session(act, session)
 
 
 def fetch_n_items_for_mm(n, session):
@@ -258,22 +439,26 @@ def delete_spam_item_by_author(item, session):
         # In this case the user's karma user also has changes to its reliability
         # But it is unlikely case. We want to not damage user's reputation
         # only if delete the item fast enough.
-        session.delete(item)
+        delete_from_session(item, session)
         for act in actions:
             if act.type == ACTION_FLAG_SPAM or act.type == ACTION_FLAG_HAM:
-                session.delete(act)
-        session.flush()
+                delete_from_session(act, session)
+        flush(session)
         return
+    # The author's karma user loses the item.
+    su.mark_user_dirty(item.author)
     for act in actions:
         if act.type == ACTION_FLAG_SPAM:
             # Increases spam reliability
             act.user.sk_base_reliab += BASE_SPAM_INCREMENT
-            session.delete(act)
+            su.mark_user_dirty(act.user)
+            delete_from_session(act, session)
         elif act.type == ACTION_FLAG_HAM:
             # Reduces spam reliability of the author
             act.user.sk_base_reliab -= BASE_SPAM_INCREMENT
-            session.delete(act)
+            su.mark_user_dirty(act.user)
+            delete_from_session(act, session)
         else:
             pass
-    session.delete(item)
-    session.flush()
+    delete_from_session(item, session)
+    flush(session)
@@ -1,6 +1,84 @@
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy import (Column, Integer, Float, String, Boolean,
-                        ForeignKey, DateTime, Sequence, and_)
+                        ForeignKey, DateTime, Sequence, Index, and_, text)
+from sqlalchemy.orm import joinedload
+
+
+# Maximum number of ids in one "IN (...)" clause, longer lists of ids are
+# split into several queries.
+IN_CLAUSE_CHUNK_SIZE = 500
+# Number of objects fetched by one query when all items or actions which
+# participate in offline computations are loaded (see query_in_pages()).
+ROWS_PER_PAGE = 1000
+
+
+def flag_index(table_name, column_name, value, *columns):
+    """ Returns an index on columns (column_name if columns are not given)
+    of rows where boolean column_name equals value. The index is partial on
+    PostgreSQL and SQLite, other backends index all rows."""
+    if not columns:
+        columns = (column_name, )
+    name = 'ix_%s_%s_%s' % (table_name, '_'.join(columns), str(value).lower())
+    return Index(name, *columns,
+                 postgresql_where=text('%s = %s' % (column_name,
+                                                    str(value).lower())),
+                 sqlite_where=text('%s = %d' % (column_name, int(value))))
+
+
+def query_in_chunks(query, column, ids):
+    """ Returns a list of rows of the query which have column value in ids.
+    """
+    ids = list(ids)
+    result = []
+    for i in xrange(0, len(ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = ids[i : i + IN_CLAUSE_CHUNK_SIZE]
+        result.extend(query.filter(column.in_(chunk)).all())
+    return result
+
+
+def query_in_pages(query, column, session, page_size=None):
+    """ Iterates over objects of the query ordered by column (a unique
+    column), every page of page_size (by default ROWS_PER_PAGE) objects is
+    fetched by a separate query
+    which starts after the last value of column of the previous page.
+    The session is flushed before every page, so changes of the previous
+    page are written and its objects can be released, memory does not depend
+    on the number of rows."""
+    if page_size is None:
+        page_size = ROWS_PER_PAGE
+    last_value = None
+    while True:
+        session.flush()
+        page_query = query
+        if last_value is not None:
+            page_query = page_query.filter(column > last_value)
+        page = page_query.order_by(column).limit(page_size).all()
+        for obj in page:
+            yield obj
+        if len(page) < page_size:
+            return
+        last_value = getattr(page[-1], column.key)
+        del page
+
+
+def update_in_chunks(query, column, ids, values):
+    """ Sets values (a dictionary which maps columns to values) to rows of
+    the query which have column value in ids, one UPDATE per chunk of ids.
+    Objects loaded into the session are not synchronized."""
+    ids = list(ids)
+    for i in xrange(0, len(ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = ids[i : i + IN_CLAUSE_CHUNK_SIZE]
+        query.filter(column.in_(chunk)).update(values,
+                                               synchronize_session=False)
+
+
+def expire_instances(session, cls, ids):
+    """ Expires instances of cls with id in ids which are loaded into the
+    session, so they are reloaded after bulk updates."""
+    ids = set(ids)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, cls) and obj.id in ids:
+            session.expire(obj)
 
 
 class UserDirichletMixin(object):
@@ -49,6 +127,18 @@ class UserDirichletMixin(object):
     def sd_karma_user_u_p(cls):
         return Column(Float, default=0)
 
+    @declared_attr
+    def sd_dirty(cls):
+        """ True if base values of the user (or of the user's karma user)
+        changed since the last offline computation, so items of the user
+        are recomputed by incremental computations."""
+        return Column(Boolean, default=False)
+
+    @classmethod
+    def sd_get_dirty_user_ids(cls, session):
+        return [user_id for user_id, in session.query(cls.id).filter(
+                                                      cls.sd_dirty == True)]
+
 
 class ItemDirichletMixin(object):
     """ Item fields which contains information necessary for spam detection
@@ -75,12 +165,36 @@ class ItemDirichletMixin(object):
     def sd_frozen(cls):
         return Column(Boolean, default=False)
 
+    @declared_attr
+    def sd_dirty(cls):
+        """ True if the item or actions on it changed since the last offline
+        computation."""
+        return Column(Boolean, default=True)
+
     @classmethod
     def sd_get_items_offline_spam_detect(cls, session):
-        items = session.query(cls).filter(
-                     cls.sd_frozen == False).all()
+        """ Iterates over items, see query_in_pages(). Authors are loaded by
+        the same query."""
+        query = session.query(cls).options(joinedload(cls.author)).filter(
+                     cls.sd_frozen == False)
+        return query_in_pages(query, cls.id, session)
+
+    @classmethod
+    def sd_get_dirty_items(cls, session):
+        items = session.query(cls).filter(and_(cls.sd_frozen == False,
+                                               cls.sd_dirty == True)).all()
         return items
 
+    @classmethod
+    def sd_get_items_offline_by_ids(cls, item_ids, session):
+        query = session.query(cls).filter(cls.sd_frozen == False)
+        return query_in_chunks(query, cls.id, item_ids)
+
+    @classmethod
+    def sd_get_items_offline_by_authors(cls, author_ids, session):
+        query = session.query(cls).filter(cls.sd_frozen == False)
+        return query_in_chunks(query, cls.author_id, author_ids)
+
 class ActionDirichletMixin(object):
 
     @declared_attr
@@ -91,9 +205,22 @@ class ActionDirichletMixin(object):
 
     @classmethod
     def sd_get_actions_offline_spam_detect(cls, session):
-        actions = session.query(cls).filter(
-                     cls.sd_frozen == False).all()
-        return actions
+        """ Iterates over actions, see query_in_pages(). Users, items and
+        authors of items are loaded by the same query."""
+        query = session.query(cls).options(joinedload(cls.user),
+                        joinedload(cls.item).joinedload('author')).filter(
+                     cls.sd_frozen == False)
+        return query_in_pages(query, cls.id, session)
+
+    @classmethod
+    def sd_get_actions_offline_on_items(cls, item_ids, session):
+        query = session.query(cls).filter(cls.sd_frozen == False)
+        return query_in_chunks(query, cls.item_id, item_ids)
+
+    @classmethod
+    def sd_get_actions_offline_by_users(cls, user_ids, session):
+        query = session.query(cls).filter(cls.sd_frozen == False)
+        return query_in_chunks(query, cls.user_id, user_ids)
 
 
 class UserKargerMixin(object):
@@ -128,6 +255,18 @@ class UserKargerMixin(object):
     def sk_karma_user_reliab(cls):
         return Column(Float, default=0)
 
+    @declared_attr
+    def sk_dirty(cls):
+        """ True if base reliability of the user (or of the user's karma
+        user) changed since the last offline computation, so items of the
+        user are recomputed by incremental computations."""
+        return Column(Boolean, default=False)
+
+    @classmethod
+    def sk_get_dirty_user_ids(cls, session):
+        return [user_id for user_id, in session.query(cls.id).filter(
+                                                      cls.sk_dirty == True)]
+
 class ItemKargerMixin(object):
 
     @declared_attr
@@ -141,12 +280,36 @@ class ItemKargerMixin(object):
     def sk_frozen(cls):
         return Column(Boolean, default=False)
 
+    @declared_attr
+    def sk_dirty(cls):
+        """ True if the item or actions on it changed since the last offline
+        computation."""
+        return Column(Boolean, default=True)
+
     @classmethod
     def sk_get_items_offline_spam_detect(cls, session):
-        items = session.query(cls).filter(
-                     cls.sk_frozen == False).all()
+        """ Iterates over items, see query_in_pages(). Authors are loaded by
+        the same query."""
+        query = session.query(cls).options(joinedload(cls.author)).filter(
+                     cls.sk_frozen == False)
+        return query_in_pages(query, cls.id, session)
+
+    @classmethod
+    def sk_get_dirty_items(cls, session):
+        items = session.query(cls).filter(and_(cls.sk_frozen == False,
+                                               cls.sk_dirty == True)).all()
         return items
 
+    @classmethod
+    def sk_get_items_offline_by_ids(cls, item_ids, session):
+        query = session.query(cls).filter(cls.sk_frozen == False)
+        return query_in_chunks(query, cls.id, item_ids)
+
+    @classmethod
+    def sk_get_items_offline_by_authors(cls, author_ids, session):
+        query = session.query(cls).filter(cls.sk_frozen == False)
+        return query_in_chunks(query, cls.author_id, author_ids)
+
 class ActionKargerMixin(object):
 
     @declared_attr
@@ -157,6 +320,19 @@ class ActionKargerMixin(object):
 
     @classmethod
     def sk_get_actions_offline_spam_detect(cls, session):
-        actions = session.query(cls).filter(
-                     cls.sk_frozen == False).all()
-        return actions
+        """ Iterates over actions, see query_in_pages(). Users, items and
+        authors of items are loaded by the same query."""
+        query = session.query(cls).options(joinedload(cls.user),
+                        joinedload(cls.item).joinedload('author')).filter(
+                     cls.sk_frozen == False)
+        return query_in_pages(query, cls.id, session)
+
+    @classmethod
+    def sk_get_actions_offline_on_items(cls, item_ids, session):
+        query = session.query(cls).filter(cls.sk_frozen == False)
+        return query_in_chunks(query, cls.item_id, item_ids)
+
+    @classmethod
+    def sk_get_actions_offline_by_users(cls, user_ids, session):
+        query = session.query(cls).filter(cls.sk_frozen == False)
+        return query_in_chunks(query, cls.user_id, user_ids)
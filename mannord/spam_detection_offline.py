@@ -0,0 +1,255 @@
+# Parts of offline spam detection which are shared by spam_detection_karger
+# (fields with prefix "sk") and spam_detection_dirichlet (prefix "sd").
+from sqlalchemy.orm.attributes import set_committed_value
+from models import ActionMixin, UserMixin, ItemMixin, ACTION_FLAG_SPAM
+import spam_utils as su
+from spam_detection_mixins import update_in_chunks, expire_instances
+
+
+def create_graph(graph_module, array_graph):
+    """ Returns graph_module.ArrayGraph() if array_graph is True and
+    graph_module.Graph() otherwise."""
+    return graph_module.ArrayGraph() if array_graph else graph_module.Graph()
+
+
+def get_dirty_region(prefix, session, graph_action_types, max_items):
+    """ Returns a list of items, a list of actions of the region of the
+    graph which contains all dirty items (<prefix>_dirty field) and a list
+    of ids of dirty users. The region is closed: it contains all actions on
+    its items, all items on which its users acted and all items of authors
+    of its items (they are connected through the author's karma user).
+    Items on which dirty users acted and items they authored are in the
+    region too, as base values of the users changed.
+    If the region has more than max_items items then the function returns
+    (None, None, None).
+    """
+    ActionClass = ActionMixin.cls
+    UserClass = UserMixin.cls
+    ItemClass = ItemMixin.cls
+    get_dirty_user_ids = getattr(UserClass, prefix + '_get_dirty_user_ids')
+    get_dirty_items = getattr(ItemClass, prefix + '_get_dirty_items')
+    get_items_by_ids = getattr(ItemClass, prefix + '_get_items_offline_by_ids')
+    get_items_by_authors = getattr(ItemClass,
+                                   prefix + '_get_items_offline_by_authors')
+    get_actions_on_items = getattr(ActionClass,
+                                   prefix + '_get_actions_offline_on_items')
+    get_actions_by_users = getattr(ActionClass,
+                                   prefix + '_get_actions_offline_by_users')
+    new_items = get_dirty_items(session)
+    item_dict = dict((it.id, it) for it in new_items)
+    dirty_user_ids = get_dirty_user_ids(session)
+    # Dirty users and their karma users start the search along with items.
+    user_ids = set(dirty_user_ids)
+    author_ids = set(dirty_user_ids)
+    new_user_ids = set(user_ids)
+    new_author_ids = set(author_ids)
+    actions = []
+    # Breadth-first search over items, users and karma users.
+    while new_items or new_user_ids or new_author_ids:
+        if len(item_dict) > max_items:
+            return None, None, None
+        new_actions = get_actions_on_items([it.id for it in new_items],
+                                           session)
+        actions.extend(new_actions)
+        ids = set(act.user_id for act in new_actions
+                  if act.type in graph_action_types) - user_ids
+        new_user_ids.update(ids)
+        user_ids.update(ids)
+        ids = set(it.author_id for it in new_items) - author_ids
+        new_author_ids.update(ids)
+        author_ids.update(ids)
+        # Fetches neighbouring items which are not in the region yet.
+        candidates = get_items_by_authors(new_author_ids, session)
+        user_actions = get_actions_by_users(new_user_ids, session)
+        item_ids = set(act.item_id for act in user_actions
+                       if act.type in graph_action_types)
+        item_ids.difference_update(item_dict)
+        item_ids.difference_update(it.id for it in candidates)
+        candidates.extend(get_items_by_ids(item_ids, session))
+        new_items = []
+        for it in candidates:
+            if it.id not in item_dict:
+                item_dict[it.id] = it
+                new_items.append(it)
+        new_user_ids = set()
+        new_author_ids = set()
+    return item_dict.values(), actions, dirty_user_ids
+
+
+def get_action_rows(prefix, session, user_columns, graph_action_types,
+                    rows_per_fetch):
+    """ Returns an iterator over rows (user id, item id, action type, values
+    of user_columns of the user, item's <prefix>_weight) of actions which
+    participate in offline computations. Rows are fetched by one query with
+    joins, rows_per_fetch rows at a time."""
+    ActionClass = ActionMixin.cls
+    UserClass = UserMixin.cls
+    ItemClass = ItemMixin.cls
+    columns = [getattr(UserClass, name) for name in user_columns]
+    query = session.query(ActionClass.user_id, ActionClass.item_id,
+                          ActionClass.type, *(columns +
+                          [getattr(ItemClass, prefix + '_weight')])
+                ).join(UserClass, ActionClass.user_id == UserClass.id
+                ).join(ItemClass, ActionClass.item_id == ItemClass.id
+                ).filter(getattr(ActionClass, prefix + '_frozen') == False,
+                         ActionClass.type.in_(graph_action_types))
+    return query.yield_per(rows_per_fetch)
+
+
+def get_item_rows(prefix, session, user_columns, rows_per_fetch):
+    """ Returns an iterator over rows (item id, author id, values of
+    user_columns of the author, item's <prefix>_weight) of items which
+    participate in offline computations."""
+    ItemClass = ItemMixin.cls
+    UserClass = UserMixin.cls
+    columns = [getattr(UserClass, name) for name in user_columns]
+    query = session.query(ItemClass.id, ItemClass.author_id, *(columns +
+                          [getattr(ItemClass, prefix + '_weight')])
+                ).join(UserClass, ItemClass.author_id == UserClass.id
+                ).filter(getattr(ItemClass, prefix + '_frozen') == False)
+    return query.yield_per(rows_per_fetch)
+
+
+def bulk_from_graph_to_db(graph, session, prefix, algo_type,
+                          graph_action_types, threshold_spam, threshold_ham,
+                          base_increment, get_user_values, split_base_delta,
+                          rows_per_fetch):
+    """ Writes results of offline computations for all items and actions
+    which participate in them without loading ORM objects. Current values
+    are fetched by column queries, every user is written once, and only rows
+    whose values changed are updated (by executemany). Instances loaded into
+    the session are expired.
+
+    Items get <prefix>_weight, is_spam, is_ham, marked_for_mm, mm_priority,
+    <prefix>_frozen (the weight is out of (threshold_spam, threshold_ham))
+    and <prefix>_dirty. get_user_values(user) returns a dictionary of fields
+    of a user of the graph, fields of karma users (their ids start with "-")
+    are set to their authors. Actions on frozen items are frozen, and
+    base_increment changes base fields of their users and karma users of
+    the authors: split_base_delta(delta) maps suffixes of fields
+    (<prefix>_<suffix> and <prefix>_karma_user_<suffix>) to increments.
+    """
+    ActionClass = ActionMixin.cls
+    UserClass = UserMixin.cls
+    ItemClass = ItemMixin.cls
+    weight_name = prefix + '_weight'
+    frozen_name = prefix + '_frozen'
+    dirty_name = prefix + '_dirty'
+    session.flush()
+    # Fills items' fields and detects frozen items.
+    item_mappings = []
+    # Maps id of a frozen item to a tuple (author id, is_spam, is_ham).
+    frozen_items = {}
+    rows = session.query(ItemClass.id, ItemClass.author_id,
+                         getattr(ItemClass, weight_name), ItemClass.is_spam,
+                         ItemClass.is_ham, ItemClass.marked_for_mm,
+                         ItemClass.mm_priority, getattr(ItemClass, dirty_name)
+                ).filter(getattr(ItemClass, frozen_name) == False
+                ).yield_per(rows_per_fetch)
+    for row in rows:
+        weight = graph.get_item(row.id).weight
+        is_spam, is_ham, marked_for_mm = su.get_spam_ham_or_mm(weight,
+                                                        algo_type=algo_type)
+        mm_priority = su.get_mm_priority(weight, algo_type=algo_type)
+        frozen = weight > threshold_ham or weight < threshold_spam
+        if frozen:
+            frozen_items[row.id] = (row.author_id, is_spam, is_ham)
+        values = {weight_name: weight, 'is_spam': is_spam, 'is_ham': is_ham,
+                  'marked_for_mm': marked_for_mm, 'mm_priority': mm_priority,
+                  frozen_name: frozen, dirty_name: False}
+        if (getattr(row, weight_name) != weight or row.is_spam != is_spam or
+            row.is_ham != is_ham or row.marked_for_mm != marked_for_mm or
+            row.mm_priority != mm_priority or frozen or
+            getattr(row, dirty_name) != False):
+            values['id'] = row.id
+            item_mappings.append(values)
+    # New values of users' fields, every user is present once.
+    user_values = {}
+    for user in graph.users:
+        # Karma user's fields belong to the author.
+        user_id = user.id[1:] if user.id.startswith('-') else user.id
+        user_values.setdefault(user_id, {}).update(get_user_values(user))
+    # Actions which are excluded from future offline computations and
+    # changes of base fields of users and karma users.
+    frozen_action_ids = []
+    base_delta = {}
+    karma_base_delta = {}
+    rows = session.query(ActionClass.id, ActionClass.user_id,
+                         ActionClass.item_id, ActionClass.type
+                ).filter(getattr(ActionClass, frozen_name) == False
+                ).yield_per(rows_per_fetch)
+    for row in rows:
+        if row.type not in graph_action_types:
+            frozen_action_ids.append(row.id)
+            continue
+        if row.item_id not in frozen_items:
+            continue
+        frozen_action_ids.append(row.id)
+        author_id, is_spam, is_ham = frozen_items[row.item_id]
+        act_val = -1 if row.type == ACTION_FLAG_SPAM else 1
+        deltas = []
+        if is_spam:
+            deltas.append(act_val * (-base_increment))
+        if is_ham:
+            deltas.append(act_val * base_increment)
+        for delta in deltas:
+            for suffix, val in split_base_delta(delta).iteritems():
+                for fields, user_id in ((base_delta, row.user_id),
+                                        (karma_base_delta, author_id)):
+                    user_fields = fields.setdefault(user_id, {})
+                    user_fields[suffix] = user_fields.get(suffix, 0) + val
+    # Compares new values of users' fields with current ones.
+    suffixes = split_base_delta(0).keys()
+    names = set(name for values in user_values.itervalues()
+                for name in values)
+    names.update('%s_%s' % (prefix, suffix) for suffix in suffixes)
+    names.update('%s_karma_user_%s' % (prefix, suffix) for suffix in suffixes)
+    names = sorted(names)
+    user_mappings = []
+    rows = session.query(UserClass.id,
+                         *[getattr(UserClass, name) for name in names]
+                ).yield_per(rows_per_fetch)
+    for row in rows:
+        values = user_values.get(row.id)
+        if values is None and not (row.id in base_delta or
+                                   row.id in karma_base_delta):
+            continue
+        values = dict(values or {})
+        for suffix, val in base_delta.get(row.id, {}).iteritems():
+            name = '%s_%s' % (prefix, suffix)
+            values[name] = getattr(row, name) + val
+        for suffix, val in karma_base_delta.get(row.id, {}).iteritems():
+            name = '%s_karma_user_%s' % (prefix, suffix)
+            values[name] = getattr(row, name) + val
+        if any(getattr(row, key) != val for key, val in values.iteritems()):
+            values['id'] = row.id
+            user_mappings.append(values)
+    # Writes changes.
+    session.bulk_update_mappings(ItemClass, item_mappings)
+    session.bulk_update_mappings(UserClass, user_mappings)
+    update_in_chunks(session.query(ActionClass), ActionClass.id,
+                     frozen_action_ids,
+                     {getattr(ActionClass, frozen_name): True})
+    expire_instances(session, ItemClass, [m['id'] for m in item_mappings])
+    expire_instances(session, UserClass, [m['id'] for m in user_mappings])
+    expire_instances(session, ActionClass, frozen_action_ids)
+
+
+def clear_dirty_users(prefix, session, user_ids=None):
+    """ Resets <prefix>_dirty field of users with ids in user_ids (of all
+    users if user_ids is None) after offline computations. Instances loaded
+    into the session get the new value without a reload."""
+    UserClass = UserMixin.cls
+    name = prefix + '_dirty'
+    dirty = getattr(UserClass, name)
+    session.flush()
+    query = session.query(UserClass).filter(dirty == True)
+    if user_ids is None:
+        query.update({dirty: False}, synchronize_session=False)
+    else:
+        update_in_chunks(query, UserClass.id, user_ids, {dirty: False})
+        user_ids = set(user_ids)
+    for obj in list(session.identity_map.values()):
+        if (isinstance(obj, UserClass) and
+            (user_ids is None or obj.id in user_ids)):
+            set_committed_value(obj, name, False)
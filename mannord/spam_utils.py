@@ -12,32 +12,72 @@ KARGER_THRESHOLD_SPAM = ini_config.get('constants','KARGER_THRESHOLD_SPAM')
 KARGER_THRESHOLD_HAM = ini_config.get('constants','KARGER_THRESHOLD_HAM')
 DIRICHLET_THRESHOLD_SPAM = ini_config.get('constants','DIRICHLET_THRESHOLD_SPAM')
 DIRICHLET_THRESHOLD_HAM = ini_config.get('constants','DIRICHLET_THRESHOLD_HAM')
+DIRICHLET_PERCENTILE_TABLE = ''
+if ini_config.has_option('constants', 'DIRICHLET_PERCENTILE_TABLE'):
+    DIRICHLET_PERCENTILE_TABLE = ini_config.get('constants',
+                                                'DIRICHLET_PERCENTILE_TABLE')
 ALGO_KARGER = 'karger'
 ALGO_DIRICHLET = 'dirichlet'
 
 
+def get_spam_ham_or_mm(weight, algo_type=ALGO_KARGER):
+    """ Returns a tuple (is_spam, is_ham, marked_for_mm) for an item with
+    the given weight."""
+    if algo_type == ALGO_KARGER:
+        threshold_spam = KARGER_THRESHOLD_SPAM
+        threshold_ham = KARGER_THRESHOLD_HAM
+    elif algo_type == ALGO_DIRICHLET:
+        threshold_spam = DIRICHLET_THRESHOLD_SPAM
+        threshold_ham = DIRICHLET_THRESHOLD_HAM
+    else:
+        raise Exception("Unknown type of algorithm!")
+    if weight < threshold_spam:
+        return True, False, False
+    elif weight > threshold_ham:
+        return False, True, False
+    # If we don't know whether the annotation is spam or ham,
+    # then mark it for metamoderation.
+    return False, False, True
+
+
+def get_mm_priority(weight, algo_type=ALGO_KARGER):
+    """ Returns distance from the weight to the middle of the interval
+    between spam and ham thresholds divided by the interval length.
+    Items with smaller values are more uncertain."""
+    if algo_type == ALGO_KARGER:
+        threshold_spam = float(KARGER_THRESHOLD_SPAM)
+        threshold_ham = float(KARGER_THRESHOLD_HAM)
+    elif algo_type == ALGO_DIRICHLET:
+        threshold_spam = float(DIRICHLET_THRESHOLD_SPAM)
+        threshold_ham = float(DIRICHLET_THRESHOLD_HAM)
+    else:
+        raise Exception("Unknown type of algorithm!")
+    middle = 0.5 * (threshold_spam + threshold_ham)
+    return abs(weight - middle) / (threshold_ham - threshold_spam)
+
+
 def mark_spam_ham_or_mm(item, algo_type=ALGO_KARGER):
     if algo_type == ALGO_KARGER:
-        item.is_spam = False
-        item.is_ham = False
-        item.marked_for_mm = False
-        if item.sk_weight < KARGER_THRESHOLD_SPAM:
-            item.is_spam = True
-        elif item.sk_weight > KARGER_THRESHOLD_HAM:
-            item.is_ham = True
-        else:
-            # If we don't know whether the annotation is spam or ham,
-            # then mark it for metamoderation.
-            item.marked_for_mm = True
+        weight = item.sk_weight
     elif algo_type == ALGO_DIRICHLET:
-        item.is_spam = False
-        item.is_ham = False
-        item.marked_for_mm = False
-        if item.sd_weight < DIRICHLET_THRESHOLD_SPAM:
-            item.is_spam = True
-        elif item.sd_weight > DIRICHLET_THRESHOLD_HAM:
-            item.is_ham = True
-        else:
-            item.marked_for_mm = True
+        weight = item.sd_weight
     else:
         raise Exception("Unknown type of algorithm!")
+    item.is_spam, item.is_ham, item.marked_for_mm = get_spam_ham_or_mm(weight,
+                                                                  algo_type)
+    item.mm_priority = get_mm_priority(weight, algo_type)
+
+
+def mark_dirty(item):
+    """ Marks the item to be recomputed by the next incremental offline
+    computation of both algorithms."""
+    item.sk_dirty = True
+    item.sd_dirty = True
+
+
+def mark_user_dirty(user):
+    """ Marks items of the user (the user acted on or authored) to be
+    recomputed by the next incremental offline computation of both
+    algorithms, it is needed when base values of the user change."""
+    user.sk_dirty = True
+    user.sd_dirty = True
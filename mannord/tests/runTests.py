@@ -1,13 +1,23 @@
 #!/usr/bin/python
 
-from datetime import datetime
+import os
+import shutil
+import tempfile
+import contextlib
+import time
+from datetime import datetime, timedelta
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 import unittest
 
 from mannord import (ItemMixin, UserMixin, ActionMixin, ComputationMixin)
 import mannord as mnrd
+import mannord.hitsDB as hitsDB
+import mannord.models as mdl
+import mannord.spam_utils as su
+import mannord.graph_d as gd
+from mannord.bloom import BloomFilter, ScalableBloomFilter
 
 Base = declarative_base()
 
@@ -22,11 +32,27 @@ session = Session()
 mnrd.bootstrap(Base, create_all=True)
 
 
+@contextlib.contextmanager
+def restored_bootstrap():
+    """ Restores classes bootstrapped above after a test bootstraps mannord
+    with another base."""
+    classes = [(mixin, mixin.cls) for mixin in (ActionMixin, ItemMixin,
+                    UserMixin, ComputationMixin, mnrd.LinkMixin)]
+    try:
+        yield
+    finally:
+        for mixin, cls in classes:
+            mixin.cls = cls
+        hitsDB.USE_LINK_TABLE = True
+        hitsDB.suggestion_cache.clear()
+
+
 def recreate_tables():
     Base.metadata.drop_all()
     session.expunge_all()
     Base.metadata.create_all()
     session.flush()
+    hitsDB.suggestion_cache.clear()
 
 
 
@@ -120,6 +146,537 @@ class TestSpamFlag(unittest.TestCase):
         actions = Action.get_actions_on_item('annot1', session)
         self.assertTrue(act in actions)
 
+    def test_reconcile_counters(self):
+        recreate_tables()
+        ModeratedAnnotation = ItemMixin.cls
+        ModerationUser = UserMixin.cls
+
+        user1 = ModerationUser('user1')
+        user2 = ModerationUser('user2')
+        user3 = ModerationUser('user3')
+        session.add_all([user1, user2, user3])
+        session.flush()
+        annot1 = ModeratedAnnotation('www.example.com', 'annot1', user1)
+        annot2 = ModeratedAnnotation('www.example.com', 'annot2', user2)
+        session.add_all([annot1, annot2])
+        session.flush()
+
+        mnrd.upvote(annot1, user2, session)
+        mnrd.downvote(annot2, user1, session)
+        mnrd.add_item('www.example.com', 'annot3', user3, session,
+                      parent_id='annot1', action_type=mnrd.ACTION_UPVOTE)
+        mnrd.raise_spam_flag(annot2, user3, session)
+        self.assertEqual((user1.vote_counter, user1.mm_vote_counter), (2, 1))
+        self.assertEqual((user2.vote_counter, user2.mm_vote_counter), (-1, 0))
+        self.assertEqual(annot2.spam_flag_counter, 1)
+        # Counters are consistent with actions.
+        self.assertEqual(mnrd.reconcile_counters(session), 0)
+
+        # Counters drifted.
+        user1.vote_counter = 7
+        user3.mm_vote_counter = -2
+        annot1.spam_flag_counter = 3
+        session.flush()
+        self.assertEqual(mnrd.reconcile_counters(session), 3)
+        self.assertEqual((user1.vote_counter, user1.mm_vote_counter), (2, 1))
+        self.assertEqual((user3.vote_counter, user3.mm_vote_counter), (0, 0))
+        self.assertEqual(annot1.spam_flag_counter, 0)
+        self.assertEqual(annot2.spam_flag_counter, 1)
+
+    def _actions_final_state(self, batch, algo_name):
+        """ Applies the same actions one by one or as a batch and returns
+        the resulting state of the tables."""
+        recreate_tables()
+        ModeratedAnnotation = ItemMixin.cls
+        Action = ActionMixin.cls
+        ModerationUser = UserMixin.cls
+
+        users = [ModerationUser('user%d' % i) for i in xrange(4)]
+        session.add_all(users)
+        session.flush()
+        items = [ModeratedAnnotation('www.example.com', 'annot%d' % i,
+                                     users[i]) for i in xrange(3)]
+        session.add_all(items)
+        session.flush()
+        mnrd.downvote(items[0], users[1], session)
+        mnrd.raise_ham_flag(items[1], users[2], session, algo_name=algo_name)
+
+        actions = [(mnrd.ACTION_UPVOTE, items[0], users[1]),
+                   (mnrd.ACTION_FLAG_SPAM, items[1], users[2]),
+                   (mnrd.ACTION_FLAG_SPAM, items[1], users[3]),
+                   (mnrd.ACTION_DOWNVOTE, items[2], users[0]),
+                   (mnrd.ACTION_UPVOTE, items[2], users[0]),
+                   (mnrd.ACTION_DOWNVOTE, items[2], users[0]),
+                   (mnrd.ACTION_FLAG_HAM, items[1], users[3]),
+                   (mnrd.ACTION_FLAG_SPAM, items[0], users[3]),
+                   (mnrd.ACTION_UPVOTE, items[1], users[0])]
+        if batch:
+            mnrd.apply_actions(actions, session, algo_name=algo_name)
+        else:
+            for action_type, item, user in actions:
+                if action_type == mnrd.ACTION_UPVOTE:
+                    mnrd.upvote(item, user, session)
+                elif action_type == mnrd.ACTION_DOWNVOTE:
+                    mnrd.downvote(item, user, session)
+                elif action_type == mnrd.ACTION_FLAG_SPAM:
+                    mnrd.raise_spam_flag(item, user, session,
+                                         algo_name=algo_name)
+                else:
+                    mnrd.raise_ham_flag(item, user, session,
+                                        algo_name=algo_name)
+        session.expire_all()
+        user_cols = ['id', 'vote_counter', 'mm_vote_counter', 'sk_reliab',
+                     'sk_reliab_raw', 'sk_base_reliab', 'sd_u_n', 'sd_u_p',
+                     'sd_reliab']
+        item_cols = ['id', 'spam_flag_counter', 'sk_weight', 'sd_weight',
+                     'sd_c_n', 'sd_c_p', 'is_spam', 'is_ham', 'marked_for_mm']
+        return (sorted((act.item_id, act.user_id, act.type)
+                       for act in session.query(Action)),
+                sorted(tuple(getattr(u, col) for col in user_cols)
+                       for u in session.query(ModerationUser)),
+                sorted(tuple(getattr(it, col) for col in item_cols)
+                       for it in session.query(ModeratedAnnotation)))
+
+    def test_apply_actions(self):
+        for algo_name in ['dirichlet', 'karger']:
+            sequential = self._actions_final_state(False, algo_name)
+            batch = self._actions_final_state(True, algo_name)
+            self.assertEqual(sequential[0], batch[0])
+            for seq_rows, batch_rows in zip(sequential[1:], batch[1:]):
+                self.assertEqual(len(seq_rows), len(batch_rows))
+                for seq_row, batch_row in zip(seq_rows, batch_rows):
+                    for seq_val, batch_val in zip(seq_row, batch_row):
+                        self.assertAlmostEqual(seq_val, batch_val)
+
+    def test_deferred(self):
+        recreate_tables()
+        ModeratedAnnotation = ItemMixin.cls
+        Action = ActionMixin.cls
+        user1 = mnrd.get_add_user('user1', session)
+        user2 = mnrd.get_add_user('user2', session)
+        annot1 = mnrd.add_item('www.example.com', 'annot1', user1, session)
+        flushes = []
+        listener = lambda session, context: flushes.append(1)
+        event.listen(session, 'after_flush', listener)
+        try:
+            with mnrd.deferred(session):
+                user3 = mnrd.get_add_user('user3', session)
+                self.assertTrue(mnrd.get_add_user('user3', session) is user3)
+                annot2 = mnrd.add_item('www.example.com', 'annot2', user3,
+                                       session, parent_id='annot1',
+                                       action_type=mnrd.ACTION_UPVOTE)
+                self.assertTrue(ModeratedAnnotation.get_item('annot2', session)
+                                is annot2)
+                mnrd.upvote(annot2, user2, session)
+                mnrd.downvote(annot2, user2, session)
+                self.assertTrue(Action.get_action('annot2', 'user2',
+                                mnrd.ACTION_UPVOTE, session) is None)
+                self.assertTrue(Action.get_action('annot2', 'user2',
+                                mnrd.ACTION_DOWNVOTE, session) is not None)
+                # Counters of loaded instances reflect the block.
+                self.assertEqual(user1.vote_counter, 1)
+                self.assertEqual(len(flushes), 0)
+        finally:
+            event.remove(session, 'after_flush', listener)
+        self.assertEqual(len(flushes), 1)
+        session.expire_all()
+        self.assertEqual((user1.vote_counter, user1.mm_vote_counter), (1, 1))
+        self.assertEqual(user3.vote_counter, -1)
+        self.assertEqual(mnrd.reconcile_counters(session), 0)
+        self.assertEqual(sorted((act.item_id, act.user_id, act.type)
+                                for act in session.query(Action)),
+                         [('annot1', 'user3', mnrd.ACTION_UPVOTE),
+                          ('annot2', 'user2', mnrd.ACTION_DOWNVOTE),
+                          ('annot2', 'user2', 'flag_ham')])
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in xrange(1000):
+            bloom.add('key%d' % i)
+        self.assertTrue(all('key%d' % i in bloom for i in xrange(1000)))
+        false_positives = sum('other%d' % i in bloom for i in xrange(10000))
+        self.assertTrue(false_positives < 300)
+
+    def test_scalable_bloom_filter(self):
+        bloom = ScalableBloomFilter(100, error_rate=0.01)
+        for i in xrange(1000):
+            bloom.add('key%d' % i)
+        self.assertTrue(len(bloom.filters) > 1)
+        self.assertTrue(all('key%d' % i in bloom for i in xrange(1000)))
+        false_positives = sum('other%d' % i in bloom for i in xrange(10000))
+        self.assertTrue(false_positives < 300)
+
+    def test_action_filter(self):
+        recreate_tables()
+        Action = ActionMixin.cls
+        user1 = mnrd.get_add_user('user1', session)
+        user2 = mnrd.get_add_user('user2', session)
+        annot1 = mnrd.add_item('www.example.com', 'annot1', user1, session)
+        mnrd.upvote(annot1, user2, session)
+        statements = []
+        listener = lambda *args: statements.append(1)
+        # The filter is only loaded for a single writer.
+        self.assertRaises(Exception, Action.load_action_filter, session)
+        Action.load_action_filter(session, single_writer=True)
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            # Definite "no" does not touch the db.
+            self.assertTrue(Action.get_action('annot1', 'user1',
+                            mnrd.ACTION_UPVOTE, session) is None)
+            self.assertEqual(len(statements), 0)
+            # Existing actions are found in the db.
+            self.assertTrue(Action.get_action('annot1', 'user2',
+                            mnrd.ACTION_UPVOTE, session) is not None)
+            self.assertEqual(len(statements), 1)
+            # New actions are added to the filter.
+            mnrd.downvote(annot1, user1, session)
+            self.assertTrue(Action.get_action('annot1', 'user1',
+                            mnrd.ACTION_DOWNVOTE, session) is not None)
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+            Action.clear_action_filter()
+
+    def test_action_filter_rebuild(self):
+        recreate_tables()
+        Action = ActionMixin.cls
+        user1 = mnrd.get_add_user('user1', session)
+        annot1 = mnrd.add_item('www.example.com', 'annot1', user1, session)
+        Action.load_action_filter(session, single_writer=True)
+        try:
+            # Actions added by add_action() are in the filter.
+            Action.add_action('annot1', 'user1', mnrd.ACTION_UPVOTE, 1,
+                              datetime.utcnow(), session)
+            self.assertTrue(Action.get_action('annot1', 'user1',
+                            mnrd.ACTION_UPVOTE, session) is not None)
+            # An action written behind the filter's back (as by a script)
+            # is seen after the filter expires, the refresh loads only
+            # actions added since the last refresh.
+            Action.load_action_filter(session, single_writer=True, ttl=0)
+            n_added = mdl._action_filter.n_added
+            session.add(Action('annot1', 'user1', mnrd.ACTION_DOWNVOTE,
+                               datetime.utcnow()))
+            session.flush()
+            self.assertTrue(Action.get_action('annot1', 'user1',
+                            mnrd.ACTION_DOWNVOTE, session) is not None)
+            self.assertEqual(mdl._action_filter.n_added, n_added + 1)
+        finally:
+            Action.clear_action_filter()
+
+    def test_items_for_mm_randomly(self):
+        recreate_tables()
+        user1 = mnrd.get_add_user('user1', session)
+        items = [mnrd.add_item('www.example.com', 'annot%d' % i, user1,
+                               session) for i in xrange(10)]
+        for i, it in enumerate(items[1:]):
+            it.marked_for_mm = True
+            # Evenly spaced keys, so every item is equally likely.
+            it.mm_random = (i + 0.5) / 9
+        items[0].marked_for_mm = False
+        session.flush()
+        counts = dict((it.id, 0) for it in items)
+        pair_counts = {}
+        for i in xrange(1500):
+            sample = mnrd.get_n_items_for_spam_mm_randomly(3, session)
+            self.assertEqual(len(set(sample)), 3)
+            for it in sample:
+                counts[it.id] += 1
+            for it1 in sample:
+                for it2 in sample:
+                    if it1.id < it2.id:
+                        pair = (it1.id, it2.id)
+                        pair_counts[pair] = pair_counts.get(pair, 0) + 1
+        # Reads do not modify items.
+        self.assertEqual(len(session.dirty), 0)
+        self.assertEqual(counts['annot0'], 0)
+        # Every marked item is picked with probability 1/3.
+        for i in xrange(1, 10):
+            self.assertTrue(400 < counts['annot%d' % i] < 600)
+        # Items are picked independently of their neighbours in key order:
+        # every pair is picked together with probability 1/12.
+        self.assertEqual(len(pair_counts), 36)
+        for count in pair_counts.values():
+            self.assertTrue(60 < count < 200)
+        # Asking for more items than marked returns all of them.
+        self.assertEqual(len(mnrd.get_n_items_for_spam_mm_randomly(20,
+                                                                   session)), 9)
+
+    def test_backfill_mm_random(self):
+        recreate_tables()
+        Item = ItemMixin.cls
+        user1 = mnrd.get_add_user('user1', session)
+        for i in xrange(3):
+            annot = mnrd.add_item('www.example.com', 'annot%d' % i, user1,
+                                  session)
+            annot.marked_for_mm = True
+        session.flush()
+        # Rows created before the column was added have no key.
+        session.query(Item).filter(Item.id != 'annot0').update(
+            {Item.mm_random: None}, synchronize_session=False)
+        session.expire_all()
+        sample = mnrd.get_n_items_for_spam_mm_randomly(3, session)
+        self.assertEqual([it.id for it in sample], ['annot0'])
+        self.assertEqual(mnrd.backfill_mm_random(session), 2)
+        self.assertEqual(mnrd.backfill_mm_random(session), 0)
+        sample = mnrd.get_n_items_for_spam_mm_randomly(3, session)
+        self.assertEqual(len(sample), 3)
+        keys = dict((it.id, it.mm_random) for it in sample)
+        self.assertEqual(mnrd.redraw_mm_random(session), 3)
+        self.assertTrue(any(it.mm_random != keys[it.id] for it in sample))
+
+    def test_items_for_mm_by_uncertainty(self):
+        recreate_tables()
+        user1 = mnrd.get_add_user('user1', session)
+        items = [mnrd.add_item('www.example.com', 'annot%d' % i, user1,
+                               session) for i in xrange(5)]
+        weights = [0.03, 0.014, -0.2, 0.001, 0.02]
+        for it, weight in zip(items, weights):
+            it.sd_weight = weight
+            su.mark_spam_ham_or_mm(it, algo_type=su.ALGO_DIRICHLET)
+            it.marked_for_mm = True
+        items[2].marked_for_mm = False
+        session.flush()
+        # The middle of Dirichlet thresholds is 0.014.
+        self.assertEqual([it.id for it in
+                          mnrd.get_n_items_for_mm_by_uncertainty(3, session)],
+                         ['annot1', 'annot4', 'annot3'])
+        # Rows created before the column was added have no priority, they
+        # are skipped until they are backfilled.
+        Item = ItemMixin.cls
+        session.query(Item).update({Item.mm_priority: None},
+                                   synchronize_session=False)
+        session.expire_all()
+        self.assertEqual(mnrd.get_n_items_for_mm_by_uncertainty(3, session),
+                         [])
+        self.assertEqual(mnrd.backfill_mm_priority(session,
+                            algo_name=su.ALGO_DIRICHLET), 5)
+        self.assertEqual([it.id for it in
+                          mnrd.get_n_items_for_mm_by_uncertainty(3, session)],
+                         ['annot1', 'annot4', 'annot3'])
+
+    def test_reviewer_reservoir(self):
+        recreate_tables()
+        ModerationUser = UserMixin.cls
+        Action = ActionMixin.cls
+        users = [mnrd.get_add_user('user%d' % i, session) for i in xrange(6)]
+        annot1 = mnrd.add_item('www.example.com', 'annot1', users[0], session)
+        annot2 = mnrd.add_item('www.example2.com', 'annot2', users[5], session)
+        now = datetime.utcnow()
+        for i, days, reliab in [(1, 1, 0.5), (2, 2, 0.5), (3, 1, 0),
+                                (4, 100, 0.5)]:
+            users[i].sd_reliab = reliab
+            session.add(Action('annot1', users[i].id, mnrd.ACTION_FLAG_HAM,
+                               now - timedelta(days=days)))
+        session.flush()
+        reservoir = hitsDB.reservoir
+        reservoir.samples.clear()
+        # Only recently active reliable users are in the reservoir.
+        self.assertEqual(sorted(reservoir.sample(10, set(), session)),
+                         ['user1', 'user2'])
+        self.assertEqual(reservoir.sample(10, set(['user1']), session),
+                         ['user2'])
+        # A new page has no neighbours, the list is topped up with random
+        # reviewers without refreshing the reservoir.
+        sample = reservoir.samples[su.ALGO_DIRICHLET]
+        n_users = mnrd.suggest_n_users_to_review(annot2, 2, session)
+        self.assertEqual(sorted(n_users), ['user1', 'user2'])
+        self.assertTrue(reservoir.samples[su.ALGO_DIRICHLET] is sample)
+        # Samples are kept per algorithm.
+        users[3].sk_reliab = 0.5
+        session.flush()
+        self.assertEqual(reservoir.sample(10, set(), session,
+                                          algo_name=su.ALGO_KARGER), ['user3'])
+        self.assertEqual(sorted(reservoir.sample(10, set(), session)),
+                         ['user1', 'user2'])
+        # A stale sample is served if the request has no time to refresh
+        # it, without a sample nothing is returned.
+        users[3].sd_reliab = 0.5
+        session.flush()
+        reservoir.invalidate()
+        self.assertEqual(sorted(reservoir.sample(10, set(), session,
+                                                 deadline=time.time())),
+                         ['user1', 'user2'])
+        self.assertEqual(sorted(reservoir.sample(10, set(), session)),
+                         ['user1', 'user2', 'user3'])
+        reservoir.samples.clear()
+        self.assertEqual(reservoir.sample(10, set(), session,
+                                          deadline=time.time()), [])
+
+    def test_suggestion_cache(self):
+        recreate_tables()
+        users = [mnrd.get_add_user('user%d' % i, session) for i in xrange(5)]
+        annot1 = mnrd.add_item('www.example.com', 'annot1', users[0], session)
+        annot2 = mnrd.add_item('www.example.com', 'annot2', users[1], session)
+        mnrd.upvote(annot1, users[2], session)
+        mnrd.upvote(annot2, users[3], session)
+        cache = hitsDB.suggestion_cache
+        n_users = mnrd.suggest_n_users_to_review(annot1, 2, session)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # The second call is answered from the cache without queries.
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            self.assertEqual(mnrd.suggest_n_users_to_review(annot1, 2,
+                                                            session), n_users)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Other authors and lengths are cached separately.
+        mnrd.suggest_n_users_to_review(annot2, 2, session)
+        mnrd.suggest_n_users_to_review(annot1, 3, session)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        # An action on the page invalidates its entries.
+        mnrd.upvote(annot1, users[4], session)
+        self.assertEqual(len(cache.entries), 0)
+        self.assertIn('user4', mnrd.suggest_n_users_to_review(annot1, 4,
+                                                              session))
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        # Least recently used entries are evicted first.
+        lru = hitsDB.SuggestionCache(size=2)
+        lru.put('page1', 'user0', 1, ['user1'])
+        lru.put('page2', 'user0', 1, ['user2'])
+        self.assertEqual(lru.get('page1', 'user0', 1), ['user1'])
+        lru.put('page3', 'user0', 1, ['user3'])
+        self.assertIsNone(lru.get('page2', 'user0', 1))
+        self.assertEqual(lru.get('page3', 'user0', 1), ['user3'])
+        self.assertEqual(sorted(lru.page_keys), ['page1', 'page3'])
+        # Expired entries are misses.
+        lru = hitsDB.SuggestionCache(ttl=0)
+        lru.put('page1', 'user0', 1, ['user1'])
+        self.assertIsNone(lru.get('page1', 'user0', 1))
+        self.assertEqual((lru.hits, lru.misses), (0, 1))
+        # Expired entries do not leave empty sets of page keys.
+        self.assertEqual(len(lru.page_keys), 0)
+
+    def test_links(self):
+        recreate_tables()
+        users = [mnrd.get_add_user('user%d' % i, session) for i in xrange(4)]
+        annot1 = mnrd.add_item('www.example.com', 'annot1', users[0], session)
+        annot2 = mnrd.add_item('www.example.com', 'annot2', users[1], session)
+        annot3 = mnrd.add_item('www.example2.com', 'annot3', users[0],
+                               session)
+        mnrd.upvote(annot1, users[2], session)
+        mnrd.downvote(annot1, users[2], session)
+        mnrd.raise_spam_flag(annot3, users[3], session)
+        annot4 = mnrd.add_item('www.example.com', 'annot4', users[3], session,
+                               parent_id='annot2',
+                               action_type=mnrd.ACTION_UPVOTE)
+        mnrd.delete_item(annot4, session)
+        mnrd.undo_downvote(annot1, users[2], session)
+        # Actions on a deleted item stay, but they are not links.
+        annot5 = mnrd.add_item('www.example3.com', 'annot5', users[1],
+                               session)
+        mnrd.raise_spam_flag(annot5, users[2], session)
+        mnrd.delete_item(annot5, session)
+        self.assertEqual(hitsDB.get_links_on_pages(['www.example3.com'],
+                                                   session), {})
+        links = hitsDB.count_links_on_pages(None, session)
+        self.assertEqual(links, {
+            'www.example.com': {'user0': 1, 'user1': 1, 'user2': 1},
+            'www.example2.com': {'user0': 1, 'user3': 1}})
+        # The maintained table agrees with counts from items and actions.
+        self.assertEqual(hitsDB.get_links_on_pages(links.keys(), session),
+                         links)
+        self.assertEqual(hitsDB.get_pages_of_users(['user0'], session),
+                         set(['www.example.com', 'www.example2.com']))
+        # Rebuild regenerates the table.
+        LinkClass = mnrd.LinkMixin.cls
+        session.query(LinkClass).delete()
+        self.assertEqual(hitsDB.get_links_on_pages(links.keys(), session), {})
+        self.assertEqual(mnrd.rebuild_links(session), 5)
+        self.assertEqual(hitsDB.get_links_on_pages(links.keys(), session),
+                         links)
+
+    def test_link_deltas(self):
+        recreate_tables()
+        users = [mnrd.get_add_user('user%d' % i, session) for i in xrange(3)]
+        annot1 = mnrd.add_item('www.example.com', 'annot1', users[0], session)
+        annot2 = mnrd.add_item('www.example.com', 'annot2', users[1], session)
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            mnrd.apply_actions([(mnrd.ACTION_UPVOTE, annot1, users[2]),
+                                (mnrd.ACTION_UPVOTE, annot2, users[2]),
+                                (mnrd.ACTION_FLAG_SPAM, annot1, users[2])],
+                               session)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        # Changes of one link are written by one update and one insert,
+        # page urls of loaded items are not queried.
+        link_statements = [st for st in statements if 'user_page_link' in st]
+        self.assertEqual(len(link_statements), 2)
+        self.assertFalse(any(st.startswith('SELECT') and 'page_url' in st
+                             for st in statements))
+        links = hitsDB.count_links_on_pages(None, session)
+        self.assertEqual(hitsDB.get_links_on_pages(links.keys(), session),
+                         links)
+        # Items which are not loaded are looked up once per flush.
+        session.expunge_all()
+        Action = ActionMixin.cls
+        session.add(Action('annot1', 'user1', mnrd.ACTION_UPVOTE,
+                           datetime.utcnow()))
+        session.add(Action('annot2', 'user0', mnrd.ACTION_UPVOTE,
+                           datetime.utcnow()))
+        session.flush()
+        links = hitsDB.count_links_on_pages(None, session)
+        self.assertEqual(links['www.example.com']['user0'], 2)
+        self.assertEqual(hitsDB.get_links_on_pages(links.keys(), session),
+                         links)
+
+    def test_bootstrap_without_link_table(self):
+        with restored_bootstrap():
+            old_engine = create_engine('sqlite:///:memory:')
+            old_base = declarative_base()
+            old_base.metadata.bind = old_engine
+            mnrd.bootstrap(old_base, create_all=True)
+            # Deployment created before the link table was added.
+            mnrd.LinkMixin.cls.__table__.drop(bind=old_engine)
+            new_base = declarative_base()
+            new_base.metadata.bind = old_engine
+            mnrd.bootstrap(new_base)
+            self.assertFalse(hitsDB.USE_LINK_TABLE)
+            old_session = sessionmaker(bind=old_engine)()
+            user1 = mnrd.get_add_user('user1', old_session)
+            mnrd.add_item('www.example.com', 'annot1', user1, old_session)
+            self.assertEqual(hitsDB.get_links_on_pages(['www.example.com'],
+                             old_session), {'www.example.com': {'user1': 1}})
+            # Rebuild creates the table and turns it on.
+            self.assertEqual(mnrd.rebuild_links(old_session), 1)
+            self.assertTrue(hitsDB.USE_LINK_TABLE)
+            mnrd.add_item('www.example.com', 'annot2', user1, old_session)
+            self.assertEqual(hitsDB.get_links_on_pages(['www.example.com'],
+                             old_session), {'www.example.com': {'user1': 2}})
+
+    def test_bootstrap_percentile_table(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(tmp_dir, 'table.npy')
+            gd.build_percentile_table(file_path, max_count=1, step=0.5)
+            # bootstrap() loads the configured table.
+            with restored_bootstrap():
+                mnrd.bootstrap(declarative_base(),
+                               percentile_table_path=file_path)
+            self.assertEqual(gd._percentile_table.max_count, 1)
+        finally:
+            gd.unload_percentile_table()
+            shutil.rmtree(tmp_dir)
+
+    def test_create_indexes(self):
+        recreate_tables()
+        # All declared indexes exist after create_all.
+        self.assertEqual(mnrd.create_indexes(engine), [])
+        # Drops indexes as on a deployment created before they were declared.
+        table = ActionMixin.cls.__table__
+        dropped = sorted(index.name for index in table.indexes)
+        for index in table.indexes:
+            index.drop(bind=engine)
+        self.assertEqual(sorted(mnrd.create_indexes(engine)), dropped)
+        self.assertEqual(mnrd.create_indexes(engine), [])
+
 
 if __name__ == '__main__':
     unittest.main()
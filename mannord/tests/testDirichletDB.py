@@ -8,7 +8,9 @@ import unittest
 
 from mannord import (ItemMixin, UserMixin, ActionMixin)
 import mannord.spam_utils as su
+import mannord.spam_detection_mixins as sdm
 import mannord.graph_d as gd
+import mannord.spam_detection_dirichlet as sdd
 import mannord as mnrd
 
 Base = declarative_base()
@@ -153,6 +155,149 @@ class TestSpamFlag(unittest.TestCase):
         print 'annot1 spam weight', annot1.sd_weight
         print 'annot2 spam weight', annot2.sd_weight
 
+    def test_incremental(self):
+        recreate_tables()
+        users = [mnrd.get_add_user('user%s' % i, session) for i in xrange(8)]
+        # Two disconnected regions: annotations of user0 flagged by users
+        # 1-3 and annotations of user4 flagged by users 5-7.
+        annots = []
+        for i in xrange(4):
+            author = users[0] if i < 2 else users[4]
+            annots.append(mnrd.get_add_item('www.example.com', 'annot%s' % i,
+                          author, session, spam_detect_algo=su.ALGO_DIRICHLET))
+        for i in xrange(1, 4):
+            mnrd.raise_spam_flag(annots[0], users[i], session, algo_name=algo_name)
+            mnrd.raise_ham_flag(annots[1], users[i], session, algo_name=algo_name)
+            mnrd.raise_ham_flag(annots[2], users[i + 4], session, algo_name=algo_name)
+            mnrd.raise_ham_flag(annots[3], users[i + 4], session, algo_name=algo_name)
+        mnrd.run_offline_spam_detection(algo_name, session)
+        self.assertTrue(sdd.run_incremental_computations(session) is None)
+        # Changes the first region only.
+        mnrd.raise_ham_flag(annots[0], users[1], session, algo_name=algo_name)
+        self.assertTrue(annots[0].sd_dirty)
+        self.assertFalse(annots[2].sd_dirty)
+        graph = sdd.run_incremental_computations(session)
+        self.assertEqual(sorted(it.id for it in graph.items),
+                         ['annot0', 'annot1'])
+        self.assertFalse(annots[0].sd_dirty)
+        weights = [it.sd_weight for it in annots]
+        reliabs = [u.sd_reliab for u in users]
+        # Dirichlet messages do not leave the region, so the full run gives
+        # the same result (up to the tolerance of iterations).
+        mnrd.run_offline_spam_detection(algo_name, session)
+        for i in xrange(len(annots)):
+            self.assertAlmostEqual(weights[i], annots[i].sd_weight, places=5)
+        for i in xrange(len(users)):
+            self.assertAlmostEqual(reliabs[i], users[i].sd_reliab, places=5)
+
+        # Too big region leads to the full run.
+        mnrd.raise_spam_flag(annots[2], users[1], session, algo_name=algo_name)
+        max_items = sdd.INCREMENTAL_MAX_ITEMS
+        sdd.INCREMENTAL_MAX_ITEMS = 1
+        try:
+            graph = sdd.run_incremental_computations(session)
+        finally:
+            sdd.INCREMENTAL_MAX_ITEMS = max_items
+        self.assertEqual(len(graph.items), 4)
+
+    def test_incremental_dirty_users(self):
+        recreate_tables()
+        users = [mnrd.get_add_user('user%s' % i, session) for i in xrange(5)]
+        annots = [mnrd.get_add_item('www.example.com', 'annot%s' % i,
+                  users[0], session, spam_detect_algo=su.ALGO_DIRICHLET)
+                  for i in xrange(2)]
+        frozen = mnrd.get_add_item('www.example.com', 'frozen', users[4],
+                        session, spam_detect_algo=su.ALGO_DIRICHLET)
+        for i in xrange(1, 4):
+            mnrd.raise_ham_flag(annots[0], users[i], session, algo_name=algo_name)
+        mnrd.raise_spam_flag(annots[1], users[1], session, algo_name=algo_name)
+        mnrd.raise_ham_flag(annots[1], users[2], session, algo_name=algo_name)
+        mnrd.run_offline_spam_detection(algo_name, session)
+        # The item is known as spam.
+        frozen.sd_frozen = True
+        frozen.sd_weight = -1
+        session.flush()
+        self.assertTrue(sdd.run_incremental_computations(session) is None)
+
+        def check_full_run():
+            weights = [it.sd_weight for it in annots]
+            reliabs = [u.sd_reliab for u in users]
+            mnrd.run_offline_spam_detection(algo_name, session)
+            for i in xrange(len(annots)):
+                self.assertAlmostEqual(weights[i], annots[i].sd_weight,
+                                       places=5)
+            for i in xrange(len(users)):
+                self.assertAlmostEqual(reliabs[i], users[i].sd_reliab,
+                                       places=5)
+
+        # A flag on the frozen item changes base values of user1, so items
+        # user1 acted on are recomputed.
+        mnrd.raise_spam_flag(frozen, users[1], session, algo_name=algo_name)
+        self.assertTrue(users[1].sd_dirty)
+        graph = sdd.run_incremental_computations(session)
+        self.assertEqual(sorted(it.id for it in graph.items),
+                         ['annot0', 'annot1'])
+        self.assertFalse(users[1].sd_dirty)
+        check_full_run()
+        # Deleting an item by the author changes base values of flaggers.
+        mnrd.delete_spam_item_by_author(annots[1], session,
+                                        algo_name=algo_name)
+        self.assertTrue(users[1].sd_dirty and users[2].sd_dirty)
+        annots = annots[:1]
+        graph = sdd.run_incremental_computations(session)
+        self.assertEqual([it.id for it in graph.items], ['annot0'])
+        check_full_run()
+        self.assertFalse(any(u.sd_dirty for u in users))
+
+    def test_bulk_write_back(self):
+        ModerationUser = UserMixin.cls
+        ModeratedAnnotation = ItemMixin.cls
+        results = []
+        threshold_spam = sdd.THRESHOLD_DEFINITELY_SPAM
+        threshold_ham = sdd.THRESHOLD_DEFINITELY_HAM
+        bulk_write_back = sdd.BULK_WRITE_BACK
+        rows_per_page = sdm.ROWS_PER_PAGE
+        # The object path streams items and actions in several pages.
+        sdm.ROWS_PER_PAGE = 2
+        # Finite thresholds freeze some items.
+        sdd.THRESHOLD_DEFINITELY_SPAM = -0.01
+        sdd.THRESHOLD_DEFINITELY_HAM = 0.02
+        try:
+            for bulk in (False, True):
+                sdd.BULK_WRITE_BACK = bulk
+                recreate_tables()
+                users = [mnrd.get_add_user('user%s' % i, session)
+                         for i in xrange(6)]
+                annots = [mnrd.get_add_item('www.example.com', 'annot%s' % i,
+                          users[i % 3], session) for i in xrange(5)]
+                for i in xrange(5):
+                    for j in xrange(3, 6):
+                        if (i + j) % 4 == 0:
+                            mnrd.raise_spam_flag(annots[i], users[j], session,
+                                                 algo_name=algo_name)
+                        else:
+                            mnrd.raise_ham_flag(annots[i], users[j], session,
+                                                algo_name=algo_name)
+                mnrd.run_offline_spam_detection(algo_name, session)
+                session.expunge_all()
+                results.append((
+                    [(u.id, u.sd_reliab, u.sd_u_n, u.sd_u_p, u.sd_base_u_n,
+                      u.sd_base_u_p, u.sd_karma_user_reliab,
+                      u.sd_karma_user_base_u_n, u.sd_karma_user_base_u_p)
+                     for u in session.query(ModerationUser).order_by(
+                                                        ModerationUser.id)],
+                    [(it.id, it.sd_weight, it.sd_frozen, it.sd_dirty,
+                      it.is_spam, it.is_ham, it.marked_for_mm)
+                     for it in session.query(ModeratedAnnotation).order_by(
+                                                    ModeratedAnnotation.id)]))
+        finally:
+            sdd.THRESHOLD_DEFINITELY_SPAM = threshold_spam
+            sdd.THRESHOLD_DEFINITELY_HAM = threshold_ham
+            sdd.BULK_WRITE_BACK = bulk_write_back
+            sdm.ROWS_PER_PAGE = rows_per_page
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(any(row[2] for row in results[1][1]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,11 @@
 #!/usr/bin/python
+import os
+import random
+import shutil
+import tempfile
 import unittest
 import mannord.graph_d as gd
+import mannord.graph_pool as gp
 
 # Behaviour of the aglorithm depends on how we compute user's reliability.
 # We can listen to a user (reliability > 0) only if we have some agreement
@@ -110,5 +115,155 @@ class TestDirichletVanilla(unittest.TestCase):
 
         self.assertTrue(u3.reliability < th)
 
+    def test_array_graph(self):
+        # Array graph should give the same results as the regular graph.
+        rnd = random.Random(0)
+        answers = [('u%s' % rnd.randrange(8), 'it%s' % rnd.randrange(6),
+                    rnd.choice([-1, 1, 0.5]),
+                    rnd.choice([(0, 0), (-1, 2), (-10, 0)])) for i in xrange(25)]
+        g = gd.Graph()
+        g_arr = gd.ArrayGraph()
+        for u_id, it_id, answr, (base_n, base_p) in answers:
+            g.add_answer(u_id, it_id, answr, base_u_n=base_n, base_u_p=base_p)
+            g_arr.add_answer(u_id, it_id, answr, base_u_n=base_n,
+                             base_u_p=base_p)
+        g.compute_answers(5)
+        g_arr.compute_answers(5)
+        for u in g.users:
+            u_arr = g_arr.get_user(u.id)
+            self.assertAlmostEqual(u.u_n, u_arr.u_n)
+            self.assertAlmostEqual(u.u_p, u_arr.u_p)
+            self.assertAlmostEqual(u.reliability, u_arr.reliability)
+        for it in g.items:
+            self.assertAlmostEqual(it.weight, g_arr.get_item(it.id).weight)
+
+    def test_tolerance(self):
+        for cls in (gd.Graph, gd.ArrayGraph):
+            g = cls()
+            g.add_answer('u1', 'it1', 1)
+            g.add_answer('u1', 'it2', 1)
+            g.add_answer('u2', 'it1', 1)
+            g.add_answer('u2', 'it2', 1)
+            g.add_answer('u3', 'it1', -1)
+            g.compute_answers(100, tol=1e-6)
+            self.assertTrue(g.n_iterations < 100)
+            self.assertTrue(g.residual < 1e-6)
+            self.assertTrue(g.get_item('it1').weight > 0)
+
+    def test_components(self):
+        random.seed(3)
+        answers = []
+        # Five independent communities of users and items.
+        for c in xrange(5):
+            for i in xrange(6):
+                for u in random.sample(xrange(8), 4):
+                    answers.append(('u%s_%s' % (c, u), 'it%s_%s' % (c, i),
+                                    random.choice([-1, 1])))
+        g = gd.ArrayGraph()
+        for u_id, it_id, answr in answers:
+            g.add_answer(u_id, it_id, answr)
+        g.compute_answers(20)
+        g_pool = gd.ArrayGraph()
+        for u_id, it_id, answr in answers:
+            g_pool.add_answer(u_id, it_id, answr)
+        batch_edges = gp.COMPONENT_BATCH_EDGES
+        gp.COMPONENT_BATCH_EDGES = 30
+        try:
+            gp.compute_answers_in_pool(g_pool, 20, 2)
+        finally:
+            gp.COMPONENT_BATCH_EDGES = batch_edges
+        for it in g.items:
+            self.assertAlmostEqual(it.weight, g_pool.get_item(it.id).weight)
+        for u in g.users:
+            self.assertAlmostEqual(u.reliability,
+                                   g_pool.get_user(u.id).reliability)
+
+    def test_warm_start(self):
+        answers = [('u1', 'it1', 1), ('u1', 'it2', 1), ('u1', 'it3', -1),
+                   ('u2', 'it1', 1), ('u2', 'it2', 1), ('u2', 'it3', -1),
+                   ('u3', 'it1', -1), ('u3', 'it2', -1), ('u3', 'it3', 1),
+                   ('u4', 'it2', 1), ('u4', 'it3', -1)]
+        for cls in (gd.Graph, gd.ArrayGraph):
+            cold = cls()
+            for u_id, it_id, answr in answers:
+                cold.add_answer(u_id, it_id, answr)
+            cold.compute_answers(100, tol=1e-6)
+            # Starts from the results of the cold run.
+            warm = cls()
+            for u_id, it_id, answr in answers:
+                u = cold.get_user(u_id)
+                warm.add_answer(u_id, it_id, answr, warm_u_n=u.u_n,
+                    warm_u_p=u.u_p, warm_weight=cold.get_item(it_id).weight)
+            warm.compute_answers(100, tol=1e-6, warm_start=True)
+            self.assertTrue(warm.n_iterations <= cold.n_iterations)
+            for it in cold.items:
+                self.assertAlmostEqual(it.weight,
+                                       warm.get_item(it.id).weight, places=4)
+
+    def test_percentile_array(self):
+        # Array functions should give the same values as the scalar ones.
+        neg = [0, -1.5, -3, 0, -20.3, -0.2]
+        pos = [0, 2, 0, 7.1, 10, 0.9]
+        reliab = gd.get_reliability_array(neg, pos)
+        weight = gd.get_item_weight_array(neg, pos)
+        for i in xrange(len(neg)):
+            self.assertAlmostEqual(reliab[i],
+                                   gd.get_reliability(neg[i], pos[i]))
+            self.assertAlmostEqual(weight[i],
+                                   gd.get_item_weight(neg[i], pos[i]))
+        perc = gd.compute_percentile_dirichlet_array(neg, pos, 0.8,
+                                                     chunk_size=4)
+        self.assertEqual(perc.shape, (len(neg),))
+
+    def test_percentile_beta(self):
+        # For pos = 1, neg = 0 the distribution function is x ** 2.
+        perc = gd.compute_percentile_beta(0, 1, 0.8)
+        self.assertAlmostEqual(perc, 0.2 ** 0.5)
+        # For pos = 0, neg = 2 the distribution function is 1 - (1 - x) ** 3.
+        perc = gd.compute_percentile_beta(-2, 0, 0.8)
+        self.assertAlmostEqual(perc, 1 - 0.8 ** (1. / 3))
+        # Percentiles of heavy users are close to the mean.
+        perc = gd.compute_percentile_beta([-1e7, -10], [1e7, 3e7], 0.8)
+        self.assertTrue(0.499 < perc[0] < 0.5)
+        self.assertTrue(0.99999 < perc[1] < 1)
+        self.assertTrue(gd.get_reliability(-1e8, 3e8) > 0.5)
+
+    def test_percentile_table(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(tmp_dir, 'table.npy')
+            gd.build_percentile_table(file_path, max_count=5, step=0.25)
+            table = gd.load_percentile_table(file_path)
+            self.assertTrue(table.error < 0.01)
+            neg = [0, -1.3, -4.9, -2, -7, -30]
+            pos = [0, 2.2, 0.1, 6, 1, 3]
+            reliab = gd.get_reliability_array(neg, pos)
+            weight = gd.get_item_weight_array(neg, pos)
+            gd.unload_percentile_table()
+            for i in xrange(len(neg)):
+                # Values are interpolated within the table and exact outside.
+                self.assertTrue(abs(reliab[i] - gd.get_reliability(neg[i],
+                                    pos[i])) <= 2 * table.error)
+                self.assertTrue(abs(weight[i] - gd.get_item_weight(neg[i],
+                                    pos[i])) <= table.error)
+        finally:
+            gd.unload_percentile_table()
+            shutil.rmtree(tmp_dir)
+
+    def test_percentile_table_small(self):
+        # The table needs at least 3 grid points in each direction.
+        self.assertRaises(Exception, gd.build_percentile_table, 'table.npy',
+                          max_count=0.25, step=0.25)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(tmp_dir, 'table.npy')
+            gd.build_percentile_table(file_path, max_count=1, step=0.5)
+            table = gd.load_percentile_table(file_path)
+            self.assertEqual(table.max_count, 1)
+            self.assertTrue(gd._percentile_table is table)
+        finally:
+            gd.unload_percentile_table()
+            shutil.rmtree(tmp_dir)
+
 if __name__ == '__main__':
     unittest.main()
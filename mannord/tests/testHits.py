@@ -1,11 +1,13 @@
 #!/usr/bin/python
 
+import random
 import unittest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from mannord import (ItemMixin, UserMixin, ActionMixin)
 import mannord.hits as hits
+import mannord.hitsDB as hitsDB
 import mannord as mnrd
 
 
@@ -47,6 +49,46 @@ class TestHITS(unittest.TestCase):
         self.assertTrue(len(n_items) == 3)
         self.assertTrue(n_items[0] == 'it2')
 
+    def _random_graph(self, graph_class):
+        rnd = random.Random(5)
+        g = graph_class()
+        for i in xrange(300):
+            g.add_link('u%d' % rnd.randint(0, 40), 'it%d' % rnd.randint(0, 60),
+                       rnd.randint(1, 3))
+        return g
+
+    def test_array_graph(self):
+        g = self._random_graph(hits.Graph)
+        g.hubs_and_authorities(10)
+        ag = self._random_graph(hits.ArrayGraph)
+        ag.hubs_and_authorities(10)
+        for u in g.users:
+            self.assertAlmostEqual(u.hub_weight,
+                                   ag.get_user(u.id).hub_weight)
+        for it in g.items:
+            self.assertAlmostEqual(it.auth_weight,
+                                   ag.get_item(it.id).auth_weight)
+        self.assertEqual(g.get_n_top_users(7, 'u3'),
+                         ag.get_n_top_users(7, 'u3'))
+        self.assertEqual(g.get_n_top_items(7), ag.get_n_top_items(7))
+        # Top users are the first users of the sorted list.
+        l = sorted(((u.hub_weight, u.id) for u in g.users if u.id != 'u3'),
+                   reverse=True)
+        self.assertEqual(g.get_n_top_users(7, 'u3'), [u_id for _, u_id in l[:7]])
+
+    def test_tolerance(self):
+        for graph_class in (hits.Graph, hits.ArrayGraph):
+            g = self._random_graph(graph_class)
+            g.hubs_and_authorities(100, tol=1e-4)
+            self.assertTrue(g.n_iterations < 100)
+            g_full = self._random_graph(graph_class)
+            g_full.hubs_and_authorities(100)
+            self.assertEqual(g_full.n_iterations, 100)
+            for u in g.users:
+                self.assertAlmostEqual(u.hub_weight,
+                                       g_full.get_user(u.id).hub_weight,
+                                       places=3)
+
     def test_hits_db(self):
         engine = create_engine('sqlite:///:memory:')
         #engine = create_engine("mysql://root:@localhost/mannord_test")
@@ -87,6 +129,68 @@ class TestHITS(unittest.TestCase):
         self.assertTrue(n_items[2] == user4.id)
         self.assertTrue(len(n_items) == 3)
 
+        # Links and pages are aggregated in SQL.
+        users, links = hitsDB.get_1neighbors_and_links('www.example1.com',
+                                                       session)
+        self.assertEqual(links, {'user1': 1, 'user2': 1, 'user3': 2})
+        self.assertEqual(sorted(hitsDB.get_1neighbors_for_user('user3',
+                                                               session)),
+                         ['www.example1.com', 'www.example2.com',
+                          'www.example3.com'])
+        statements = []
+        listener = lambda *args: statements.append(1)
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            hitsDB.suggest_n_users_to_review(annot8, 4, session)
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+        # Links are read from the link table, heaviest pages of all
+        # neighbour users by one query with ROW_NUMBER().
+        self.assertEqual(len(statements), 3)
+
+        # All ways to read pages of users agree.
+        def page_weights(use_link_table, use_window_functions):
+            saved = hitsDB.USE_LINK_TABLE, hitsDB.USE_WINDOW_FUNCTIONS
+            hitsDB.USE_LINK_TABLE = use_link_table
+            hitsDB.USE_WINDOW_FUNCTIONS = use_window_functions
+            try:
+                return [hitsDB.get_page_weights_of_users(
+                            ['user1', 'user3', 'user4'], session,
+                            max_pages=max_pages,
+                            exclude=set(['www.example3.com']))
+                        for max_pages in (None, 1, 2)]
+            finally:
+                hitsDB.USE_LINK_TABLE, hitsDB.USE_WINDOW_FUNCTIONS = saved
+        expected = page_weights(True, True)
+        self.assertEqual(expected[0]['user3'], {'www.example1.com': 2,
+                                                'www.example2.com': 1})
+        self.assertEqual(expected[1]['user3'], {'www.example1.com': 2})
+        for use_link_table in (True, False):
+            for use_window_functions in (True, False):
+                self.assertEqual(page_weights(use_link_table,
+                                              use_window_functions), expected)
+
+        # Expansion limits, user1 is reachable only through www.example1.com
+        # which the author user2 and user3 annotated.
+        def suggest(**limits):
+            saved = dict((name, getattr(hitsDB, name)) for name in limits)
+            try:
+                for name, value in limits.iteritems():
+                    setattr(hitsDB, name, value)
+                return hitsDB.suggest_n_users_to_review(annot8, 4, session)
+            finally:
+                for name, value in saved.iteritems():
+                    setattr(hitsDB, name, value)
+        self.assertIn('user1', suggest(MAX_NEIGHBOR_USERS=1))
+        self.assertIn('user1', suggest(MAX_LINKS=6))
+        self.assertIn('user1', suggest(MAX_PAGES_PER_USER=1))
+        self.assertIn('user1', suggest(MAX_PAGES_PER_USER=1,
+                                       USE_LINK_TABLE=False))
+        for limits in [{'MAX_NEIGHBOR_USERS': 0}, {'MAX_PAGES_PER_USER': 0},
+                       {'MAX_LINKS': 5}, {'SUGGESTION_TIME_BUDGET': 0},
+                       {'SUGGESTION_TIME_BUDGET': 0, 'USE_LINK_TABLE': False}]:
+            self.assertEqual(sorted(suggest(**limits)), ['user3', 'user4'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -9,6 +9,9 @@ import unittest
 from mannord import (ItemMixin, UserMixin, ActionMixin, ComputationMixin)
 import mannord as mnrd
 import mannord.spam_utils as su
+import mannord.spam_detection_mixins as sdm
+import mannord.spam_detection_karger as sdk
+import mannord.graph_pool as gp
 
 Base = declarative_base()
 
@@ -40,6 +43,7 @@ def recreate_tables():
     session.expunge_all()
     Base.metadata.create_all()
     session.flush()
+    ComputationMixin.invalidate_cache()
 
 
 class TestSpamFlag(unittest.TestCase):
@@ -153,6 +157,179 @@ class TestSpamFlag(unittest.TestCase):
         print 'annot1 spam weight', annot1.sk_weight
         print 'annot2 spam weight', annot2.sk_weight
 
+    def test_incremental(self):
+        recreate_tables()
+        users = [mnrd.get_add_user('user%s' % i, session) for i in xrange(8)]
+        # Two disconnected regions: annotations of user0 flagged by users
+        # 1-3 and annotations of user4 flagged by users 5-7.
+        annots = []
+        for i in xrange(4):
+            author = users[0] if i < 2 else users[4]
+            annots.append(mnrd.get_add_item('www.example.com', 'annot%s' % i,
+                          author, session, spam_detect_algo=su.ALGO_KARGER))
+        for i in xrange(1, 4):
+            mnrd.raise_spam_flag(annots[0], users[i], session, algo_name=su.ALGO_KARGER)
+            mnrd.raise_ham_flag(annots[1], users[i], session, algo_name=su.ALGO_KARGER)
+            mnrd.raise_ham_flag(annots[2], users[i + 4], session, algo_name=su.ALGO_KARGER)
+            mnrd.raise_ham_flag(annots[3], users[i + 4], session, algo_name=su.ALGO_KARGER)
+        mnrd.run_offline_spam_detection(su.ALGO_KARGER, session)
+        self.assertTrue(sdk.run_incremental_computations(session) is None)
+        weight = annots[2].sk_weight
+        # Changes the first region only.
+        mnrd.raise_ham_flag(annots[0], users[1], session, algo_name=su.ALGO_KARGER)
+        mnrd.raise_ham_flag(annots[0], users[2], session, algo_name=su.ALGO_KARGER)
+        mnrd.raise_ham_flag(annots[0], users[3], session, algo_name=su.ALGO_KARGER)
+        self.assertTrue(annots[0].sk_dirty)
+        self.assertFalse(annots[2].sk_dirty)
+        comp = mnrd.ComputationMixin.cls.get(mnrd.COMPUTATION_SK_NAME, session)
+        normaliz = comp.normalization
+        graph = sdk.run_incremental_computations(session)
+        self.assertEqual(sorted(it.id for it in graph.items),
+                         ['annot0', 'annot1'])
+        # Stored normalization is used.
+        self.assertEqual(graph.normaliz, normaliz)
+        self.assertFalse(annots[0].sk_dirty)
+        self.assertTrue(annots[0].sk_weight > 0)
+        self.assertEqual(annots[2].sk_weight, weight)
+        self.assertTrue(sdk.run_incremental_computations(session) is None)
+        # A flag on a frozen item changes base reliability of user5, so
+        # items user5 acted on are recomputed.
+        annots[0].sk_frozen = True
+        session.flush()
+        mnrd.raise_spam_flag(annots[0], users[5], session, algo_name=su.ALGO_KARGER)
+        self.assertTrue(users[5].sk_dirty)
+        graph = sdk.run_incremental_computations(session)
+        self.assertEqual(sorted(it.id for it in graph.items),
+                         ['annot2', 'annot3'])
+        self.assertFalse(users[5].sk_dirty)
+
+    def test_bulk_write_back(self):
+        ModerationUser = UserMixin.cls
+        ModeratedAnnotation = ItemMixin.cls
+        ModerationAction = ActionMixin.cls
+        results = []
+        threshold_spam = sdk.THRESHOLD_DEFINITELY_SPAM
+        threshold_ham = sdk.THRESHOLD_DEFINITELY_HAM
+        bulk_write_back = sdk.BULK_WRITE_BACK
+        rows_per_page = sdm.ROWS_PER_PAGE
+        # The object path streams items and actions in several pages.
+        sdm.ROWS_PER_PAGE = 2
+        # Finite thresholds freeze some items.
+        sdk.THRESHOLD_DEFINITELY_SPAM = -0.5
+        sdk.THRESHOLD_DEFINITELY_HAM = 2
+        try:
+            for bulk in (False, True):
+                sdk.BULK_WRITE_BACK = bulk
+                recreate_tables()
+                users = [mnrd.get_add_user('user%s' % i, session)
+                         for i in xrange(6)]
+                annots = [mnrd.get_add_item('www.example.com', 'annot%s' % i,
+                          users[i % 3], session, spam_detect_algo=su.ALGO_KARGER)
+                          for i in xrange(5)]
+                for i in xrange(5):
+                    for j in xrange(3, 6):
+                        if (i + j) % 4 == 0:
+                            mnrd.raise_spam_flag(annots[i], users[j], session,
+                                                 algo_name=su.ALGO_KARGER)
+                        else:
+                            mnrd.raise_ham_flag(annots[i], users[j], session,
+                                                algo_name=su.ALGO_KARGER)
+                mnrd.downvote(annots[0], users[4], session)
+                mnrd.run_offline_spam_detection(su.ALGO_KARGER, session)
+                session.expunge_all()
+                results.append((
+                    [(u.id, u.sk_reliab, u.sk_reliab_raw, u.sk_base_reliab,
+                      u.sk_karma_user_reliab, u.sk_karma_user_base_reliab)
+                     for u in session.query(ModerationUser).order_by(
+                                                        ModerationUser.id)],
+                    [(it.id, it.sk_weight, it.sk_frozen, it.sk_dirty,
+                      it.is_spam, it.is_ham, it.marked_for_mm)
+                     for it in session.query(ModeratedAnnotation).order_by(
+                                                    ModeratedAnnotation.id)],
+                    [(act.id, act.sk_frozen)
+                     for act in session.query(ModerationAction).order_by(
+                                                    ModerationAction.id)]))
+        finally:
+            sdk.THRESHOLD_DEFINITELY_SPAM = threshold_spam
+            sdk.THRESHOLD_DEFINITELY_HAM = threshold_ham
+            sdk.BULK_WRITE_BACK = bulk_write_back
+            sdm.ROWS_PER_PAGE = rows_per_page
+        self.assertEqual(results[0], results[1])
+        # Some items are frozen and the downvote (the last action) is
+        # excluded from offline computations.
+        self.assertTrue(any(row[2] for row in results[1][1]))
+        self.assertTrue(results[1][2][-1][1])
+
+    def test_pool(self):
+        results = []
+        batch_edges = gp.COMPONENT_BATCH_EDGES
+        gp.COMPONENT_BATCH_EDGES = 5
+        try:
+            for n_processes in (1, 2):
+                recreate_tables()
+                # Three pages with their own users.
+                for page in xrange(3):
+                    users = [mnrd.get_add_user('user%s_%s' % (page, i),
+                                               session) for i in xrange(4)]
+                    annots = [mnrd.get_add_item('www.example%s.com' % page,
+                              'annot%s_%s' % (page, i), users[i], session,
+                              spam_detect_algo=su.ALGO_KARGER)
+                              for i in xrange(3)]
+                    for i in xrange(3):
+                        for j in xrange(1, 4):
+                            if (i + j + page) % 3 == 0:
+                                mnrd.raise_spam_flag(annots[i], users[j],
+                                        session, algo_name=su.ALGO_KARGER)
+                            else:
+                                mnrd.raise_ham_flag(annots[i], users[j],
+                                        session, algo_name=su.ALGO_KARGER)
+                sdk.run_offline_computations(session,
+                                             n_processes=n_processes)
+                comp = ComputationMixin.cls.get(mnrd.COMPUTATION_SK_NAME,
+                                                session)
+                results.append((comp.normalization,
+                    [(u.id, u.sk_reliab, u.sk_reliab_raw,
+                      u.sk_karma_user_reliab)
+                     for u in session.query(UserMixin.cls).order_by(
+                                                        UserMixin.cls.id)],
+                    [(it.id, it.sk_weight)
+                     for it in session.query(ItemMixin.cls).order_by(
+                                                        ItemMixin.cls.id)]))
+        finally:
+            gp.COMPONENT_BATCH_EDGES = batch_edges
+        # The pool computes the same normalization as the single process.
+        self.assertNotEqual(results[0][0], 1.0)
+        self.assertAlmostEqual(results[1][0], results[0][0])
+        for rows, pool_rows in zip(results[0][1:], results[1][1:]):
+            self.assertEqual(len(rows), len(pool_rows))
+            for row, pool_row in zip(rows, pool_rows):
+                self.assertEqual(row[0], pool_row[0])
+                for val, pool_val in zip(row[1:], pool_row[1:]):
+                    self.assertAlmostEqual(val, pool_val)
+
+    def test_normalization_cache(self):
+        recreate_tables()
+        Computation = ComputationMixin.cls
+        name = mnrd.COMPUTATION_SK_NAME
+        comp = Computation.get(name, session)
+        self.assertEqual(Computation.get_normalization(name, session), 1.0)
+        # The cached value is used until the cache is invalidated.
+        comp.normalization = 2.0
+        session.flush()
+        self.assertEqual(Computation.get_normalization(name, session), 1.0)
+        Computation.invalidate_cache(name)
+        self.assertEqual(Computation.get_normalization(name, session), 2.0)
+        # Offline computations write normalization and invalidate the cache.
+        user1 = mnrd.get_add_user('user1', session)
+        user2 = mnrd.get_add_user('user2', session)
+        annot1 = mnrd.get_add_item('www.example.com', 'annot1', user1,
+                                   session, spam_detect_algo=su.ALGO_KARGER)
+        mnrd.raise_spam_flag(annot1, user2, session, algo_name=su.ALGO_KARGER)
+        mnrd.run_offline_spam_detection(su.ALGO_KARGER, session)
+        self.assertEqual(Computation.get_normalization(name, session),
+                         comp.normalization)
+        self.assertNotEqual(comp.normalization, 2.0)
+
 
 if __name__ == '__main__':
     unittest.main()
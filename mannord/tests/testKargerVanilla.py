@@ -1,6 +1,8 @@
 #!/usr/bin/python
+import random
 import unittest
 import mannord.graph_k as gk
+import mannord.graph_pool as gp
 
 
 class TestKargerVanilla(unittest.TestCase):
@@ -156,6 +158,141 @@ class TestKargerVanilla(unittest.TestCase):
         self.assertTrue(u1.reliability > 0)
         self.assertTrue(u2.reliability > 0)
 
+    def test_array_graph(self):
+        # Array graph should give the same results as the regular graph.
+        rnd = random.Random(0)
+        answers = [('u%s' % rnd.randrange(20), 'it%s' % rnd.randrange(15),
+                    rnd.choice([-1, 1, gk.KARMA_USER_VOTE]),
+                    rnd.choice([0, 1, -1])) for i in xrange(80)]
+        g = gk.Graph()
+        g_arr = gk.ArrayGraph()
+        for u_id, it_id, answr, base in answers:
+            g.add_answer(u_id, it_id, answr, base_reliability=base)
+            g_arr.add_answer(u_id, it_id, answr, base_reliability=base)
+        g.compute_answers(11)
+        g_arr.compute_answers(11)
+        self.assertAlmostEqual(g.normaliz, g_arr.normaliz)
+        for u in g.users:
+            u_arr = g_arr.get_user(u.id)
+            self.assertAlmostEqual(u.reliability, u_arr.reliability)
+            self.assertAlmostEqual(u.reliability_raw, u_arr.reliability_raw)
+        for it in g.items:
+            self.assertAlmostEqual(it.weight, g_arr.get_item(it.id).weight)
+
+    def test_tolerance(self):
+        for cls in (gk.Graph, gk.ArrayGraph):
+            g = cls()
+            g.add_answer('u1', 'it1', 1)
+            g.add_answer('u1', 'it2', 1)
+            g.add_answer('u2', 'it1', 1)
+            g.add_answer('u2', 'it2', 1)
+            g.add_answer('u3', 'it1', -1)
+            g.add_answer('u3', 'it2', -1)
+            g.compute_answers(100, tol=1e-6)
+            self.assertTrue(g.n_iterations < 100)
+            self.assertTrue(g.residual < 1e-6)
+            self.assertTrue(g.get_item('it1').weight > 0)
+            self.assertTrue(g.get_user('u3').reliability < 0)
+            # Without tolerance all iterations are made.
+            g.compute_answers(12)
+            self.assertEqual(g.n_iterations, 12)
+            self.assertTrue(g.residual is None)
+
+    def test_components(self):
+        random.seed(3)
+        answers = []
+        # Five independent communities of users and items.
+        for c in xrange(5):
+            for i in xrange(6):
+                for u in random.sample(xrange(8), 4):
+                    answers.append(('u%s_%s' % (c, u), 'it%s_%s' % (c, i),
+                                    random.choice([-1, 1])))
+        g = gk.ArrayGraph()
+        for u_id, it_id, answr in answers:
+            g.add_answer(u_id, it_id, answr)
+        self.assertEqual(len(gp.split_components(g)), 5)
+        g.compute_answers(20, tol=1e-6, normaliz=1.3)
+        for cls in (gk.Graph, gk.ArrayGraph):
+            g_pool = cls()
+            for u_id, it_id, answr in answers:
+                g_pool.add_answer(u_id, it_id, answr)
+            batch_edges = gp.COMPONENT_BATCH_EDGES
+            gp.COMPONENT_BATCH_EDGES = 30
+            try:
+                gk.compute_answers_in_pool(g_pool, 20, 2, normaliz=1.3,
+                                           tol=1e-6)
+            finally:
+                gp.COMPONENT_BATCH_EDGES = batch_edges
+            self.assertEqual(g_pool.normaliz, 1.3)
+            self.assertEqual(len(g_pool.items), len(g.items))
+            for it in g.items:
+                self.assertAlmostEqual(it.weight,
+                                       g_pool.get_item(it.id).weight)
+            for u in g.users:
+                self.assertAlmostEqual(u.reliability,
+                                       g_pool.get_user(u.id).reliability)
+
+    def test_components_global_normaliz(self):
+        random.seed(5)
+        answers = []
+        for c in xrange(6):
+            for i in xrange(5):
+                for u in random.sample(xrange(6), 3 + c % 3):
+                    answers.append(('u%s_%s' % (c, u), 'it%s_%s' % (c, i),
+                                    random.choice([-1, 1])))
+        for cls in (gk.Graph, gk.ArrayGraph):
+            g = cls()
+            g_pool = cls()
+            for u_id, it_id, answr in answers:
+                g.add_answer(u_id, it_id, answr, base_reliability=0.3)
+                g_pool.add_answer(u_id, it_id, answr, base_reliability=0.3)
+            g.compute_answers(20, tol=1e-6)
+            batch_edges = gp.COMPONENT_BATCH_EDGES
+            gp.COMPONENT_BATCH_EDGES = 20
+            try:
+                # Parts are computed in lock-step with the normalization
+                # over the whole graph.
+                gk.compute_answers_in_pool(g_pool, 20, 3, tol=1e-6)
+            finally:
+                gp.COMPONENT_BATCH_EDGES = batch_edges
+            self.assertNotEqual(g.normaliz, 1)
+            self.assertAlmostEqual(g_pool.normaliz, g.normaliz)
+            self.assertEqual(g_pool.n_iterations, g.n_iterations)
+            self.assertAlmostEqual(g_pool.residual, g.residual)
+            for it in g.items:
+                self.assertAlmostEqual(it.weight,
+                                       g_pool.get_item(it.id).weight)
+            for u in g.users:
+                self.assertAlmostEqual(u.reliability,
+                                       g_pool.get_user(u.id).reliability)
+                self.assertAlmostEqual(u.reliability_raw,
+                                       g_pool.get_user(u.id).reliability_raw)
+
+    def test_warm_start(self):
+        answers = [('u1', 'it1', 1), ('u1', 'it2', 1), ('u1', 'it3', -1),
+                   ('u2', 'it1', 1), ('u2', 'it2', 1), ('u2', 'it3', -1),
+                   ('u3', 'it1', -1), ('u3', 'it2', -1), ('u3', 'it3', 1),
+                   ('u4', 'it2', 1), ('u4', 'it3', -1)]
+        for cls in (gk.Graph, gk.ArrayGraph):
+            cold = cls()
+            for u_id, it_id, answr in answers:
+                cold.add_answer(u_id, it_id, answr)
+            cold.compute_answers(100, tol=1e-6)
+            # Starts from the results of the cold run.
+            warm = cls()
+            for u_id, it_id, answr in answers:
+                warm.add_answer(u_id, it_id, answr,
+                    warm_reliability=cold.get_user(u_id).reliability,
+                    warm_weight=cold.get_item(it_id).weight)
+            warm.compute_answers(100, tol=1e-6, warm_start=True)
+            self.assertTrue(warm.n_iterations <= cold.n_iterations)
+            for it in cold.items:
+                self.assertAlmostEqual(it.weight,
+                                       warm.get_item(it.id).weight, places=4)
+            for u in cold.users:
+                self.assertAlmostEqual(u.reliability,
+                                   warm.get_user(u.id).reliability, places=4)
+
 
     ##todo(michael): this function is temporary
     #def test_temp(self):